@@ -4,7 +4,7 @@ from .messaging_pyx import MultiplePublishersError, MessagingError  # pylint: di
 import os
 import capnp
 
-from typing import Optional, List, Union
+from typing import Any, Dict, Optional, List, Union
 from collections import deque
 
 from cereal import log
@@ -41,6 +41,65 @@ def new_message(service: Optional[str] = None, size: Optional[int] = None) -> ca
       dat.init(service, size)
   return dat
 
+# field values that MessageBuilder can compare with the last written one
+SCALAR_TYPES = {bool, int, float}
+COMPARABLE_TYPES = SCALAR_TYPES | {str, list}
+
+class MessageBuilder():
+  """Reuses one message for a service that is sent every cycle.
+
+     Fields are written in place and only when their value changed since the
+     last cycle, since setting a field costs much more than comparing it.
+     Lists of numbers that keep their length are also written in place.
+     Anything else that's rewritten, e.g. text, a list of another length or a
+     nested struct from init(), leaves the old data behind in the message, so
+     it's compacted with a copy before it's serialized again. The copy is one
+     C++ call, about 2 us for controlsState, which is cheaper than writing a
+     nested struct field by field through pycapnp.
+  """
+  def __init__(self, service: str, size: Optional[int] = None):
+    self.service = service
+    self.msg = new_message(service, size)
+    self.struct = getattr(self.msg, service)
+    self.values: Dict[str, Any] = {}
+    self.garbage = False
+
+  def update(self, **fields) -> None:
+    values = self.values
+    for name, value in fields.items():
+      old = values.get(name, values)
+      if old == value and type(value) in COMPARABLE_TYPES:
+        continue
+      if type(value) is list and type(old) is list and len(old) == len(value) and type(value[0]) in SCALAR_TYPES:
+        lst = getattr(self.struct, name)
+        for i, v in enumerate(value):
+          if old[i] != v:
+            lst[i] = v
+        values[name] = value.copy()
+        continue
+      setattr(self.struct, name, value)
+      # copied, so a list that's changed in place isn't mistaken for the written one
+      values[name] = value.copy() if type(value) is list else value
+      if type(value) not in SCALAR_TYPES:
+        self.garbage = True
+
+  def init(self, name: str, *args) -> capnp.lib.capnp._DynamicStructBuilder:
+    """Like struct.init(name), for nested fields that are written every cycle."""
+    self.values.pop(name, None)
+    self.garbage = True
+    return self.struct.init(name, *args)
+
+  def to_bytes(self, valid: bool = True) -> bytes:
+    if self.garbage:
+      self.msg = self.msg.copy()
+      self.struct = getattr(self.msg, self.service)
+      self.garbage = False
+    self.msg.logMonoTime = int(sec_since_boot() * 1e9)
+    self.msg.valid = valid
+    dat = self.msg.to_bytes()
+    self.msg.clear_write_flag()
+    return dat
+
 def pub_sock(endpoint: str) -> PubSocket:
   sock = PubSocket()
   sock.connect(context, endpoint)
@@ -22,7 +22,7 @@ cdef extern from "messaging.h":
     @staticmethod
     SubSocket * create()
     int connect(Context *, string, string, bool)
-    Message * receive(bool)
+    Message * receive(bool) nogil
     void setTimeout(int)
 
   cdef cppclass PubSocket:
@@ -80,8 +80,13 @@ cdef class SubSocket:
       raise MessagingError
 
   def __dealloc__(self):
+    self.close()
+
+  def close(self):
+    """Frees the socket now instead of when it's garbage collected, e.g. to release a msgq reader."""
     if self.is_owner:
       del self.socket
+    self.socket = NULL
 
   cdef setPtr(self, cppSubSocket * ptr):
     if self.is_owner:
@@ -100,10 +105,18 @@ cdef class SubSocket:
         raise MessagingError
 
   def setTimeout(self, int timeout):
+    if self.socket == NULL:
+      raise MessagingError("socket is closed")
     self.socket.setTimeout(timeout)
 
   def receive(self, bool non_blocking=False):
-    msg = self.socket.receive(non_blocking)
+    cdef cppMessage * msg
+    if self.socket == NULL:
+      raise MessagingError("socket is closed")
+
+    # other threads can run while this one waits for a message
+    with nogil:
+      msg = self.socket.receive(non_blocking)
 
     if msg == NULL:
       # If a blocking read returns no message check errno if SIGINT was caught in the C++ code
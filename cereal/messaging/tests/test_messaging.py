@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+import unittest
+
+import cereal.messaging as messaging
+from cereal import log
+
+
+class TestMessageBuilder(unittest.TestCase):
+  def setUp(self):
+    self.mb = messaging.MessageBuilder('controlsState')
+
+  def _update(self, cycle, can_mono_times=None, alert_text="alert"):
+    self.mb.update(
+      alertText1=alert_text,
+      canMonoTimes=[cycle, cycle + 1] if can_mono_times is None else can_mono_times,
+      enabled=cycle % 2 == 0,
+      vCruise=float(cycle % 3),
+      canErrorCounter=7,
+    )
+
+  def _read(self, valid=True):
+    return messaging.log_from_bytes(self.mb.to_bytes(valid=valid)).controlsState
+
+  def _check(self, cs, cycle, can_mono_times=None, alert_text="alert"):
+    self.assertEqual(cs.alertText1, alert_text)
+    self.assertEqual(list(cs.canMonoTimes), [cycle, cycle + 1] if can_mono_times is None else can_mono_times)
+    self.assertEqual(cs.enabled, cycle % 2 == 0)
+    self.assertEqual(cs.vCruise, float(cycle % 3))
+    self.assertEqual(cs.canErrorCounter, 7)
+
+  def test_round_trip(self):
+    self._update(0)
+    self._check(self._read(), 0)
+
+    # unchanged
+    self._update(0)
+    self.assertFalse(self.mb.garbage)
+    self._check(self._read(), 0)
+
+    # changed scalars and a list of the same length are written in place
+    self._update(1)
+    self.assertFalse(self.mb.garbage)
+    self._check(self._read(), 1)
+
+    # a list of another length and new text are replaced
+    self._update(2, can_mono_times=[5, 6, 7], alert_text="other")
+    self.assertTrue(self.mb.garbage)
+    self._check(self._read(), 2, can_mono_times=[5, 6, 7], alert_text="other")
+    self._update(3, can_mono_times=[])
+    self._check(self._read(), 3, can_mono_times=[])
+
+    # nested structs
+    lac_log = log.ControlsState.LateralPIDState.new_message()
+    lac_log.output = 0.5
+    self.mb.init('lateralControlState').pidState = lac_log
+    self._update(4)
+    cs = self._read()
+    self._check(cs, 4)
+    self.assertEqual(cs.lateralControlState.pidState.output, 0.5)
+
+    # a list changed in place after it was written is still seen as changed
+    times = [1, 2]
+    self.mb.update(canMonoTimes=times)
+    times[0] = 3
+    self.mb.update(canMonoTimes=times)
+    self.assertEqual(list(self._read().canMonoTimes), [3, 2])
+
+  def test_valid(self):
+    self._update(0)
+    self.assertFalse(messaging.log_from_bytes(self.mb.to_bytes(valid=False)).valid)
+    self.assertTrue(messaging.log_from_bytes(self.mb.to_bytes()).valid)
+
+  def test_size_bounded(self):
+    lac_log = log.ControlsState.LateralPIDState.new_message()
+    def update(cycle, **kwargs):
+      self._update(cycle, **kwargs)
+      lac_log.output = cycle / 4.
+      self.mb.init('lateralControlState').pidState = lac_log
+
+    update(0)
+    size = len(self.mb.to_bytes())
+    for cycle in range(1, 500):
+      if cycle % 50 == 0:
+        update(cycle, can_mono_times=list(range(cycle % 7)), alert_text=f"alert {cycle}")
+      else:
+        update(cycle)
+      self.assertLessEqual(len(self.mb.to_bytes()), size + 64)
+
+    # back to the size of the first cycle with the same content
+    update(0)
+    self.assertEqual(len(self.mb.to_bytes()), size)
+
+
+if __name__ == "__main__":
+  unittest.main()
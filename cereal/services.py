@@ -62,6 +62,9 @@ services = {
   "modelV2": (True, 20., 40),
   "managerState": (True, 2., 1),
   "uploaderState": (True, 0., 1),
+  "controlsdLatency": (True, 0.1, 1),
+  "plannerdLatency": (True, 0.1, 1),
+  "radardLatency": (True, 0.1, 1),
 
   # debug
   "testJoystick": (False, 0.),
@@ -19,6 +19,14 @@ def json_handler(obj):
 def json_robust_dumps(obj):
   return json.dumps(obj, default=json_handler)
 
+def json_key(k):
+  # dict keys as json.dumps writes them
+  if isinstance(k, str):
+    return k
+  elif isinstance(k, (bool, int, float)) or k is None:
+    return json.dumps(k)
+  return str(k)
+
 class NiceOrderedDict(OrderedDict):
   def __str__(self):
     return json_robust_dumps(self)
@@ -74,6 +82,8 @@ class SwagLogFileFormatter(SwagFormatter):
     # e.g. log.info() creates 'msg' -> 'msg$s'
     #      log.event() creates 'msg.health.logMonoTime' -> 'msg.health.logMonoTime$i'
     #      because overlapping namespace 'msg' caused problems
+    # records aren't passed through json first anymore, so keys can be of any type
+    k = json_key(k)
     if isinstance(v, (str, bytes)):
       k += "$s"
     elif isinstance(v, float):
@@ -88,22 +98,27 @@ class SwagLogFileFormatter(SwagFormatter):
         ik, iv = self.fix_kv(ik, iv)
         nv[ik] = iv
       v = nv
-    elif isinstance(v, list):
+    elif isinstance(v, (list, tuple)):
       k += "$a"
+    elif v is not None:
+      # anything else ends up as its repr, see json_handler
+      k += "$s"
     return k, v
 
+  def format_record_dict(self, v):
+    v = copy.copy(v)
+    mk, mv = self.fix_kv('msg', v.pop('msg'))
+    v[mk] = mv
+    v['id'] = uuid.uuid4().hex
+
+    return json_robust_dumps(v)
+
   def format(self, record):
     if isinstance(record, str):
       v = json.loads(record)
     else:
       v = self.format_dict(record)
-
-    mk, mv = self.fix_kv('msg', v['msg'])
-    del v['msg']
-    v[mk] = mv
-    v['id'] = uuid.uuid4().hex
-
-    return json_robust_dumps(v)
+    return self.format_record_dict(v)
 
 class SwagErrorFilter(logging.Filter):
   def filter(self, record):
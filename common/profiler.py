@@ -1,8 +1,10 @@
 import time
 
 class Profiler():
-  def __init__(self, enabled=False):
+  def __init__(self, enabled=False, latency=None):
+    """latency is an optional LoopLatency that gets every checkpoint, even when disabled."""
     self.enabled = enabled
+    self.latency = latency
     self.cp = {}
     self.cp_ignored = []
     self.iter = 0
@@ -19,6 +21,8 @@ class Profiler():
     self.last_time = self.start_time
 
   def checkpoint(self, name, ignore=False):
+    if self.latency is not None:
+      self.latency.checkpoint(name, ignore)
     # ignore flag needed when benchmarking threads with ratekeeper
     if not self.enabled:
       return
@@ -33,6 +37,9 @@ class Profiler():
     self.last_time = tt
 
   def display(self):
+    # called once per loop
+    if self.latency is not None:
+      self.latency.end_loop()
     if not self.enabled:
       return
     self.iter += 1
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+import json
+import logging
+import unittest
+from enum import IntEnum
+
+import numpy as np
+
+from common.logging_extra import SwagLogger, SwagLogFileFormatter, NiceOrderedDict, json_robust_dumps
+
+
+class Gear(IntEnum):
+  park = 1
+
+
+class Thing():
+  def __repr__(self):
+    return "Thing()"
+
+
+PAYLOADS = [
+  "plain message",
+  {"event": "counts", "counts": {1: 2, 2.5: "a", True: None, None: [1, 2]}},
+  {"event": "nested", "a": {"b": {"c": 1, "d": 1.5, "e": False}}, "l": [{"x": 1}, (1, 2)]},
+  {"event": "types", "bytes": b"\x00\x01", "tuple": (1, "a"), "enum": Gear.park, "thing": Thing(),
+   "np_float": np.float64(1.5), "np_int": np.int64(3), "none": None, "nan": float("nan")},
+  NiceOrderedDict([("event", "ordered"), ("args", ("a", 1)), (3, {4: 5})]),
+]
+
+
+class TestSwagLogFileFormatter(unittest.TestCase):
+  def setUp(self):
+    self.log = SwagLogger()
+    self.log.bind_global(dongle_id="0000", version=1)
+    self.formatter = SwagLogFileFormatter(self.log)
+
+  def _record(self, msg):
+    return self.log.makeRecord("swaglog", logging.INFO, __file__, 1, msg, (), None)
+
+  def test_matches_json_path(self):
+    for msg in PAYLOADS:
+      record_dict = self.formatter.format_dict(self._record(msg))
+
+      # records used to be sent as json and decoded before being formatted for the file
+      old = json.loads(self.formatter.format(json_robust_dumps(record_dict)))
+      new = json.loads(self.formatter.format_record_dict(record_dict))
+      del old["id"], new["id"]
+      self.assertEqual(json.dumps(new), json.dumps(old), msg)
+
+  def test_non_str_keys(self):
+    v = json.loads(self.formatter.format(self._record({"counts": {1: 2}})))
+    self.assertEqual(v["msg"], {"counts": {"1$i": 2}})
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -70,6 +70,7 @@ public:
   void UpdateCans(uint64_t sec, const capnp::DynamicStruct::Reader& cans);
   void UpdateValid(uint64_t sec);
   std::vector<SignalValue> query_latest();
+  std::vector<SignalValue> query_since(uint64_t sec);
 };
 
 class CANPacker {
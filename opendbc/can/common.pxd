@@ -75,9 +75,11 @@ cdef extern from "common.h":
 
   cdef cppclass CANParser:
     bool can_valid
+    uint64_t last_sec
     CANParser(int, string, vector[MessageParseOptions], vector[SignalParseOptions])
     void update_string(string, bool)
     vector[SignalValue] query_latest()
+    vector[SignalValue] query_since(uint64_t)
 
   cdef cppclass CANPacker:
    CANPacker(string)
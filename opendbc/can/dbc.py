@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
 import re
 import os
+import marshal
 import struct
 import sys
+import tempfile
 import numbers
 from collections import namedtuple, defaultdict
 
+import numpy as np
+
 def int_or_float(s):
   # return number, trying to maintain int format
   if s.isdigit():
@@ -18,14 +22,105 @@ DBCSignal = namedtuple(
   "DBCSignal", ["name", "start_bit", "size", "is_little_endian", "is_signed",
                 "factor", "offset", "tmin", "tmax", "units"])
 
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dbc_out")
+CACHE_VERSION = 1
+
+
+def get_cache_path(fn):
+  name, _ = os.path.splitext(os.path.basename(fn))
+  return os.path.join(CACHE_DIR, name + ".dbc.cache")
+
+
+def get_source_version(fn):
+  st = os.stat(fn)
+  return [CACHE_VERSION, os.path.abspath(fn), st.st_size, st.st_mtime_ns]
+
 
 class dbc():
-  def __init__(self, fn):
+  def __init__(self, fn, use_cache=True):
+    self.fn = fn
     self.name, _ = os.path.splitext(os.path.basename(fn))
-    with open(fn, encoding="ascii") as f:
-      self.txt = f.readlines()
+    self.use_cache = use_cache
+    self._msgs = None
+    self._txt = None
     self._warned_addresses = set()
 
+    # lookup to bit reverse each byte
+    self.bits_index = [(i & ~0b111) + ((-i - 1) & 0b111) for i in range(64)]
+
+  # the file is only parsed, or loaded from the cache, on first use
+  @property
+  def msgs(self):
+    if self._msgs is None:
+      self._load()
+    return self._msgs
+
+  @property
+  def def_vals(self):
+    if self._msgs is None:
+      self._load()
+    return self._def_vals
+
+  @property
+  def msg_name_to_address(self):
+    if self._msgs is None:
+      self._load()
+    return self._msg_name_to_address
+
+  @property
+  def txt(self):
+    if self._txt is None:
+      with open(self.fn, encoding="ascii") as f:
+        self._txt = f.readlines()
+    return self._txt
+
+  def _load(self):
+    # the cache is written by process_dbc at build time, never as a side effect of loading
+    if not (self.use_cache and self.load_cache(get_cache_path(self.fn))):
+      self._parse()
+
+    self._msg_name_to_address = {}
+    for address, m in self._msgs.items():
+      name = m[0][0]
+      self._msg_name_to_address[name] = address
+
+  def load_cache(self, path):
+    """Loads msgs and def_vals written by write_cache, if they're from the current dbc file."""
+    try:
+      with open(path, "rb") as f:
+        dat = marshal.loads(f.read())
+      if dat["source"] != get_source_version(self.fn):
+        return False
+    except (OSError, ValueError, EOFError, TypeError, KeyError):
+      return False
+
+    self._msgs = {address: ((name, size), [DBCSignal._make(sig) for sig in sigs])
+                  for address, name, size, sigs in dat["msgs"]}
+    self._def_vals = defaultdict(list)
+    for address, vals in dat["def_vals"]:
+      self._def_vals[address] = [tuple(v) for v in vals]
+    return True
+
+  def write_cache(self, path):
+    """Writes msgs and def_vals for load_cache, done by process_dbc at build time."""
+    dat = {
+      "source": get_source_version(self.fn),
+      "msgs": [(address, name, size, [tuple(sig) for sig in sigs]) for address, ((name, size), sigs) in self.msgs.items()],
+      "def_vals": [(address, vals) for address, vals in self.def_vals.items()],
+    }
+    # unique temp file, so parallel builds don't interleave their writes
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=os.path.basename(path), suffix=".tmp", delete=False) as f:
+      try:
+        marshal.dump(dat, f)
+        f.close()
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, path)
+      except BaseException:
+        os.remove(f.name)
+        raise
+
+  def _parse(self):
+
     # regexps from https://github.com/ebroecker/canmatrix/blob/master/canmatrix/importdbc.py
     bo_regexp = re.compile(r"^BO\_ (\w+) (\w+) *: (\w+) (\w+)")
     sg_regexp = re.compile(r"^SG\_ (\w+) : (\d+)\|(\d+)@(\d+)([\+|\-]) \(([0-9.+\-eE]+),([0-9.+\-eE]+)\) \[([0-9.+\-eE]+)\|([0-9.+\-eE]+)\] \"(.*)\" (.*)")
@@ -37,13 +132,10 @@ class dbc():
     #   size is the size of the message in bytes.
     #   signals is a list signals contained in the message.
     # signals is a list of DBCSignal in order of increasing start_bit.
-    self.msgs = {}
+    self._msgs = {}
 
     # A dictionary which maps message ids to a list of tuples (signal name, definition value pairs)
-    self.def_vals = defaultdict(list)
-
-    # lookup to bit reverse each byte
-    self.bits_index = [(i & ~0b111) + ((-i - 1) & 0b111) for i in range(64)]
+    self._def_vals = defaultdict(list)
 
     for l in self.txt:
       l = l.strip()
@@ -58,10 +150,10 @@ class dbc():
         name = dat.group(2)
         size = int(dat.group(3))
         ids = int(dat.group(1), 0)  # could be hex
-        if ids in self.msgs:
+        if ids in self._msgs:
           sys.exit("Duplicate address detected %d %s" % (ids, self.name))
 
-        self.msgs[ids] = ((name, size), [])
+        self._msgs[ids] = ((name, size), [])
 
       if l.startswith("SG_ "):
         # new signal
@@ -85,7 +177,7 @@ class dbc():
         tmax = int_or_float(dat.group(go + 9))
         units = dat.group(go + 10)
 
-        self.msgs[ids][1].append(
+        self._msgs[ids][1].append(
           DBCSignal(sgname, start_bit, signal_size, is_little_endian,
                     is_signed, factor, offset, tmin, tmax, units))
 
@@ -107,16 +199,11 @@ class dbc():
         defvals[1::2] = [d.strip().upper().replace(" ", "_") for d in defvals[1::2]]
         defvals = '"' + "".join(str(i) for i in defvals) + '"'
 
-        self.def_vals[ids].append((sgname, defvals))
+        self._def_vals[ids].append((sgname, defvals))
 
-    for msg in self.msgs.values():
+    for msg in self._msgs.values():
       msg[1].sort(key=lambda x: x.start_bit)
 
-    self.msg_name_to_address = {}
-    for address, m in self.msgs.items():
-      name = m[0][0]
-      self.msg_name_to_address[name] = address
-
   def lookup_msg_id(self, msg_id):
     if not isinstance(msg_id, numbers.Number):
       msg_id = self.msg_name_to_address[msg_id]
@@ -196,6 +283,7 @@ class dbc():
       out = {}
     else:
       out = [None] * len(arr)
+      arr_index = {sig: i for i, sig in enumerate(arr)}
 
     msg = self.msgs.get(x[0])
     if msg is None:
@@ -212,7 +300,7 @@ class dbc():
     le, be = None, None
 
     for s in msg[1]:
-      if arr is not None and s[0] not in arr:
+      if arr is not None and s[0] not in arr_index:
         continue
 
       start_bit = s[1]
@@ -249,9 +337,86 @@ class dbc():
       if arr is None:
         out[s[0]] = tmp
       else:
-        out[arr.index(s[0])] = tmp
+        out[arr_index[s[0]]] = tmp
     return name, out
 
+  def decode_bulk(self, addresses, times, data, arr=None):
+    """Decode many CAN messages at once, with vectorized bit extraction.
+
+       Inputs:
+        addresses: Array of N CAN addresses.
+        times: Array of N times, e.g. logMonoTime or bus time.
+        data: uint8 array of shape (N, 8) or (N, 64), shorter messages padded with zeros.
+        arr: Optional list of signals which should be decoded and returned.
+
+       Returns:
+        A dict mapping message name to (times, signals), where signals is a dict
+        of signal name to a float64 array of decoded values. Messages of unknown
+        addresses are skipped, as are signals that don't fit in data.
+    """
+    addresses = np.asarray(addresses)
+    times = np.asarray(times)
+    data = np.asarray(data, dtype=np.uint8)
+    if arr is not None:
+      arr = set(arr)
+
+    ret = {}
+    # group messages by address with one sort, instead of a mask per address
+    order = np.argsort(addresses, kind='stable')
+    sorted_addresses = addresses[order]
+    uniq, starts = np.unique(sorted_addresses, return_index=True)
+    ends = np.append(starts[1:], len(order))
+
+    for address, start, end in zip(uniq.tolist(), starts, ends):
+      msg = self.msgs.get(address)
+      if msg is None:
+        self._warned_addresses.add(address)
+        continue
+
+      idx = order[start:end]
+      dat = data[idx]
+      out = {}
+      for s in msg[1]:
+        if arr is not None and s.name not in arr:
+          continue
+        values = self._extract_bits(dat, s)
+        if values is not None:
+          out[s.name] = values
+      ret[msg[0][0]] = (times[idx], out)
+    return ret
+
+  def _extract_bits(self, dat, s):
+    # position of the signal's first bit, counting from the msb of byte 0 for big endian
+    if s.is_little_endian:
+      first = s.start_bit
+    else:
+      first = (s.start_bit // 8) * 8 + (-s.start_bit - 1) % 8
+    last = first + s.size
+    if last > dat.shape[1] * 8:
+      return None
+
+    # or in the bits from every byte the signal spans, at most 9
+    tmp = np.zeros(len(dat), dtype=np.uint64)
+    for byte in range(first // 8, (last - 1) // 8 + 1):
+      lo = max(first, byte * 8)
+      hi = min(last, byte * 8 + 8)
+      if s.is_little_endian:
+        chunk = dat[:, byte] >> np.uint8(lo - byte * 8)
+        shift = lo - first
+      else:
+        chunk = dat[:, byte] >> np.uint8(byte * 8 + 8 - hi)
+        shift = last - hi
+      chunk = chunk & np.uint8((1 << (hi - lo)) - 1)
+      tmp |= chunk.astype(np.uint64) << np.uint64(shift)
+
+    if s.is_signed:
+      if s.size == 64:
+        tmp = tmp.view(np.int64)
+      else:
+        sign = (tmp >> np.uint64(s.size - 1)).astype(np.int64)
+        tmp = tmp.astype(np.int64) - (sign << np.int64(s.size))
+    return tmp * s.factor + s.offset
+
   def get_signals(self, msg):
     msg = self.lookup_msg_id(msg)
     return [sgs.name for sgs in self.msgs[msg][1]]
@@ -300,3 +300,25 @@ std::vector<SignalValue> CANParser::query_latest() {
 
   return ret;
 }
+
+// values of all messages seen at or after sec, e.g. in a batch of update_string calls
+std::vector<SignalValue> CANParser::query_since(uint64_t sec) {
+  std::vector<SignalValue> ret;
+
+  for (const auto& kv : message_states) {
+    const auto& state = kv.second;
+    if (sec != 0 && state.seen < sec) continue;
+
+    for (int i=0; i<state.parse_sigs.size(); i++) {
+      const Signal &sig = state.parse_sigs[i];
+      ret.push_back((SignalValue){
+        .address = state.address,
+        .ts = state.ts,
+        .name = sig.name,
+        .value = state.vals[i],
+      });
+    }
+  }
+
+  return ret;
+}
@@ -1,11 +1,13 @@
 # distutils: language = c++
 # cython: c_string_encoding=ascii, language_level=3
 
+from cython.operator cimport dereference as deref
 from libcpp.string cimport string
 from libcpp.vector cimport vector
 from libcpp.unordered_set cimport unordered_set
-from libc.stdint cimport uint32_t, uint64_t, uint16_t
+from libc.stdint cimport uint32_t, uint64_t, uint16_t, uintptr_t
 from libcpp.map cimport map
+from libcpp.utility cimport pair
 from libcpp cimport bool
 
 from .common cimport CANParser as cpp_CANParser
@@ -15,6 +17,8 @@ import os
 import numbers
 from collections import defaultdict
 
+import numpy as np
+
 cdef int CAN_INVALID_CNT = 5
 
 cdef class CANParser:
@@ -25,6 +29,9 @@ cdef class CANParser:
     map[uint32_t, string] address_to_msg_name
     vector[SignalValue] can_values
     bool test_mode_enabled
+    # (address, DBC signal name pointer) -> index in values
+    map[pair[uint32_t, uintptr_t], int] value_index
+    double[::1] values_view
 
   cdef readonly:
     string dbc_name
@@ -32,8 +39,10 @@ cdef class CANParser:
     dict ts
     bool can_valid
     int can_invalid_cnt
+    object values
+    dict signal_ids
 
-  def __init__(self, dbc_name, signals, checks=None, bus=0, enforce_checks=True):
+  def __init__(self, dbc_name, signals, checks=None, bus=0, enforce_checks=True, signal_array=False):
     if checks is None:
       checks = []
     self.can_valid = True
@@ -100,22 +109,46 @@ cdef class CANParser:
       mpo.check_frequency = freq
       message_options_v.push_back(mpo)
 
+    self.signal_ids = {}
+    if signal_array:
+      self.init_values(signals)
+
     self.can = new cpp_CANParser(bus, dbc_name, message_options_v, signal_options_v)
-    self.update_vl()
+    self.update_valid()
+    self.update_vl(self.can.query_latest())
 
-  cdef unordered_set[uint32_t] update_vl(self):
-    cdef string sig_name
-    cdef unordered_set[uint32_t] updated_val
+  cdef init_values(self, signals):
+    defaults = []
+    for sig_name, sig_address, sig_default in signals:
+      key = (sig_address, sig_name)
+      if key not in self.signal_ids:
+        self.signal_ids[key] = len(defaults)
+        self.signal_ids[(self.address_to_msg_name[sig_address].decode('utf8'), sig_name)] = len(defaults)
+        defaults.append(sig_default)
+
+    cdef int i, j
+    for i in range(self.dbc[0].num_msgs):
+      msg = self.dbc[0].msgs[i]
+      for j in range(msg.num_sigs):
+        key = (msg.address, msg.sigs[j].name.decode('utf8'))
+        if key in self.signal_ids:
+          self.value_index[pair[uint32_t, uintptr_t](msg.address, <uintptr_t>msg.sigs[j].name)] = self.signal_ids[key]
 
-    can_values = self.can.query_latest()
-    valid = self.can.can_valid
+    self.values = np.array(defaults, dtype=np.float64)
+    self.values_view = self.values
 
+  cdef void update_valid(self):
     # Update invalid flag
     self.can_invalid_cnt += 1
-    if valid:
-        self.can_invalid_cnt = 0
+    if self.can.can_valid:
+      self.can_invalid_cnt = 0
     self.can_valid = self.can_invalid_cnt < CAN_INVALID_CNT
 
+  cdef unordered_set[uint32_t] update_vl(self, vector[SignalValue] can_values):
+    cdef unordered_set[uint32_t] updated_val
+    cdef map[pair[uint32_t, uintptr_t], int].iterator it
+    cdef bool use_values = self.values is not None
+
     for cv in can_values:
       # Cast char * directly to unicode
       name = <unicode>self.address_to_msg_name[cv.address].c_str()
@@ -127,22 +160,46 @@ cdef class CANParser:
       self.vl[name][cv_name] = cv.value
       self.ts[name][cv_name] = cv.ts
 
+      if use_values:
+        it = self.value_index.find(pair[uint32_t, uintptr_t](cv.address, <uintptr_t>cv.name))
+        if it != self.value_index.end():
+          self.values_view[deref(it).second] = cv.value
+
       updated_val.insert(cv.address)
 
     return updated_val
 
+  def signal_index(self, msg, sig_name):
+    """Index of a signal in values, for CANParsers made with signal_array=True.
+
+       Look it up once, then read cp.values[idx] every cycle instead of cp.vl[msg][sig_name].
+    """
+    return self.signal_ids[(msg, sig_name)]
+
   def update_string(self, dat, sendcan=False):
     self.can.update_string(dat, sendcan)
-    return self.update_vl()
+    self.update_valid()
+    return self.update_vl(self.can.query_latest())
 
   def update_strings(self, strings, sendcan=False):
-    updated_vals = set()
+    """Parses all strings, then updates vl and ts once with every message seen in them."""
+    cdef uint64_t first_sec = 0
+    cdef bool first = True
 
     for s in strings:
-      updated_val = self.update_string(s, sendcan)
-      updated_vals.update(updated_val)
+      self.can.update_string(s, sendcan)
+      if first:
+        first_sec = self.can.last_sec
+        first = False
+      # can_valid still counts every string, like separate update_string calls
+      self.update_valid()
+
+    if first:
+      return set()
+    return self.update_vl(self.can.query_since(first_sec))
 
-    return updated_vals
+# dbc name -> dv, so CANDefines for the same DBC only build it once per process
+cdef dict dv_cache = {}
 
 cdef class CANDefine():
   cdef:
@@ -158,6 +215,11 @@ cdef class CANDefine():
     if not self.dbc:
       raise RuntimeError(f"Can't find DBC: '{dbc_name}'")
 
+    if dbc_name not in dv_cache:
+      dv_cache[dbc_name] = self.build_dv()
+    self.dv = dv_cache[dbc_name]
+
+  cdef dict build_dv(self):
     num_vals = self.dbc[0].num_vals
 
     address_to_msg_name = {}
@@ -189,4 +251,4 @@ cdef class CANDefine():
       dv[address][sgname] = dict(zip(values, defs))
       dv[msgname][sgname] = dv[address][sgname]
 
-      self.dv = dict(dv)
+    return dict(dv)
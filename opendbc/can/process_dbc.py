@@ -6,7 +6,7 @@ import sys
 import jinja2
 
 from collections import Counter
-from opendbc.can.dbc import dbc
+from opendbc.can.dbc import dbc, get_cache_path
 
 def process(in_fn, out_fn):
   dbc_name = os.path.split(out_fn)[-1].replace('.cc', '')
@@ -17,7 +17,7 @@ def process(in_fn, out_fn):
   with open(template_fn, "r") as template_f:
     template = jinja2.Template(template_f.read(), trim_blocks=True, lstrip_blocks=True)
 
-  can_dbc = dbc(in_fn)
+  can_dbc = dbc(in_fn, use_cache=False)
 
   # process counter and checksums first
   msgs = [(address, msg_name, msg_size, sorted(msg_sigs, key=lambda s: s.name not in ("COUNTER", "CHECKSUM")))
@@ -113,6 +113,9 @@ def process(in_fn, out_fn):
       out_f.truncate()
       out_f.write(parser_code)
 
+  # parsed dbc for the python dbc class, so it doesn't have to parse the text again
+  can_dbc.write_cache(get_cache_path(in_fn))
+
 def main():
   if len(sys.argv) != 3:
     print("usage: %s dbc_directory output_filename" % (sys.argv[0],))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+import unittest
+
+from opendbc.can.packer import CANPacker
+from opendbc.can.parser import CANParser
+from selfdrive.boardd.boardd import can_list_to_can_capnp
+
+DBC = "toyota_nodsu_pt_generated"
+SIGNALS = [
+  ("STEER_ANGLE", "STEER_ANGLE_SENSOR", 0),
+  ("STEER_RATE", "STEER_ANGLE_SENSOR", 0),
+  ("BRAKE_AMOUNT", "BRAKE", 0),
+  ("BRAKE_PEDAL", "BRAKE", 0),
+]
+CHECKS = [("STEER_ANGLE_SENSOR", 0), ("BRAKE", 0)]
+
+
+def make_parser():
+  return CANParser(DBC, list(SIGNALS), list(CHECKS), 0, signal_array=True)
+
+
+class TestCANParser(unittest.TestCase):
+  def setUp(self):
+    packer = CANPacker(DBC)
+    self.batches = []
+    for i in range(3):
+      strings = []
+      for j in range(4):
+        msgs = [packer.make_can_msg("STEER_ANGLE_SENSOR", 0, {"STEER_ANGLE": 1.5 * (i * 4 + j), "STEER_RATE": -j})]
+        # BRAKE isn't in every string, nor in the last batch
+        if j % 2 == 0 and i < 2:
+          msgs.append(packer.make_can_msg("BRAKE", 0, {"BRAKE_AMOUNT": i * 4 + j, "BRAKE_PEDAL": 10 + j}))
+        # a message from another bus is ignored
+        msgs.append(packer.make_can_msg("BRAKE", 1, {"BRAKE_AMOUNT": 255}))
+        strings.append(can_list_to_can_capnp(msgs))
+      self.batches.append(strings)
+
+  def test_update_strings(self):
+    batched, single = make_parser(), make_parser()
+    for strings in self.batches + [[]]:
+      updated = batched.update_strings(strings)
+      expected = set()
+      for s in strings:
+        expected.update(single.update_string(s))
+
+      self.assertEqual(updated, expected)
+      self.assertEqual(batched.vl, single.vl)
+      self.assertEqual(batched.ts, single.ts)
+      self.assertEqual(batched.can_valid, single.can_valid)
+      self.assertEqual(list(batched.values), list(single.values))
+      for sig_name, msg, _ in SIGNALS:
+        self.assertEqual(batched.values[batched.signal_index(msg, sig_name)], single.vl[msg][sig_name])
+
+    self.assertEqual(batched.vl["BRAKE"]["BRAKE_AMOUNT"], 6)
+    self.assertEqual(batched.vl["STEER_ANGLE_SENSOR"]["STEER_ANGLE"], 1.5 * 11)
+
+  def test_signal_index(self):
+    cp = make_parser()
+    idx = cp.signal_index(37, "STEER_RATE")
+    self.assertEqual(cp.signal_index("STEER_ANGLE_SENSOR", "STEER_RATE"), idx)
+    self.assertEqual(cp.values[idx], 0)
+    with self.assertRaises(KeyError):
+      cp.signal_index("STEER_ANGLE_SENSOR", "STEER_FRACTION")
+
+
+if __name__ == "__main__":
+  unittest.main()
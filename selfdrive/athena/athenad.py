@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import base64
+import gzip
 import hashlib
 import io
 import json
@@ -28,8 +29,8 @@ from common.params import Params
 from common.realtime import sec_since_boot
 from selfdrive.hardware import HARDWARE, PC, TICI
 from selfdrive.loggerd.config import ROOT
-from selfdrive.loggerd.xattr_cache import getxattr, setxattr
-from selfdrive.swaglog import cloudlog, SWAGLOG_DIR
+from selfdrive.loggerd.xattr_cache import getxattr_many, setxattr
+from selfdrive.swaglog import cloudlog, SWAGLOG_DIR, COMPRESSED_EXT, get_log_size, open_log, read_manifest
 from selfdrive.version import version, get_version, get_git_remote, get_git_branch, get_git_commit
 
 ATHENA_HOST = os.getenv('ATHENA_HOST', 'wss://athena.comma.ai')
@@ -40,20 +41,221 @@ LOG_ATTR_NAME = 'user.upload'
 LOG_ATTR_VALUE_MAX_UNIX_TIME = int.to_bytes(2147483647, 4, sys.byteorder)
 RECONNECT_TIMEOUT_S = 70
 
+LOG_WINDOW = 4  # forwardLogs requests in flight
+LOG_BATCH_BYTES = 256 * 1024  # small log files are sent together, up to this size
+LOG_RESPONSE_TIMEOUT = 100  # seconds
+LOG_RESEND_DELAY = 3600  # seconds before a log without a successful response is sent again
+LOG_COMPRESSION = os.getenv("ATHENA_LOG_COMPRESSION")  # gzip, if the server accepts it
+
 RETRY_DELAY = 10  # seconds
 MAX_RETRY_COUNT = 30  # Try for at most 5 minutes if upload fails immediately
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', "2"))
+UPLOAD_QUEUE_PARAM = "AthenadUploadQueue"
+UPLOAD_PRIORITY = {"qlog.bz2": 0, "qcamera.ts": 0, "rlog.bz2": 1}  # everything else is 2
 WS_FRAME_SIZE = 4096
+MESSAGE_IDLE_TIMEOUT = 60  # seconds without a getMessage before a service's socket is closed
 
 dispatcher["echo"] = lambda s: s
 recv_queue: Any = queue.Queue()
 send_queue: Any = queue.Queue()
-upload_queue: Any = queue.Queue()
 log_send_queue: Any = queue.Queue()
 log_recv_queue: Any = queue.Queue()
-cancelled_uploads: Any = set()
-UploadItem = namedtuple('UploadItem', ['path', 'url', 'headers', 'created_at', 'id', 'retry_count', 'current', 'progress'], defaults=(0, False, 0))
+UploadItem = namedtuple('UploadItem', ['path', 'url', 'headers', 'created_at', 'id', 'retry_count', 'current', 'progress',
+                                       'priority', 'retry_at'], defaults=(0, False, 0, 2, 0))
+
+
+class UploadQueue():
+  """uploadFileToUrl requests, ordered by priority and then age.
+
+     Items stay in the queue while they upload, and every change is saved to
+     params so the queue survives a restart. Failed uploads wait out their
+     retry delay in the queue instead of in a worker.
+  """
+  def __init__(self):
+    self.params = None
+    self.cv = threading.Condition()
+    self.items = {}
+
+  def load(self, params):
+    self.params = params
+    try:
+      dat = json.loads(params.get(UPLOAD_QUEUE_PARAM) or "[]")
+      items = [UploadItem(**{k: v for k, v in d.items() if k in UploadItem._fields}) for d in dat]
+    except (ValueError, TypeError):
+      cloudlog.exception("athena.upload_queue.load_failed")
+      items = []
+
+    with self.cv:
+      # anything uploading when athenad stopped starts over
+      self.items = {i.id: i._replace(current=False, progress=0) for i in items}
+      self.cv.notify_all()
+
+  def _save(self):
+    if self.params is not None:
+      self.params.put(UPLOAD_QUEUE_PARAM, json.dumps([i._asdict() for i in self.items.values()]))
+
+  def put(self, item):
+    """Adds an item, or refreshes the url of a queued upload of the same file."""
+    with self.cv:
+      for i in self.items.values():
+        if i.path == item.path:
+          if not i.current:
+            i = i._replace(url=item.url, headers=item.headers)
+            self.items[i.id] = i
+            self._save()
+          return i
+
+      self.items[item.id] = item
+      self._save()
+      self.cv.notify()
+      return item
+
+  def get(self, timeout):
+    end = time.monotonic() + timeout
+    with self.cv:
+      while True:
+        now = time.time()
+        waiting = [i for i in self.items.values() if not i.current]
+        ready = [i for i in waiting if i.retry_at <= now]
+        if len(ready):
+          item = min(ready, key=lambda i: (i.priority, i.created_at))._replace(current=True)
+          self.items[item.id] = item
+          return item
+
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+          return None
+        next_retry = min((i.retry_at - now for i in waiting), default=remaining)
+        self.cv.wait(min(remaining, max(next_retry, 0.01)))
+
+  def update(self, item):
+    with self.cv:
+      if item.id in self.items:
+        self.items[item.id] = item
+
+  def done(self, item):
+    with self.cv:
+      self.items.pop(item.id, None)
+      self._save()
+
+  def retry(self, item):
+    with self.cv:
+      if item.id not in self.items:
+        return
+      self.items[item.id] = item._replace(retry_count=item.retry_count + 1, progress=0, current=False,
+                                          retry_at=time.time() + RETRY_DELAY)
+      self._save()
+      self.cv.notify()
+
+  def cancel(self, upload_id):
+    with self.cv:
+      item = self.items.get(upload_id)
+      if item is None or item.current:
+        return False
+      del self.items[upload_id]
+      self._save()
+      return True
+
+  def reset_current(self):
+    with self.cv:
+      self.items = {i.id: i._replace(current=False, progress=0) for i in self.items.values()}
+      self.cv.notify_all()
+
+  def list(self):
+    with self.cv:
+      return list(self.items.values())
+
+
+upload_queue = UploadQueue()
+
+
+class CachedService():
+  """A conflated socket and the last message read from it.
+
+     One thread at a time blocks on the socket, the others wait on cv for the
+     message it receives. Messages are as old as their logMonoTime, a conflated
+     socket keeps the last one after its publisher stopped.
+  """
+  def __init__(self, service):
+    self.cv = threading.Condition()
+    self.sock = messaging.sub_sock(service, conflate=True)
+    self.receiving = False
+    self.msg = None
+    self.msg_time = 0.
+    self.last_access = 0.
+
+  def _update(self, dat):
+    if dat is not None:
+      msg = messaging.log_from_bytes(dat)
+      self.msg_time = msg.logMonoTime / 1e9
+      self.msg = msg.to_dict()
+
+  def get(self, timeout):
+    end = sec_since_boot() + timeout / 1000.
+    with self.cv:
+      if not self.receiving:
+        self._update(self.sock.receive(non_blocking=True))
+
+      while True:
+        now = sec_since_boot()
+        if self.msg is not None and now - self.msg_time <= timeout / 1000.:
+          return self.msg
+        if now >= end:
+          raise TimeoutError
+        if self.receiving:
+          self.cv.wait(end - now)
+          continue
+
+        self.receiving = True
+        self.sock.setTimeout(max(int((end - now) * 1000), 1))
+        # don't hold the lock while blocked on the socket
+        self.cv.release()
+        dat = None
+        try:
+          dat = self.sock.receive()
+        finally:
+          self.cv.acquire()
+          self.receiving = False
+          self._update(dat)
+          self.cv.notify_all()
+
+  def close(self):
+    """Closes the socket unless a request is waiting on it, returns whether it was closed."""
+    with self.cv:
+      if self.receiving:
+        return False
+      self.sock.close()
+      return True
+
+
+class MessageCache():
+  """Long-lived conflated sockets with the latest message of each service asked for.
+
+     A snapshot younger than the request's timeout is served right away,
+     sockets that aren't asked for in MESSAGE_IDLE_TIMEOUT are closed.
+  """
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.services = {}
+
+  def _get_service(self, service):
+    now = sec_since_boot()
+    with self.lock:
+      for s, c in list(self.services.items()):
+        if s != service and now - c.last_access > MESSAGE_IDLE_TIMEOUT and c.close():
+          del self.services[s]
+
+      if service not in self.services:
+        self.services[service] = CachedService(service)
+      cached = self.services[service]
+      cached.last_access = now
+      return cached
 
-cur_upload_items = {}
+  def get(self, service, timeout):
+    return self._get_service(service).get(timeout)
+
+
+message_cache = MessageCache()
 
 
 def handle_long_poll(ws):
@@ -62,8 +264,10 @@ def handle_long_poll(ws):
   threads = [
     threading.Thread(target=ws_recv, args=(ws, end_event), name='ws_recv'),
     threading.Thread(target=ws_send, args=(ws, end_event), name='ws_send'),
-    threading.Thread(target=upload_handler, args=(end_event,), name='upload_handler'),
     threading.Thread(target=log_handler, args=(end_event,), name='log_handler'),
+  ] + [
+    threading.Thread(target=upload_handler, args=(end_event,), name=f'upload_handler_{x}')
+    for x in range(UPLOAD_WORKERS)
   ] + [
     threading.Thread(target=jsonrpc_handler, args=(end_event,), name=f'worker_{x}')
     for x in range(HANDLER_THREADS)
@@ -104,42 +308,29 @@ def jsonrpc_handler(end_event):
 
 
 def upload_handler(end_event):
-  tid = threading.get_ident()
-
   while not end_event.is_set():
-    cur_upload_items[tid] = None
-
     try:
-      cur_upload_items[tid] = upload_queue.get(timeout=1)._replace(current=True)
-      if cur_upload_items[tid].id in cancelled_uploads:
-        cancelled_uploads.remove(cur_upload_items[tid].id)
+      item = upload_queue.get(timeout=1)
+      if item is None:
         continue
 
       try:
         def cb(sz, cur):
-          cur_upload_items[tid] = cur_upload_items[tid]._replace(progress=cur / sz if sz else 1)
+          upload_queue.update(item._replace(progress=cur / sz if sz else 1))
 
-        _do_upload(cur_upload_items[tid], cb)
+        _do_upload(item, cb)
+        upload_queue.done(item)
       except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.SSLError) as e:
-        cloudlog.warning(f"athena.upload_handler.retry {e} {cur_upload_items[tid]}")
-
-        if cur_upload_items[tid].retry_count < MAX_RETRY_COUNT:
-          item = cur_upload_items[tid]
-          item = item._replace(
-            retry_count=item.retry_count + 1,
-            progress=0,
-            current=False
-          )
-          upload_queue.put_nowait(item)
-          cur_upload_items[tid] = None
-
-          for _ in range(RETRY_DELAY):
-            time.sleep(1)
-            if end_event.is_set():
-              break
+        cloudlog.warning(f"athena.upload_handler.retry {e} {item}")
+
+        if item.retry_count < MAX_RETRY_COUNT:
+          upload_queue.retry(item)
+        else:
+          upload_queue.done(item)
+      except Exception:
+        upload_queue.done(item)
+        raise
 
-    except queue.Empty:
-      pass
     except Exception:
       cloudlog.exception("athena.upload_handler.exception")
 
@@ -163,13 +354,23 @@ def getMessage(service=None, timeout=1000):
   if service is None or service not in service_list:
     raise Exception("invalid service")
 
-  socket = messaging.sub_sock(service, timeout=timeout)
-  ret = messaging.recv_one(socket)
+  return message_cache.get(service, timeout)
 
-  if ret is None:
-    raise TimeoutError
 
-  return ret.to_dict()
+@dispatcher.add_method
+def getMessages(services=None, timeout=1000):
+  """Latest message of several services, services without one within timeout are None."""
+  if services is None or not all(s in service_list for s in services):
+    raise Exception("invalid service")
+
+  end = sec_since_boot() + timeout / 1000.
+  ret = {}
+  for service in services:
+    try:
+      ret[service] = message_cache.get(service, max(int((end - sec_since_boot()) * 1000), 0))
+    except TimeoutError:
+      ret[service] = None
+  return ret
 
 
 @dispatcher.add_method
@@ -241,28 +442,27 @@ def uploadFileToUrl(fn, url, headers):
   if not os.path.exists(path):
     return 404
 
-  item = UploadItem(path=path, url=url, headers=headers, created_at=int(time.time() * 1000), id=None)
+  item = UploadItem(path=path, url=url, headers=headers, created_at=int(time.time() * 1000), id=None,
+                    priority=UPLOAD_PRIORITY.get(os.path.basename(path), 2))
   upload_id = hashlib.sha1(str(item).encode()).hexdigest()
   item = item._replace(id=upload_id)
 
-  upload_queue.put_nowait(item)
+  # a repeated request for the same file returns the queued item
+  item = upload_queue.put(item)
 
   return {"enqueued": 1, "item": item._asdict()}
 
 
 @dispatcher.add_method
 def listUploadQueue():
-  items = list(upload_queue.queue) + list(cur_upload_items.values())
-  return [i._asdict() for i in items if (i is not None) and (i.id not in cancelled_uploads)]
+  return [i._asdict() for i in upload_queue.list()]
 
 
 @dispatcher.add_method
 def cancelUpload(upload_id):
-  upload_ids = set(item.id for item in list(upload_queue.queue))
-  if upload_id not in upload_ids:
+  if not upload_queue.cancel(upload_id):
     return 404
 
-  cancelled_uploads.add(upload_id)
   return {"success": 1}
 
 
@@ -355,80 +555,180 @@ def takeSnapshot():
     raise Exception("not available while camerad is started")
 
 
-def get_logs_to_send_sorted():
-  # TODO: scan once then use inotify to detect file creation/deletion
+def get_log_time_sent(value):
+  try:
+    return int.from_bytes(value, sys.byteorder)
+  except (ValueError, TypeError):
+    return 0
+
+
+def get_log_names(log_dir):
+  files = read_manifest(log_dir)
+  if files is not None:
+    return {name for name, _ in files}
+  return {name for name in os.listdir(log_dir) if name.startswith("swaglog.") and not name.endswith(".tmp")}
+
+
+def set_log_attr(log_entry, value):
+  log_path = os.path.join(SWAGLOG_DIR, log_entry)
+  try:
+    setxattr(log_path, LOG_ATTR_NAME, value)
+  except FileNotFoundError:
+    # compressed since it was sent
+    setxattr(log_path + COMPRESSED_EXT, LOG_ATTR_NAME, value)
+
+
+class PendingLogs():
+  """Log files waiting to be forwarded.
+
+     The swaglog manifest is only read again when the directory's mtime
+     changes, and only new files get their xattr checked.
+  """
+  def __init__(self, log_dir):
+    self.log_dir = log_dir
+    self.dir_mtime = None
+    self.known = set()
+    self.pending = set()
+    # name -> time it can be sent again
+    self.retry = {}
+
+  def refresh(self):
+    curr_time = time.time()
+    for log_entry, t in list(self.retry.items()):
+      if t <= curr_time:
+        del self.retry[log_entry]
+        if log_entry in self.known:
+          self.pending.add(log_entry)
+
+    mtime = os.stat(self.log_dir).st_mtime
+    if mtime == self.dir_mtime:
+      return
+    self.dir_mtime = mtime
+
+    names = get_log_names(self.log_dir)
+    self.known &= names
+    self.pending &= names
+    for log_entry in list(self.retry):
+      if log_entry not in names:
+        del self.retry[log_entry]
+
+    new = [os.path.join(self.log_dir, name) for name in names - self.known]
+    for log_path, value in getxattr_many(new, LOG_ATTR_NAME).items():
+      log_entry = os.path.basename(log_path)
+      self.known.add(log_entry)
+      time_sent = get_log_time_sent(value)
+      if not time_sent or curr_time - time_sent > LOG_RESEND_DELAY:
+        self.pending.add(log_entry)
+      else:
+        self.retry[log_entry] = time_sent + LOG_RESEND_DELAY
+
+  def __len__(self):
+    return len(self.pending)
+
+  def pop_batch(self, max_bytes):
+    """Newest files first, small ones are combined into a batch of up to max_bytes."""
+    # excluding most recent (active) log file
+    active = max(self.known, default=None)
+    batch = []
+    size = 0
+    for log_entry in sorted(self.pending, reverse=True):
+      if log_entry == active:
+        continue
+      try:
+        sz = get_log_size(os.path.join(self.log_dir, log_entry))
+      except OSError:
+        self.pending.discard(log_entry)  # file could be deleted by log rotation
+        continue
+      if len(batch) and size + sz > max_bytes:
+        break
+      batch.append(log_entry)
+      size += sz
+
+    self.pending -= set(batch)
+    return batch
+
+  def retry_later(self, log_entries):
+    for log_entry in log_entries:
+      self.retry[log_entry] = time.time() + LOG_RESEND_DELAY
+
+
+def get_forward_logs_request(log_entries):
   curr_time = int(time.time())
   logs = []
-  for log_entry in os.listdir(SWAGLOG_DIR):
+  for log_entry in log_entries:
     log_path = os.path.join(SWAGLOG_DIR, log_entry)
     try:
-      time_sent = int.from_bytes(getxattr(log_path, LOG_ATTR_NAME), sys.byteorder)
-    except (ValueError, TypeError):
-      time_sent = 0
-    # assume send failed and we lost the response if sent more than one hour ago
-    if not time_sent or curr_time - time_sent > 3600:
-      logs.append(log_entry)
-  # excluding most recent (active) log file
-  return sorted(logs)[:-1]
+      set_log_attr(log_entry, int.to_bytes(curr_time, 4, sys.byteorder))
+      with open_log(log_path) as f:
+        logs.append(f.read())
+    except OSError:
+      pass  # file could be deleted by log rotation
+  if not len(logs):
+    return None
+
+  # swaglogs are one json object per line, so they can simply be concatenated
+  params = {"logs": "".join(log if log.endswith("\n") else log + "\n" for log in logs)}
+  if LOG_COMPRESSION == "gzip":
+    params = {"logs": base64.b64encode(gzip.compress(params["logs"].encode())).decode(), "compression": "gzip"}
+
+  return {
+    "method": "forwardLogs",
+    "params": params,
+    "jsonrpc": "2.0",
+    "id": log_entries[0] if len(log_entries) == 1 else f"{log_entries[0]}+{len(log_entries) - 1}",
+  }
 
 
 def log_handler(end_event):
   if PC:
     return
 
-  log_files = []
+  pending = PendingLogs(SWAGLOG_DIR)
+  in_flight = {}  # request id -> (log entries, time sent)
   last_scan = 0
   while not end_event.is_set():
     try:
       curr_scan = sec_since_boot()
       if curr_scan - last_scan > 10:
-        log_files = get_logs_to_send_sorted()
+        pending.refresh()
         last_scan = curr_scan
 
-      # send one log
-      curr_log = None
-      if len(log_files) > 0:
-        log_entry = log_files.pop() # newest log file
-        cloudlog.debug(f"athena.log_handler.forward_request {log_entry}")
-        try:
-          curr_time = int(time.time())
-          log_path = os.path.join(SWAGLOG_DIR, log_entry)
-          setxattr(log_path, LOG_ATTR_NAME, int.to_bytes(curr_time, 4, sys.byteorder))
-          with open(log_path, "r") as f:
-            jsonrpc = {
-              "method": "forwardLogs",
-              "params": {
-                "logs": f.read()
-              },
-              "jsonrpc": "2.0",
-              "id": log_entry
-            }
-            log_send_queue.put_nowait(json.dumps(jsonrpc))
-            curr_log = log_entry
-        except OSError:
-          pass  # file could be deleted by log rotation
-
-      # wait for response up to ~100 seconds
-      # always read queue at least once to process any old responses that arrive
-      for _ in range(100):
-        if end_event.is_set():
+      # keep a window of requests in flight
+      while len(in_flight) < LOG_WINDOW and len(pending):
+        log_entries = pending.pop_batch(LOG_BATCH_BYTES)
+        if not len(log_entries):
           break
-        try:
-          log_resp = json.loads(log_recv_queue.get(timeout=1))
-          log_entry = log_resp.get("id")
-          log_success = "result" in log_resp and log_resp["result"].get("success")
-          cloudlog.debug(f"athena.log_handler.forward_response {log_entry} {log_success}")
-          if log_entry and log_success:
-            log_path = os.path.join(SWAGLOG_DIR, log_entry)
+        jsonrpc = get_forward_logs_request(log_entries)
+        if jsonrpc is None:
+          continue
+        cloudlog.debug(f"athena.log_handler.forward_request {jsonrpc['id']}")
+        log_send_queue.put_nowait(json.dumps(jsonrpc))
+        in_flight[jsonrpc["id"]] = (log_entries, sec_since_boot())
+
+      # always read queue at least once to process any old responses that arrive
+      try:
+        log_resp = json.loads(log_recv_queue.get(timeout=1))
+        log_id = log_resp.get("id")
+        log_success = "result" in log_resp and log_resp["result"].get("success")
+        cloudlog.debug(f"athena.log_handler.forward_response {log_id} {log_success}")
+
+        # responses to requests from before a reconnect are for a single file
+        log_entries, _ = in_flight.pop(log_id, ([log_id] if log_id else [], 0))
+        if log_success:
+          for log_entry in log_entries:
             try:
-              setxattr(log_path, LOG_ATTR_NAME, LOG_ATTR_VALUE_MAX_UNIX_TIME)
+              set_log_attr(log_entry, LOG_ATTR_VALUE_MAX_UNIX_TIME)
             except OSError:
               pass  # file could be deleted by log rotation
-          if curr_log == log_entry:
-            break
-        except queue.Empty:
-          if curr_log is None:
-            break
+        else:
+          pending.retry_later(log_entries)
+      except queue.Empty:
+        pass
+
+      for log_id, (log_entries, t) in list(in_flight.items()):
+        if sec_since_boot() - t > LOG_RESPONSE_TIMEOUT:
+          del in_flight[log_id]
+          pending.retry_later(log_entries)
 
     except Exception:
       cloudlog.exception("athena.log_handler.exception")
@@ -544,6 +844,7 @@ def main():
 
   ws_uri = ATHENA_HOST + "/ws/v2/" + dongle_id
   api = Api(dongle_id)
+  upload_queue.load(params)
 
   conn_retries = 0
   while 1:
@@ -559,7 +860,7 @@ def main():
       manage_tokens(api)
 
       conn_retries = 0
-      cur_upload_items.clear()
+      upload_queue.reset_current()
 
       handle_long_poll(ws)
     except (KeyboardInterrupt, SystemExit):
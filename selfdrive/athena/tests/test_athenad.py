@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+import base64
+import gzip
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import cereal.messaging as messaging
+from common.xattr import setxattr
+from selfdrive.athena import athenad
+from selfdrive.athena.athenad import LOG_ATTR_NAME, LOG_ATTR_VALUE_MAX_UNIX_TIME, MessageCache, PendingLogs, UploadItem, UploadQueue
+
+
+class FakeParams(dict):
+  def get(self, key, encoding=None):
+    return super().get(key)
+
+  def put(self, key, dat):
+    self[key] = dat
+
+
+def sent_at(t):
+  return int.to_bytes(int(t), 4, sys.byteorder)
+
+
+def upload_item(path, priority=2, created_at=0, url="http://localhost/upload"):
+  return UploadItem(path=path, url=url, headers={}, created_at=created_at, id=f"{path}-{created_at}", priority=priority)
+
+
+class FakeSubSocket():
+  """Conflated socket fed by send(), that fails on concurrent receives."""
+  def __init__(self):
+    self.q = queue.Queue()
+    self.timeout = None
+    self.receiving = False
+    self.closed = False
+
+  def send(self, dat):
+    self.q.put(dat)
+
+  def setTimeout(self, timeout):
+    self.timeout = timeout
+
+  def receive(self, non_blocking=False):
+    assert not self.receiving and not self.closed
+    self.receiving = True
+    try:
+      dat = self.q.get(block=not non_blocking, timeout=None if non_blocking else self.timeout / 1000.)
+      while not self.q.empty():
+        dat = self.q.get()
+      return dat
+    except queue.Empty:
+      return None
+    finally:
+      self.receiving = False
+
+  def close(self):
+    self.closed = True
+
+
+class TestMessageCache(unittest.TestCase):
+  def setUp(self):
+    self.socks = {}
+    patcher = mock.patch.object(messaging, "sub_sock", lambda service, **kwargs: self.socks.setdefault(service, FakeSubSocket()))
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.cache = MessageCache()
+
+  def _send(self, service, delay=0.):
+    msg = messaging.new_message(service)
+    if delay:
+      threading.Timer(delay, self.socks[service].send, (msg.to_bytes(),)).start()
+    else:
+      self.socks[service].send(msg.to_bytes())
+    return msg.logMonoTime
+
+  def test_snapshot(self):
+    with self.assertRaises(TimeoutError):
+      self.cache.get("deviceState", 50)
+
+    t = self._send("deviceState")
+    self.assertEqual(self.cache.get("deviceState", 1000)["logMonoTime"], t)
+    # served from the snapshot, without waiting for a new message
+    start = time.monotonic()
+    self.assertEqual(self.cache.get("deviceState", 1000)["logMonoTime"], t)
+    self.assertLess(time.monotonic() - start, 0.5)
+
+    # the newest message wins over the snapshot
+    t = self._send("deviceState")
+    self.assertEqual(self.cache.get("deviceState", 1000)["logMonoTime"], t)
+
+  def test_stale_message(self):
+    with self.assertRaises(TimeoutError):
+      self.cache.get("deviceState", 10)
+
+    # left in the conflated socket by a publisher that stopped
+    msg = messaging.new_message("deviceState")
+    msg.logMonoTime -= int(10e9)
+    self.socks["deviceState"].send(msg.to_bytes())
+    with self.assertRaises(TimeoutError):
+      self.cache.get("deviceState", 100)
+    self.assertEqual(self.cache.get("deviceState", 20000)["logMonoTime"], msg.logMonoTime)
+
+    # a fresh one sent while waiting is served
+    t = self._send("deviceState", delay=0.2)
+    self.assertEqual(self.cache.get("deviceState", 1000)["logMonoTime"], t)
+
+  def test_concurrent_gets(self):
+    with self.assertRaises(TimeoutError):
+      self.cache.get("deviceState", 10)
+
+    results = []
+    def get(timeout):
+      try:
+        results.append((timeout, self.cache.get("deviceState", timeout)["logMonoTime"]))
+      except TimeoutError:
+        results.append((timeout, None))
+
+    threads = [threading.Thread(target=get, args=(timeout,)) for timeout in (5000, 5000, 100)]
+    start = time.monotonic()
+    for thread in threads:
+      thread.start()
+    t = self._send("deviceState", delay=0.5)
+    for thread in threads:
+      thread.join()
+
+    # the short request timed out on its own instead of queueing behind the others
+    self.assertIn((100, None), results)
+    self.assertEqual(results.count((5000, t)), 2)
+    self.assertLess(time.monotonic() - start, 2.)
+
+  def test_idle_sockets_closed(self):
+    with self.assertRaises(TimeoutError):
+      self.cache.get("deviceState", 10)
+    sock = self.socks["deviceState"]
+
+    with mock.patch.object(athenad, "MESSAGE_IDLE_TIMEOUT", -1):
+      with self.assertRaises(TimeoutError):
+        self.cache.get("carState", 10)
+    self.assertTrue(sock.closed)
+    self.assertNotIn("deviceState", self.cache.services)
+    self.assertFalse(self.socks["carState"].closed)
+
+
+class TestUploadQueue(unittest.TestCase):
+  def setUp(self):
+    self.params = FakeParams()
+    self.queue = UploadQueue()
+    self.queue.load(self.params)
+
+  def test_priority_order(self):
+    for path, priority, created_at in [("a/fcamera.hevc", 2, 0), ("b/qlog.bz2", 0, 2), ("a/rlog.bz2", 1, 1), ("a/qlog.bz2", 0, 1)]:
+      self.queue.put(upload_item(path, priority, created_at))
+
+    order = []
+    while (item := self.queue.get(timeout=0)) is not None:
+      self.assertTrue(item.current)
+      order.append(item.path)
+    self.assertEqual(order, ["a/qlog.bz2", "b/qlog.bz2", "a/rlog.bz2", "a/fcamera.hevc"])
+
+  def test_dedup(self):
+    first = self.queue.put(upload_item("a/qlog.bz2", url="http://localhost/old"))
+    item = self.queue.put(upload_item("a/qlog.bz2", created_at=1, url="http://localhost/new"))
+    self.assertEqual(item.id, first.id)
+    self.assertEqual(len(self.queue.list()), 1)
+    self.assertEqual(self.queue.list()[0].url, "http://localhost/new")
+
+    # an upload in progress isn't changed under the worker
+    current = self.queue.get(timeout=0)
+    item = self.queue.put(upload_item("a/qlog.bz2", created_at=2, url="http://localhost/newer"))
+    self.assertEqual(item.url, "http://localhost/new")
+    self.assertFalse(self.queue.cancel(current.id))
+
+  def test_retry(self):
+    self.queue.put(upload_item("a/qlog.bz2", priority=0))
+    self.queue.put(upload_item("a/rlog.bz2", priority=1))
+    failed = self.queue.get(timeout=0)
+    self.assertEqual(failed.path, "a/qlog.bz2")
+
+    # waits out its delay in the queue, behind lower priority uploads
+    self.queue.retry(failed)
+    self.assertEqual(self.queue.get(timeout=0).path, "a/rlog.bz2")
+    self.assertIsNone(self.queue.get(timeout=0))
+
+    with mock.patch.object(athenad, "RETRY_DELAY", 0):
+      self.queue.retry(self.queue.list()[0]._replace(current=True))
+    item = self.queue.get(timeout=0.1)
+    self.assertEqual(item.path, "a/qlog.bz2")
+    self.assertEqual(item.retry_count, 2)
+
+  def test_persistence(self):
+    self.queue.put(upload_item("a/qlog.bz2", priority=0))
+    self.queue.put(upload_item("a/rlog.bz2", priority=1))
+    current = self.queue.get(timeout=0)
+    self.queue.update(current._replace(progress=0.5))
+    self.queue.put(upload_item("a/fcamera.hevc"))
+    self.queue.done(self.queue.get(timeout=0))
+
+    # uploads in progress when athenad stopped start over
+    restarted = UploadQueue()
+    restarted.load(self.params)
+    items = {i.path: i for i in restarted.list()}
+    self.assertEqual(set(items), {"a/qlog.bz2", "a/fcamera.hevc"})
+    self.assertFalse(items["a/qlog.bz2"].current)
+    self.assertEqual(items["a/qlog.bz2"].progress, 0)
+    self.assertEqual(restarted.get(timeout=0).path, "a/qlog.bz2")
+
+    # a corrupt param doesn't keep athenad from starting
+    self.params[athenad.UPLOAD_QUEUE_PARAM] = "{"
+    restarted = UploadQueue()
+    restarted.load(self.params)
+    self.assertEqual(restarted.list(), [])
+
+
+class TestLogForwarding(unittest.TestCase):
+  def setUp(self):
+    self.log_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.log_dir)
+
+  def _make_log(self, idx, size=10, attr=None):
+    name = f"swaglog.{idx:010}"
+    path = os.path.join(self.log_dir, name)
+    with open(path, "w") as f:
+      f.write(("x" * (size - 1) + "\n") if size else "")
+    if attr is not None:
+      setxattr(path, LOG_ATTR_NAME, attr)
+    return name
+
+  def test_refresh(self):
+    unsent = self._make_log(0)
+    self._make_log(1, attr=LOG_ATTR_VALUE_MAX_UNIX_TIME)
+    recent = self._make_log(2, attr=sent_at(time.time()))
+    lost = self._make_log(3, attr=sent_at(time.time() - athenad.LOG_RESEND_DELAY - 1))
+
+    pending = PendingLogs(self.log_dir)
+    pending.refresh()
+    self.assertEqual(pending.pending, {unsent, lost})
+    self.assertIn(recent, pending.retry)
+
+    # new files are picked up, deleted ones dropped
+    os.remove(os.path.join(self.log_dir, unsent))
+    new = self._make_log(4)
+    os.utime(self.log_dir, (0, 0))
+    pending.refresh()
+    self.assertEqual(pending.pending, {lost, new})
+
+  def test_pop_batch(self):
+    names = [self._make_log(i, size=100) for i in range(6)]
+    pending = PendingLogs(self.log_dir)
+    pending.refresh()
+
+    # newest first, without the active log, up to max_bytes
+    self.assertEqual(pending.pop_batch(250), [names[4], names[3]])
+    self.assertEqual(pending.pop_batch(250), [names[2], names[1]])
+    # a file larger than max_bytes is still sent, on its own
+    self.assertEqual(pending.pop_batch(50), [names[0]])
+    self.assertEqual(pending.pop_batch(250), [])
+
+  def test_retry_later(self):
+    names = [self._make_log(i) for i in range(3)]
+    pending = PendingLogs(self.log_dir)
+    pending.refresh()
+    batch = pending.pop_batch(athenad.LOG_BATCH_BYTES)
+    self.assertEqual(batch, names[1::-1])
+
+    # only the active log is left
+    pending.retry_later(batch)
+    pending.refresh()
+    self.assertEqual(pending.pending, {names[2]})
+
+    with mock.patch.object(athenad, "LOG_RESEND_DELAY", 0):
+      pending.retry_later(batch)
+    pending.refresh()
+    self.assertEqual(pending.pending, set(names))
+
+  def test_forward_logs_request(self):
+    names = [self._make_log(i, size=10) for i in range(2)]
+    with mock.patch.object(athenad, "SWAGLOG_DIR", self.log_dir):
+      request = athenad.get_forward_logs_request(names)
+      self.assertEqual(request["id"], f"{names[0]}+1")
+      self.assertEqual(request["params"]["logs"], ("x" * 9 + "\n") * 2)
+
+      with mock.patch.object(athenad, "LOG_COMPRESSION", "gzip"):
+        request = athenad.get_forward_logs_request(names)
+      self.assertEqual(request["params"]["compression"], "gzip")
+      logs = gzip.decompress(base64.b64decode(request["params"]["logs"])).decode()
+      self.assertEqual(logs, ("x" * 9 + "\n") * 2)
+
+      # sent files are marked, so a restart doesn't send them again right away
+      pending = PendingLogs(self.log_dir)
+      pending.refresh()
+      self.assertEqual(len(pending), 0)
+
+      self.assertIsNone(athenad.get_forward_logs_request(["swaglog.0000000009"]))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -148,6 +148,9 @@ std::unordered_map<std::string, uint32_t> keys = {
     {"moneyPlane.settings.pandaModEnabled", PERSISTENT},
     {"moneyPlane.settings.tetherEnabled", PERSISTENT},
     {"moneyPlane.settings.onRoadUploadEnabled", PERSISTENT},
+    {"moneyPlane.settings.uploadCellDailyMB", PERSISTENT},
+    {"moneyPlane.settings.uploadTetherDailyMB", PERSISTENT},
+    {"moneyPlane.uploader.usage", PERSISTENT},
     {"moneyPlane.settings.opLong", PERSISTENT},
     {"moneyPlane.settings.mqtt.broker", PERSISTENT},
     {"moneyPlane.settings.mqtt.port", PERSISTENT},
@@ -158,6 +161,7 @@ std::unordered_map<std::string, uint32_t> keys = {
 
     {"AccessToken", CLEAR_ON_MANAGER_START | DONT_LOG},
     {"AthenadPid", PERSISTENT},
+    {"AthenadUploadQueue", PERSISTENT},
     {"BootedOnroad", CLEAR_ON_MANAGER_START | CLEAR_ON_IGNITION_OFF},
     {"CalibrationParams", PERSISTENT},
     {"CarBatteryCapacity", PERSISTENT},
@@ -12,6 +12,7 @@ from common.cached_params import CachedParams
 import cereal.messaging as messaging
 from selfdrive.config import Conversions as CV
 from selfdrive.swaglog import cloudlog
+from selfdrive.loop_latency import LoopLatency
 from selfdrive.boardd.boardd import can_list_to_can_capnp
 from selfdrive.car.car_helpers import get_car, get_startup_event, get_one_can
 from selfdrive.controls.lib.lane_planner import CAMERA_OFFSET
@@ -184,7 +185,10 @@ class Controls:
 
     # controlsd is driven by can recv, expected at 100Hz
     self.rk = Ratekeeper(100, print_delay_threshold=None)
-    self.prof = Profiler(False)  # off by default
+    self.prof = Profiler(False, latency=LoopLatency('controlsdLatency'))  # printing is off by default
+
+    # controlsState is reused every cycle, only changed fields are written
+    self.controls_state = messaging.MessageBuilder('controlsState')
 
   def update_events(self, CS):
     """Compute carEvents from carState"""
@@ -354,6 +358,8 @@ class Controls:
 
     # Update carState from CAN
     can_strs = messaging.drain_sock_raw(self.can_sock, wait_for_one=True)
+    # waiting for CAN sets the loop's pace, it isn't counted in the loop latency
+    self.prof.checkpoint("Wait", ignore=True)
     CS = self.CI.update(self.CC, can_strs)
 
     self.sm.update(0)
@@ -639,48 +645,50 @@ class Controls:
     curvature = -self.VM.calc_curvature(steer_angle_without_offset, CS.vEgo)
 
     # controlsState
-    dat = messaging.new_message('controlsState')
-    dat.valid = CS.canValid
-    controlsState = dat.controlsState
-    controlsState.alertText1 = self.AM.alert_text_1
-    controlsState.alertText2 = self.AM.alert_text_2
-    controlsState.alertSize = self.AM.alert_size
-    controlsState.alertStatus = self.AM.alert_status
-    controlsState.alertBlinkingRate = self.AM.alert_rate
-    controlsState.alertType = self.AM.alert_type
-    controlsState.alertSound = self.AM.audible_alert
-    controlsState.canMonoTimes = list(CS.canMonoTimes)
-    controlsState.longitudinalPlanMonoTime = self.sm.logMonoTime['longitudinalPlan']
-    controlsState.lateralPlanMonoTime = self.sm.logMonoTime['lateralPlan']
-    controlsState.enabled = self.enabled
-    controlsState.active = self.active
-    controlsState.curvature = curvature
-    controlsState.state = self.state
-    controlsState.engageable = not self.events.any(ET.NO_ENTRY)
-    controlsState.longControlState = self.LoC.long_control_state
-    controlsState.vPid = float(self.LoC.v_pid)
-    controlsState.vCruise = float(self.v_cruise_kph)
-    controlsState.upAccelCmd = float(self.LoC.pid.p)
-    controlsState.uiAccelCmd = float(self.LoC.pid.i)
-    controlsState.ufAccelCmd = float(self.LoC.pid.f)
-    controlsState.cumLagMs = -self.rk.remaining * 1000.
-    controlsState.startMonoTime = int(start_time * 1e9)
-    controlsState.forceDecel = bool(force_decel)
-    controlsState.canErrorCounter = self.can_error_counter
-
+    self.controls_state.update(
+      alertText1=self.AM.alert_text_1,
+      alertText2=self.AM.alert_text_2,
+      alertSize=self.AM.alert_size,
+      alertStatus=self.AM.alert_status,
+      alertBlinkingRate=self.AM.alert_rate,
+      alertType=self.AM.alert_type,
+      alertSound=self.AM.audible_alert,
+      canMonoTimes=list(CS.canMonoTimes),
+      longitudinalPlanMonoTime=self.sm.logMonoTime['longitudinalPlan'],
+      lateralPlanMonoTime=self.sm.logMonoTime['lateralPlan'],
+      enabled=self.enabled,
+      active=self.active,
+      curvature=curvature,
+      state=self.state,
+      engageable=not self.events.any(ET.NO_ENTRY),
+      longControlState=self.LoC.long_control_state,
+      vPid=float(self.LoC.v_pid),
+      vCruise=float(self.v_cruise_kph),
+      upAccelCmd=float(self.LoC.pid.p),
+      uiAccelCmd=float(self.LoC.pid.i),
+      ufAccelCmd=float(self.LoC.pid.f),
+      cumLagMs=-self.rk.remaining * 1000.,
+      startMonoTime=int(start_time * 1e9),
+      forceDecel=bool(force_decel),
+      canErrorCounter=self.can_error_counter,
+    )
+
+    # a new nested struct every cycle, so controlsState is compacted with a copy every cycle
+    lateralControlState = self.controls_state.init('lateralControlState')
     if self.joystick_mode:
-      controlsState.lateralControlState.debugState = lac_log
+      lateralControlState.debugState = lac_log
     elif self.CP.steerControlType == car.CarParams.SteerControlType.angle:
-      controlsState.lateralControlState.angleState = lac_log
+      lateralControlState.angleState = lac_log
     elif self.CP.lateralTuning.which() == 'pid':
-      controlsState.lateralControlState.pidState = lac_log
+      lateralControlState.pidState = lac_log
     elif self.CP.lateralTuning.which() == 'lqr':
-      controlsState.lateralControlState.lqrState = lac_log
+      lateralControlState.lqrState = lac_log
     elif self.CP.lateralTuning.which() == 'indi':
-      controlsState.lateralControlState.indiState = lac_log
-    self.pm.send('controlsState', dat)
+      lateralControlState.indiState = lac_log
+    self.pm.send('controlsState', self.controls_state.to_bytes(valid=CS.canValid))
 
-    # carState
+    # carState, carEvents and carControl are copied whole from structs made this cycle,
+    # so reusing their messages wouldn't save the allocation
     car_events = self.events.to_msg()
     cs_send = messaging.new_message('carState')
     cs_send.valid = CS.canValid
@@ -94,14 +94,21 @@ class Events:
       self.events.append(e.name.raw)
 
   def to_msg(self):
-    ret = []
-    for event_name in self.events:
-      event = car.CarEvent.new_message()
-      event.name = event_name
-      for event_type in EVENTS.get(event_name, {}).keys():
-        setattr(event, event_type, True)
-      ret.append(event)
-    return ret
+    return [get_event_msg(event_name) for event_name in self.events]
+
+
+# event name -> CarEvent, they never change and are copied into the message they're assigned to
+EVENT_MSGS = {}
+
+def get_event_msg(event_name):
+  event = EVENT_MSGS.get(event_name)
+  if event is None:
+    event = car.CarEvent.new_message()
+    event.name = event_name
+    for event_type in EVENTS.get(event_name, {}).keys():
+      setattr(event, event_type, True)
+    EVENT_MSGS[event_name] = event
+  return event
 
 
 class Alert:
@@ -6,6 +6,7 @@ from selfdrive.swaglog import cloudlog
 from selfdrive.controls.lib.longitudinal_planner import Planner
 from selfdrive.controls.lib.lateral_planner import LateralPlanner
 from selfdrive.hardware import TICI
+from selfdrive.loop_latency import LoopLatency
 import cereal.messaging as messaging
 
 
@@ -29,15 +30,21 @@ def plannerd_thread(sm=None, pm=None):
   if pm is None:
     pm = messaging.PubMaster(['longitudinalPlan', 'lateralPlan'])
 
+  latency = LoopLatency('plannerdLatency')
+
   while True:
     sm.update()
+    latency.checkpoint("Wait", ignore=True)
 
     if sm.updated['modelV2']:
       lateral_planner.update(sm, CP)
       lateral_planner.publish(sm, pm)
+      latency.checkpoint("Lateral planner")
     if sm.updated['radarState']:
       longitudinal_planner.update(sm, CP, lateral_planner)
       longitudinal_planner.publish(sm, pm)
+      latency.checkpoint("Longitudinal planner")
+    latency.end_loop()
 
 
 def main(sm=None, pm=None):
@@ -13,6 +13,7 @@ from selfdrive.controls.lib.cluster.fastcluster_py import cluster_points_centroi
 from selfdrive.controls.lib.radar_helpers import Cluster, Track
 from selfdrive.swaglog import cloudlog
 from selfdrive.hardware import TICI
+from selfdrive.loop_latency import LoopLatency
 
 
 class KalmanParams():
@@ -201,16 +202,22 @@ def radard_thread(sm=None, pm=None, can_sock=None):
   # TODO: always log leads once we can hide them conditionally
   enable_lead = CP.openpilotLongitudinalControl or not CP.radarOffCan
 
+  latency = LoopLatency('radardLatency')
+
   while 1:
     can_strings = messaging.drain_sock_raw(can_sock, wait_for_one=True)
+    latency.checkpoint("Wait", ignore=True)
     rr = RI.update(can_strings)
+    latency.checkpoint("Radar interface")
 
     if rr is None:
+      latency.end_loop()
       continue
 
     sm.update(0)
 
     dat = RD.update(sm, rr, enable_lead)
+    latency.checkpoint("Update")
     dat.radarState.cumLagMs = -rk.remaining*1000.
 
     pm.send('radarState', dat)
@@ -227,6 +234,8 @@ def radard_thread(sm=None, pm=None, can_sock=None):
         "vRel": float(tracks[ids].vRel),
       }
     pm.send('liveTracks', dat)
+    latency.checkpoint("Sent")
+    latency.end_loop()
 
     rk.monitor_time()
 
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import time
+
+import numpy as np
+
+from opendbc import DBC_PATH
+from opendbc.can.dbc import dbc
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Compare dbc.decode with dbc.decode_bulk on random frames")
+  parser.add_argument("--dbc", default="toyota_rav4_hybrid_2017_pt_generated")
+  parser.add_argument("--count", type=int, default=200000)
+  args = parser.parse_args()
+
+  db = dbc(os.path.join(DBC_PATH, args.dbc + ".dbc"))
+  rng = np.random.default_rng(0)
+  addresses = rng.choice(list(db.msgs.keys()), args.count)
+  times = np.arange(args.count, dtype=np.uint64)
+  data = rng.integers(0, 256, (args.count, 8), dtype=np.uint8)
+
+  t = time.monotonic()
+  frames = [(a, t, d.tobytes()) for a, t, d in zip(addresses.tolist(), times.tolist(), data)]
+  scalar = [db.decode(f) for f in frames]
+  scalar_time = time.monotonic() - t
+
+  t = time.monotonic()
+  bulk = db.decode_bulk(addresses, times, data)
+  bulk_time = time.monotonic() - t
+
+  # check against the scalar decoder
+  seen = {}
+  for name, out in scalar:
+    i = seen.get(name, 0)
+    seen[name] = i + 1
+    for sig, value in out.items():
+      assert np.isclose(bulk[name][1][sig][i], value), (name, sig, i)
+
+  print(f"decode:      {scalar_time:.2f}s, {args.count / scalar_time:.0f} frames/s")
+  print(f"decode_bulk: {bulk_time:.2f}s, {args.count / bulk_time:.0f} frames/s, {scalar_time / bulk_time:.0f}x")
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+import time
+
+from opendbc import DBC_PATH
+from opendbc.can.dbc import dbc
+
+
+def load_text(paths):
+  t = time.monotonic()
+  for path in paths:
+    dbc(path, use_cache=False).msgs
+  return time.monotonic() - t
+
+
+def load_cache(paths, cache_dir):
+  t = time.monotonic()
+  for path in paths:
+    assert dbc(path, use_cache=False).load_cache(os.path.join(cache_dir, os.path.basename(path)))
+  return time.monotonic() - t
+
+
+if __name__ == "__main__":
+  paths = sorted(os.path.join(DBC_PATH, fn) for fn in os.listdir(DBC_PATH) if fn.endswith(".dbc"))
+
+  # caches in a temp dir, so the ones from the build in dbc_out aren't touched
+  with tempfile.TemporaryDirectory() as cache_dir:
+    for path in paths:
+      dbc(path, use_cache=False).write_cache(os.path.join(cache_dir, os.path.basename(path)))
+
+    text_time = load_text(paths)
+    cache_time = load_cache(paths, cache_dir)
+  print(f"{len(paths)} DBCs")
+  print(f"text:  {text_time * 1000:.0f} ms")
+  print(f"cache: {cache_time * 1000:.0f} ms, {text_time / cache_time:.1f}x")
+
+  try:
+    from opendbc.can.can_define import CANDefine
+  except ImportError:
+    print("CANDefine not built, skipping")
+  else:
+    for i in range(2):
+      t = time.monotonic()
+      for path in paths:
+        CANDefine(os.path.basename(path)[:-len(".dbc")])
+      print(f"CANDefine {'first' if i == 0 else 'again'}: {(time.monotonic() - t) * 1000:.0f} ms")
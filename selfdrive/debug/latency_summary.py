@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+import argparse
+from collections import defaultdict
+
+from tqdm import tqdm
+
+from selfdrive.loop_latency import percentile
+from tools.lib.route import Route
+from tools.lib.logreader import LogReader
+
+SERVICES = ['controlsdLatency', 'plannerdLatency', 'radardLatency']
+
+
+class Section():
+  def __init__(self, num_buckets):
+    self.counts = [0] * num_buckets
+    self.count = 0
+    self.sum_ms = 0.
+    self.max_ms = 0.
+
+  def add(self, s):
+    for i, c in enumerate(s.counts):
+      self.counts[i] += c
+    self.count += s.count
+    self.sum_ms += s.sumMs
+    self.max_ms = max(self.max_ms, s.maxMs)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Loop latency percentiles per process and section from a route")
+  parser.add_argument("route")
+  parser.add_argument("--qlog", action="store_true", help="use qlogs instead of rlogs")
+  args = parser.parse_args()
+
+  r = Route(args.route)
+  paths = r.qlog_paths() if args.qlog else r.log_paths()
+
+  bounds = {}
+  sections = defaultdict(dict)
+  for path in tqdm(paths):
+    if path is None:
+      continue
+    for msg in LogReader(path):
+      service = msg.which()
+      if service not in SERVICES:
+        continue
+
+      dat = getattr(msg, service)
+      bounds[service] = list(dat.bucketBoundsMs)
+      for s in dat.sections:
+        if s.name not in sections[service]:
+          sections[service][s.name] = Section(len(s.counts))
+        sections[service][s.name].add(s)
+
+  for service in SERVICES:
+    if service not in sections:
+      continue
+    print(f"\n{service.replace('Latency', '')}")
+    print(f"{'section':>25} {'count':>9} {'mean':>8} {'p50':>8} {'p99':>8} {'p999':>8} {'max':>8}  (ms)")
+    for name, s in sorted(sections[service].items(), key=lambda x: x[0] != "loop"):
+      p50, p99, p999 = (percentile(s.counts, q, bounds[service], s.max_ms) for q in (50, 99, 99.9))
+      mean = s.sum_ms / s.count if s.count else 0.
+      print(f"{name:>25} {s.count:>9} {mean:8.2f} {p50:8.2f} {p99:8.2f} {p999:8.2f} {s.max_ms:8.2f}")
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+import argparse
+
+import cereal.messaging as messaging
+from cereal import car, log
+from common.profiler import Profiler
+from selfdrive.controls.lib.events import Events, EVENTS
+
+State = log.ControlsState.OpenpilotState
+
+
+def get_car_state(i):
+  CS = car.CarState.new_message()
+  CS.vEgo = 20. + i % 10
+  CS.steeringAngleDeg = 1.5
+  CS.canMonoTimes = [i * 10_000_000 + j for j in range(3)]
+  CS.canValid = True
+  return CS
+
+
+def get_lac_log(i):
+  lac_log = log.ControlsState.LateralPIDState.new_message()
+  lac_log.active = True
+  lac_log.steeringAngleDeg = 1.5
+  lac_log.output = 0.1 * (i % 10)
+  return lac_log
+
+
+def fields(i, CS, events):
+  return dict(
+    alertText1="", alertText2="", alertSize=0, alertStatus=0, alertBlinkingRate=0.,
+    alertType="", alertSound=0, canMonoTimes=list(CS.canMonoTimes),
+    longitudinalPlanMonoTime=i * 50_000_000, lateralPlanMonoTime=i * 50_000_000,
+    enabled=True, active=True, curvature=0.001 * (i % 10), state=State.enabled,
+    engageable=True, longControlState=1, vPid=20., vCruise=60., upAccelCmd=0.1 * (i % 3),
+    uiAccelCmd=0.2, ufAccelCmd=0., cumLagMs=-2., startMonoTime=i * 10_000_000,
+    forceDecel=False, canErrorCounter=0,
+  )
+
+
+def publish_new_message(i, CS, events, lac_log):
+  """publish_logs before MessageBuilder and cached CarEvents."""
+  dat = messaging.new_message('controlsState')
+  dat.valid = CS.canValid
+  controlsState = dat.controlsState
+  for k, v in fields(i, CS, events).items():
+    setattr(controlsState, k, v)
+  controlsState.lateralControlState.pidState = lac_log
+  dat.to_bytes()
+
+  car_events = []
+  for event_name in events.names:
+    event = car.CarEvent.new_message()
+    event.name = event_name
+    for event_type in EVENTS.get(event_name, {}).keys():
+      setattr(event, event_type, True)
+    car_events.append(event)
+  cs_send = messaging.new_message('carState')
+  cs_send.carState = CS
+  cs_send.carState.events = car_events
+  cs_send.to_bytes()
+
+
+def publish_builder(builder, i, CS, events, lac_log):
+  builder.update(**fields(i, CS, events))
+  builder.init('lateralControlState').pidState = lac_log
+  builder.to_bytes(valid=CS.canValid)
+
+  cs_send = messaging.new_message('carState')
+  cs_send.carState = CS
+  cs_send.carState.events = events.to_msg()
+  cs_send.to_bytes()
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Time building controlsd's per cycle messages")
+  parser.add_argument("--count", type=int, default=10000)
+  args = parser.parse_args()
+
+  events = Events()
+  for name in list(EVENTS.keys())[:3]:
+    events.add(name)
+  builder = messaging.MessageBuilder('controlsState')
+
+  prof = Profiler(True)
+  for i in range(args.count):
+    CS, lac_log = get_car_state(i), get_lac_log(i)
+    prof.checkpoint("Inputs", ignore=True)
+    publish_new_message(i, CS, events, lac_log)
+    prof.checkpoint("new_message")
+    publish_builder(builder, i, CS, events, lac_log)
+    prof.checkpoint("MessageBuilder")
+  prof.display()
@@ -17,8 +17,8 @@ if __name__ == "__main__":
   cfg = [c for c in CONFIGS if c.proc_name == args.process][0]
 
   route = Route(args.route)
-  lr = MultiLogIterator(route.log_paths(), wraparound=False)
-  inputs = list(lr)
+  with MultiLogIterator(route.log_paths(), wraparound=False, prefetch=2) as lr:
+    inputs = list(lr)
 
   outputs = replay_process(cfg, inputs)
 
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import time
+import uuid
+from multiprocessing import Process
+
+from selfdrive import logmessaged
+from selfdrive.swaglog import cloudlog, SWAGLOG_DIR, open_log
+
+
+def count_records(marker, since):
+  count = 0
+  for fn in os.listdir(SWAGLOG_DIR):
+    path = os.path.join(SWAGLOG_DIR, fn)
+    if not fn.startswith("swaglog.") or fn.endswith(".tmp") or os.path.getmtime(path) < since:
+      continue
+    try:
+      with open_log(path) as f:
+        count += sum(marker in line for line in f)
+    except OSError:
+      pass  # compressed while counting
+  return count
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Records per second through cloudlog -> logmessaged -> disk")
+  parser.add_argument("--count", type=int, default=100000)
+  parser.add_argument("--event", action="store_true", help="log events with a dict, instead of plain messages")
+  args = parser.parse_args()
+
+  proc = Process(target=logmessaged.main, daemon=True)
+  proc.start()
+  time.sleep(1)
+
+  marker = uuid.uuid4().hex
+  start = time.time()
+  t = time.monotonic()
+  for i in range(args.count):
+    if args.event:
+      cloudlog.event("benchmark", marker=marker, i=i, value=i * 0.5, ok=True)
+    else:
+      cloudlog.info(f"benchmark {marker} {i}")
+  send_time = time.monotonic() - t
+
+  # wait for logmessaged to catch up
+  written, last = 0, -1
+  while written != last:
+    time.sleep(0.5)
+    last, written = written, count_records(marker, start)
+  total_time = time.monotonic() - t - 0.5
+
+  proc.terminate()
+  print(f"sent {args.count} records in {send_time:.2f}s, {args.count / send_time:.0f} records/s")
+  print(f"wrote {written} records ({args.count - written} dropped) in {total_time:.2f}s, {written / total_time:.0f} records/s")
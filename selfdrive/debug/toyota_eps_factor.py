@@ -59,6 +59,6 @@ def get_eps_factor(lr, plot=False):
 
 if __name__ == "__main__":
   r = Route(sys.argv[1])
-  lr = MultiLogIterator(r.log_paths(), wraparound=False)
-  n = get_eps_factor(lr, plot="--plot" in sys.argv)
+  with MultiLogIterator(r.log_paths(), wraparound=False, prefetch=2, services=['can']) as lr:
+    n = get_eps_factor(lr, plot="--plot" in sys.argv)
   print("EPS torque factor: ", n)
@@ -1,37 +1,200 @@
 #!/usr/bin/env python3
 import os
+import queue
 import shutil
 import threading
+from selfdrive.loggerd.xattr_cache import getxattr, getxattr_many
 from selfdrive.swaglog import cloudlog
 from selfdrive.loggerd.config import ROOT, get_available_bytes, get_available_percent
-from selfdrive.loggerd.uploader import listdir_by_creation
+from selfdrive.loggerd.upload_index import UPLOAD_ATTR_NAME, get_directory_sort
 
 MIN_BYTES = 5 * 1024 * 1024 * 1024
 MIN_PERCENT = 10
+# free a bit more than needed, so deletes don't happen on every check
+EXTRA_BYTES = 512 * 1024 * 1024
 
 DELETE_LAST = ['boot', 'crash']
 
 
-def deleter_thread(exit_event):
-  while not exit_event.is_set():
-    out_of_bytes = get_available_bytes(default=MIN_BYTES + 1) < MIN_BYTES
-    out_of_percent = get_available_percent(default=MIN_PERCENT + 1) < MIN_PERCENT
+def trash_path(root):
+  # outside ROOT, so the uploader never sees half deleted segments
+  return root.rstrip("/") + "_trash"
+
+
+def get_bytes_needed():
+  available_bytes = get_available_bytes(default=MIN_BYTES + 1)
+  available_percent = get_available_percent(default=MIN_PERCENT + 1)
+
+  needed = MIN_BYTES - available_bytes
+  if 0 < available_percent < MIN_PERCENT:
+    needed = max(needed, (MIN_PERCENT - available_percent) * available_bytes / available_percent)
+  return needed + EXTRA_BYTES if needed > 0 else 0
+
+
+class SegmentInfo():
+  def __init__(self, size, uploaded, mtime):
+    self.size = size
+    self.uploaded = uploaded
+    self.mtime = mtime
+
+
+class SegmentIndex():
+  """Size and upload state of every finished directory under root.
+
+     Directories are walked once they're finished, and again when their mtime
+     changes, e.g. files were added after a crash. Upload state is re-read
+     from the uploader's xattrs until everything is uploaded.
+  """
+  def __init__(self, root):
+    self.root = root
+    self.root_mtime = None
+    self.segments = {}
+    # directories that aren't finished yet
+    self.pending = set()
+
+  def _scan(self, logname):
+    path = os.path.join(self.root, logname)
+    try:
+      mtime = os.stat(path).st_mtime
+      names = os.listdir(path)
+      if any(name.endswith(".lock") for name in names):
+        return None
+
+      size = 0
+      uploaded = True
+      for name in names:
+        fn = os.path.join(path, name)
+        size += os.path.getsize(fn)
+        uploaded = uploaded and getxattr(fn, UPLOAD_ATTR_NAME) is not None
+    except OSError:
+      return None
+    return SegmentInfo(size, uploaded, mtime)
+
+  def _update_upload_state(self, logname, info):
+    path = os.path.join(self.root, logname)
+    try:
+      values = getxattr_many([os.path.join(path, name) for name in os.listdir(path)], UPLOAD_ATTR_NAME)
+      info.uploaded = all(v is not None for v in values.values())
+    except OSError:
+      pass
+
+  def refresh(self):
+    try:
+      root_mtime = os.stat(self.root).st_mtime
+    except OSError:
+      return
+
+    if root_mtime != self.root_mtime:
+      self.root_mtime = root_mtime
+      try:
+        lognames = set(os.listdir(self.root))
+      except OSError:
+        cloudlog.exception("deleter listdir failed")
+        return
+      for logname in set(self.segments) - lognames:
+        del self.segments[logname]
+      self.pending = lognames - set(self.segments)
 
-    if out_of_percent or out_of_bytes:
-      # remove the earliest directory we can
-      dirs = sorted(listdir_by_creation(ROOT), key=lambda x: x in DELETE_LAST)
-      for delete_dir in dirs:
-        delete_path = os.path.join(ROOT, delete_dir)
+    for logname, info in self.segments.items():
+      try:
+        if os.stat(os.path.join(self.root, logname)).st_mtime != info.mtime:
+          self.pending.add(logname)
+      except OSError:
+        self.pending.add(logname)
 
-        if any(name.endswith(".lock") for name in os.listdir(delete_path)):
-          continue
+    # directories that are still being written are picked up on a later refresh
+    for logname in list(self.pending):
+      info = self._scan(logname)
+      if info is not None:
+        self.segments[logname] = info
+        self.pending.discard(logname)
+      else:
+        self.segments.pop(logname, None)
+
+  def remove(self, logname):
+    self.segments.pop(logname, None)
+
+  def eviction_order(self):
+    """Uploaded segments first, then the rest, then boot and crash. Oldest first within each."""
+    for logname, info in self.segments.items():
+      if not info.uploaded:
+        self._update_upload_state(logname, info)
+
+    def key(logname):
+      info = self.segments[logname]
+      return (logname in DELETE_LAST, not info.uploaded, get_directory_sort(logname))
+    return sorted(self.segments, key=key)
+
+  def select(self, needed):
+    """Returns the directories to delete to free at least needed bytes."""
+    ret = []
+    for logname in self.eviction_order():
+      if needed <= 0:
+        break
+      ret.append(logname)
+      needed -= self.segments[logname].size
+    return ret
+
+
+class Trash():
+  """Deletes directories in a background thread, after moving them out of root."""
+  def __init__(self, root):
+    self.path = trash_path(root)
+    os.makedirs(self.path, exist_ok=True)
+    self.queue = queue.Queue()
+    self.lock = threading.Lock()
+    self.pending_bytes = 0
+
+    # left over from the last run
+    for name in os.listdir(self.path):
+      self.queue.put((os.path.join(self.path, name), 0))
+
+    self.thread = threading.Thread(target=self._delete_thread, daemon=True)
+    self.thread.start()
+
+  def put(self, path, size):
+    dest = os.path.join(self.path, os.path.basename(path))
+    if os.path.exists(dest):
+      shutil.rmtree(dest, ignore_errors=True)
+    os.rename(path, dest)
+    with self.lock:
+      self.pending_bytes += size
+    self.queue.put((dest, size))
+
+  def _delete_thread(self):
+    while True:
+      path, size = self.queue.get()
+      try:
+        # one file at a time, so no single call holds the filesystem for long
+        for dirpath, _, fnames in os.walk(path, topdown=False):
+          for fname in fnames:
+            os.unlink(os.path.join(dirpath, fname))
+          os.rmdir(dirpath)
+      except OSError:
+        cloudlog.exception("issue deleting %s" % path)
+        shutil.rmtree(path, ignore_errors=True)
+      with self.lock:
+        self.pending_bytes -= size
+
+
+def deleter_thread(exit_event):
+  index = SegmentIndex(ROOT)
+  trash = Trash(ROOT)
+
+  while not exit_event.is_set():
+    with trash.lock:
+      needed = get_bytes_needed() - trash.pending_bytes
 
+    if needed > 0:
+      index.refresh()
+      for logname in index.select(needed):
+        delete_path = os.path.join(ROOT, logname)
         try:
           cloudlog.info("deleting %s" % delete_path)
-          shutil.rmtree(delete_path)
-          break
+          trash.put(delete_path, index.segments[logname].size)
         except OSError:
           cloudlog.exception("issue deleting %s" % delete_path)
+        index.remove(logname)
       exit_event.wait(.1)
     else:
       exit_event.wait(30)
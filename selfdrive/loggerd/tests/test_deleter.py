@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from common.xattr import setxattr
+from selfdrive.loggerd import deleter
+from selfdrive.loggerd.deleter import EXTRA_BYTES, MIN_BYTES, SegmentIndex, Trash, get_bytes_needed
+from selfdrive.loggerd.upload_index import UPLOAD_ATTR_NAME
+
+
+class TestDeleter(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.root = os.path.join(self.tmpdir, "realdata")
+    os.mkdir(self.root)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _make_segment(self, seg, size=1000, uploaded=False, lock=False):
+    logname = f"2021-01-01--00-00-00--{seg}"
+    path = os.path.join(self.root, logname)
+    os.mkdir(path)
+    for name in ["rlog.bz2", "qlog.bz2"] + (["rlog.bz2.lock"] if lock else []):
+      fn = os.path.join(path, name)
+      with open(fn, "wb") as f:
+        f.write(b"a" * (size // 2))
+      if uploaded:
+        setxattr(fn, UPLOAD_ATTR_NAME, b'1')
+    return logname
+
+  def test_eviction_order(self):
+    not_uploaded = self._make_segment(1)
+    uploaded = [self._make_segment(i, uploaded=True) for i in (2, 3)]
+    self._make_segment(4, lock=True)
+
+    index = SegmentIndex(self.root)
+    index.refresh()
+    self.assertEqual(index.eviction_order(), uploaded + [not_uploaded])
+
+    # just enough to free the bytes needed
+    self.assertEqual(index.select(1500), uploaded)
+
+    # upload state is picked up after the first scan
+    for name in os.listdir(os.path.join(self.root, not_uploaded)):
+      setxattr(os.path.join(self.root, not_uploaded, name), UPLOAD_ATTR_NAME, b'1')
+    self.assertEqual(index.select(500), [not_uploaded])
+
+  def test_size_refreshed(self):
+    logname = self._make_segment(0)
+    index = SegmentIndex(self.root)
+    index.refresh()
+    self.assertEqual(index.segments[logname].size, 1000)
+
+    # e.g. a file written after a reboot
+    with open(os.path.join(self.root, logname, "crash"), "wb") as f:
+      f.write(b"a" * 500)
+    os.utime(os.path.join(self.root, logname), (0, 0))
+    index.refresh()
+    self.assertEqual(index.segments[logname].size, 1500)
+
+  def test_bytes_needed(self):
+    gb = 1024 * 1024 * 1024
+    for available_bytes, available_percent, needed in [(20 * gb, 50., 0),
+                                                        (4 * gb, 50., MIN_BYTES - 4 * gb + EXTRA_BYTES),
+                                                        (8 * gb, 8., 2 * gb + EXTRA_BYTES),
+                                                        (None, None, 0)]:
+      with mock.patch.object(deleter, "get_available_bytes", lambda default: default if available_bytes is None else available_bytes), \
+           mock.patch.object(deleter, "get_available_percent", lambda default: default if available_percent is None else available_percent):
+        self.assertAlmostEqual(get_bytes_needed(), needed)
+
+  def test_trash(self):
+    logname = self._make_segment(0)
+    trash = Trash(self.root)
+    trash.put(os.path.join(self.root, logname), 1000)
+    self.assertFalse(os.path.exists(os.path.join(self.root, logname)))
+
+    for _ in range(100):
+      if trash.pending_bytes == 0:
+        break
+      time.sleep(0.01)
+    self.assertEqual(os.listdir(trash.path), [])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from common.xattr import setxattr
+from selfdrive.loggerd.upload_index import UPLOAD_ATTR_NAME, UploadIndex
+
+IMMEDIATE_PRIORITY = {"qlog.bz2": 0, "qcamera.ts": 1}
+HIGH_PRIORITY = {"rlog.bz2": 0, "fcamera.hevc": 1, "dcamera.hevc": 2, "ecamera.hevc": 3}
+IMMEDIATE_FOLDERS = ["crash/", "boot/"]
+
+
+class TestUploadIndex(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.root = os.path.join(self.tmpdir, "realdata")
+    os.mkdir(self.root)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _index(self):
+    return UploadIndex(self.root, IMMEDIATE_PRIORITY, HIGH_PRIORITY, IMMEDIATE_FOLDERS)
+
+  def _make_segment(self, seg, names, lock=False):
+    path = os.path.join(self.root, f"2021-01-01--00-00-00--{seg}")
+    os.makedirs(path, exist_ok=True)
+    for name in names + (["rlog.bz2.lock"] if lock else []):
+      with open(os.path.join(path, name), "wb") as f:
+        f.write(b"a" * 10)
+    return path
+
+  def _drain(self, index, with_raw):
+    keys = []
+    while (d := index.next_file(with_raw)) is not None:
+      keys.append(d[1])
+      index.mark_uploaded(d[1])
+    return keys
+
+  def test_order(self):
+    for seg in (10, 2):
+      self._make_segment(seg, ["fcamera.hevc", "rlog.bz2", "qlog.bz2", "other"])
+    index = self._index()
+    index.refresh()
+    self.assertEqual(index.immediate_count, 2)
+    self.assertEqual(index.raw_count, 6)
+
+    seg = "2021-01-01--00-00-00--"
+    self.assertEqual(self._drain(index, False), [seg + "2/qlog.bz2", seg + "10/qlog.bz2"])
+    self.assertEqual(self._drain(index, True), [seg + "2/rlog.bz2", seg + "2/fcamera.hevc",
+                                                 seg + "10/rlog.bz2", seg + "10/fcamera.hevc",
+                                                 seg + "2/other", seg + "10/other"])
+    self.assertEqual(index.raw_count, 0)
+    self.assertEqual(index.raw_size, 0)
+
+  def test_locked_and_new_segments(self):
+    path = self._make_segment(0, ["qlog.bz2"], lock=True)
+    index = self._index()
+    index.refresh()
+    self.assertIsNone(index.next_file(True))
+
+    os.unlink(os.path.join(path, "rlog.bz2.lock"))
+    index.refresh()
+    self.assertEqual(len(self._drain(index, True)), 1)
+
+    self._make_segment(1, ["qlog.bz2"])
+    index.refresh()
+    self.assertEqual(len(self._drain(index, True)), 1)
+
+  def test_files_added_to_indexed_dirs(self):
+    crash = os.path.join(self.root, "crash")
+    os.mkdir(crash)
+    path = self._make_segment(0, [])
+    index = self._index()
+    index.refresh()
+    self.assertIsNone(index.next_file(True))
+
+    with open(os.path.join(crash, "tombstone_0"), "wb") as f:
+      f.write(b"a" * 10)
+    self._make_segment(0, ["qlog.bz2", "rlog.bz2"])
+    index.refresh()
+    self.assertEqual(self._drain(index, True), ["crash/tombstone_0", os.path.join(os.path.basename(path), "qlog.bz2"),
+                                                os.path.join(os.path.basename(path), "rlog.bz2")])
+
+    # uploaded files aren't picked up again when another one shows up
+    with open(os.path.join(crash, "tombstone_1"), "wb") as f:
+      f.write(b"a" * 10)
+    index.refresh()
+    self.assertEqual(self._drain(index, True), ["crash/tombstone_1"])
+
+  def test_settled_dirs_not_checked(self):
+    os.mkdir(os.path.join(self.root, "crash"))
+    old = self._make_segment(0, ["qlog.bz2"])
+    os.utime(old, (0, 0))
+    new = self._make_segment(1, ["qlog.bz2"])
+    index = self._index()
+    index.refresh()
+    self.assertEqual(index.changing, {"crash", os.path.basename(new)})
+
+    # settles once it hasn't changed for SETTLE_TIME
+    os.utime(new, (0, 0))
+    self._make_segment(1, ["rlog.bz2"])
+    os.utime(new, (1, 1))
+    index.refresh()
+    self.assertIn(os.path.join(os.path.basename(new), "rlog.bz2"), self._drain(index, True))
+    index.refresh()
+    self.assertEqual(index.changing, {"crash"})
+
+  def test_rescan_no_duplicates(self):
+    path = self._make_segment(0, ["qlog.bz2", "rlog.bz2"])
+    index = self._index()
+    index.refresh()
+    now = time.time()
+    for i in range(5):
+      self._make_segment(0, [f"other{i}"])
+      os.utime(path, (now + i, now + i))
+      index.refresh()
+    self.assertEqual(len(index.immediate_heap) + len(index.raw_heap), 7)
+    self.assertEqual((index.immediate_count, index.raw_count), (1, 6))
+    self.assertEqual(len(self._drain(index, True)), 7)
+
+  def test_persistence(self):
+    path = self._make_segment(0, ["qlog.bz2", "rlog.bz2"])
+    setxattr(os.path.join(path, "rlog.bz2"), UPLOAD_ATTR_NAME, b'1')
+    index = self._index()
+    index.refresh()
+    index.save()
+
+    index = self._index()
+    self.assertEqual(len(index.dirs), 1)
+    self.assertEqual(self._drain(index, True), [os.path.join(os.path.basename(path), "qlog.bz2")])
+
+  def test_deleted_files(self):
+    path = self._make_segment(0, ["qlog.bz2"])
+    index = self._index()
+    index.refresh()
+    shutil.rmtree(path)
+    self.assertIsNone(index.next_file(True))
+    self.assertEqual(index.immediate_count, 0)
+
+
+if __name__ == "__main__":
+  unittest.main()
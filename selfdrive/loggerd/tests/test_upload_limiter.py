@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+import threading
+import time
+import unittest
+
+from cereal import log
+from selfdrive.loggerd.upload_limiter import LINK_RATES, TokenBucket, UploadLimiter
+
+NetworkType = log.DeviceState.NetworkType
+
+
+class FakeParams(dict):
+  def get(self, key, encoding=None):
+    return super().get(key)
+
+  def put(self, key, dat):
+    self[key] = dat
+
+
+def device_state(cpu=10, thermal_status='green'):
+  msg = log.DeviceState.new_message()
+  msg.cpuUsagePercent = [cpu]
+  msg.thermalStatus = thermal_status
+  return msg.as_reader()
+
+
+class TestUploadLimiter(unittest.TestCase):
+  def setUp(self):
+    self.params = FakeParams({"moneyPlane.settings.uploadCellDailyMB": "1"})
+
+  def test_token_bucket(self):
+    bucket = TokenBucket(1000)
+    self.assertAlmostEqual(bucket.consume(1000), 1.0, delta=0.05)
+    self.assertAlmostEqual(bucket.consume(500), 1.5, delta=0.05)
+    bucket.set_rate(None)
+    self.assertEqual(bucket.consume(1e9), 0)
+
+  def test_links(self):
+    limiter = UploadLimiter(self.params)
+    limiter.update(NetworkType.wifi, True, True, device_state())
+    self.assertFalse(limiter.metered)
+    self.assertIsNone(limiter.bucket.rate)
+
+    # phone hotspot on the road
+    limiter.update(NetworkType.wifi, False, True, device_state())
+    self.assertEqual(limiter.link, "tether")
+    limiter.update(NetworkType.cell4G, False, True, device_state())
+    self.assertEqual(limiter.bucket.rate, LINK_RATES["cell"])
+
+  def test_load_throttling(self):
+    limiter = UploadLimiter(self.params)
+    limiter.update(NetworkType.cell4G, False, True, device_state(cpu=95))
+    self.assertEqual(limiter.bucket.rate, LINK_RATES["cell"] / 2)
+    limiter.update(NetworkType.cell4G, False, True, device_state(thermal_status='red'))
+    self.assertFalse(limiter.allowed())
+    self.assertEqual(limiter.bucket.rate, 0)
+
+  def test_paused_exit(self):
+    exit_event = threading.Event()
+    limiter = UploadLimiter(self.params, exit_event)
+    limiter.update(NetworkType.cell4G, False, True, device_state(thermal_status='red'))
+
+    threading.Timer(0.2, exit_event.set).start()
+    t = time.monotonic()
+    limiter.throttle(1000)
+    self.assertLess(time.monotonic() - t, 2.)
+
+  def test_daily_budget(self):
+    limiter = UploadLimiter(self.params)
+    limiter.update(NetworkType.cell4G, False, True, device_state())
+    limiter.bucket.set_rate(None)
+    limiter.throttle(int(1e6))
+    self.assertFalse(limiter.allowed())
+
+    # still used up after a restart, but not on wifi
+    limiter.save(force=True)
+    limiter = UploadLimiter(self.params)
+    limiter.update(NetworkType.cell4G, False, True, device_state())
+    self.assertFalse(limiter.allowed())
+    limiter.update(NetworkType.wifi, True, True, device_state())
+    self.assertTrue(limiter.allowed())
+
+
+if __name__ == "__main__":
+  unittest.main()
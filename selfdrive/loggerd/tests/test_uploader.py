@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+from selfdrive.loggerd.uploader import upload_blocks, get_upload_progress
+
+
+class BlobHandler(BaseHTTPRequestHandler):
+  """Minimal stand-in for a block blob store."""
+  blocks = {}
+  blobs = {}
+  fail_after = None
+
+  def do_PUT(self):
+    url = urlparse(self.path)
+    query = parse_qs(url.query)
+    dat = self.rfile.read(int(self.headers['Content-Length']))
+
+    comp = query.get('comp', [None])[0]
+    if comp == 'block':
+      if self.fail_after is not None and len(self.blocks) >= self.fail_after:
+        self.send_response(500)
+        self.end_headers()
+        return
+      self.blocks[query['blockid'][0]] = dat
+    elif comp == 'blocklist':
+      ids = [x.split('</Latest>')[0] for x in dat.decode().split('<Latest>')[1:]]
+      self.blobs[url.path] = b"".join(self.blocks[i] for i in ids)
+    else:
+      self.blobs[url.path] = dat
+    self.send_response(201)
+    self.end_headers()
+
+  def log_message(self, *args):
+    pass
+
+
+class TestUploader(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    BlobHandler.blocks = {}
+    BlobHandler.blobs = {}
+    BlobHandler.fail_after = None
+    self.server = HTTPServer(('127.0.0.1', 0), BlobHandler)
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    self.url = f"http://127.0.0.1:{self.server.server_port}/seg/fcamera.hevc?sig=abc"
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.tmpdir)
+
+  def test_resumed_upload(self):
+    fn = os.path.join(self.tmpdir, "fcamera.hevc")
+    dat = os.urandom(10 * 1000 + 123)
+    with open(fn, "wb") as f:
+      f.write(dat)
+
+    session = requests.Session()
+    headers = {'x-ms-blob-type': 'BlockBlob'}
+
+    # connection drops after the third block
+    BlobHandler.fail_after = 3
+    resp = upload_blocks(session, fn, self.url, headers, chunk_size=1000)
+    self.assertEqual(resp.status_code, 500)
+    self.assertEqual(get_upload_progress(fn, 1000), 3)
+
+    sent = []
+    BlobHandler.fail_after = None
+    resp = upload_blocks(session, fn, self.url, headers, chunk_size=1000, on_sent=sent.append)
+    self.assertEqual(resp.status_code, 201)
+    self.assertEqual(sum(sent), len(dat) - 3000)
+    self.assertEqual(BlobHandler.blobs["/seg/fcamera.hevc"], dat)
+
+
+if __name__ == "__main__":
+  unittest.main()
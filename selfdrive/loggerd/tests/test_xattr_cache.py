@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import unittest
+
+from common.xattr import setxattr as setxattr_uncached
+import selfdrive.loggerd.xattr_cache as xattr_cache
+
+ATTR = 'user.upload'
+
+
+class TestXattrCache(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    xattr_cache.cached_attributes.clear()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def _touch(self, name):
+    fn = os.path.join(self.tmpdir, name)
+    with open(fn, "wb"):
+      pass
+    return fn
+
+  def test_invalidation(self):
+    fn = self._touch("a")
+    self.assertIsNone(xattr_cache.getxattr(fn, ATTR))
+
+    # set by another process
+    setxattr_uncached(fn, ATTR, b'1')
+    self.assertEqual(xattr_cache.getxattr(fn, ATTR), b'1')
+
+    # deleted and recreated
+    os.unlink(fn)
+    with self.assertRaises(OSError):
+      xattr_cache.getxattr(fn, ATTR)
+    self._touch("a")
+    self.assertIsNone(xattr_cache.getxattr(fn, ATTR))
+
+  def test_bounded(self):
+    fns = [self._touch(str(i)) for i in range(20)]
+    orig = xattr_cache.MAX_ENTRIES
+    try:
+      xattr_cache.MAX_ENTRIES = 10
+      values = xattr_cache.getxattr_many(fns + [os.path.join(self.tmpdir, "missing")], ATTR)
+    finally:
+      xattr_cache.MAX_ENTRIES = orig
+    self.assertEqual(set(values.keys()), set(fns))
+    self.assertEqual(len(xattr_cache.cached_attributes), 10)
+    self.assertIn((fns[-1], ATTR), xattr_cache.cached_attributes)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,266 @@
+import heapq
+import json
+import os
+import time
+
+from common.file_helpers import atomic_write_in_dir
+from selfdrive.loggerd.xattr_cache import getxattr_many
+from selfdrive.swaglog import cloudlog
+
+UPLOAD_ATTR_NAME = 'user.upload'
+INDEX_VERSION = 1
+SAVE_INTERVAL = 60.
+# directories changed more recently than this are checked for new files on every refresh
+SETTLE_TIME = 60.
+
+
+def get_directory_sort(d):
+  return list(map(lambda s: s.rjust(10, '0'), d.rsplit('--', 1)))
+
+
+def upload_index_path(root):
+  # next to ROOT rather than in it, the deleter expects only segment directories there
+  return root.rstrip("/") + "_upload_index.json"
+
+
+class UploadIndex():
+  """Files under root that still need uploading, kept in upload order.
+
+     Segment directories are listed when they show up, while they are still being
+     written (they contain a .lock file), and when their mtime changes. Only the
+     immediate folders, e.g. crash/ and boot/, and directories changed in the last
+     SETTLE_TIME seconds have their mtime checked on every refresh. Only new files
+     have their xattrs read, and picking the next file is O(log n). The index is
+     saved to disk, so a restart doesn't need to check the xattrs of every file.
+  """
+  def __init__(self, root, immediate_priority, high_priority, immediate_folders, path=None):
+    self.root = root
+    self.path = upload_index_path(root) if path is None else path
+    self.immediate_priority = immediate_priority
+    self.high_priority = high_priority
+    self.immediate_folders = immediate_folders
+
+    # logname -> {"mtime": float, "files": {name: [size, uploaded]}}
+    self.dirs = {}
+    # directories that have to be listed again on the next refresh
+    self.unsettled = set()
+    # directories that may still get new files
+    self.changing = set()
+    self.root_mtime = None
+
+    self.immediate_heap = []
+    self.raw_heap = []
+
+    self.raw_size = 0
+    self.raw_count = 0
+    self.immediate_size = 0
+    self.immediate_count = 0
+
+    self.dirty = False
+    self.last_save = 0.
+    self.load()
+
+  def get_upload_sort(self, name):
+    if name in self.immediate_priority:
+      return self.immediate_priority[name]
+    if name in self.high_priority:
+      return self.high_priority[name] + 100
+    return 1000
+
+  def is_immediate(self, logname, name):
+    return name in self.immediate_priority or any(logname + "/" == f for f in self.immediate_folders)
+
+  def _count(self, name, size, sign):
+    if name in self.immediate_priority:
+      self.immediate_count += sign
+      self.immediate_size += sign * size
+    else:
+      self.raw_count += sign
+      self.raw_size += sign * size
+
+  def _push(self, logname, name):
+    order = (get_directory_sort(logname), self.get_upload_sort(name), name)
+    if self.is_immediate(logname, name):
+      heapq.heappush(self.immediate_heap, (order, logname))
+    else:
+      heapq.heappush(self.raw_heap, (name not in self.high_priority, order, logname))
+
+  def _watch(self, logname, mtime):
+    if logname + "/" in self.immediate_folders or time.time() - mtime < SETTLE_TIME:
+      self.changing.add(logname)
+    else:
+      self.changing.discard(logname)
+
+  def _add_files(self, logname, files):
+    for name, (size, uploaded) in files.items():
+      self.dirs[logname]["files"][name] = [size, uploaded]
+      if not uploaded:
+        self._count(name, size, 1)
+        self._push(logname, name)
+
+  def _add_dir(self, logname, files, mtime):
+    self.dirs[logname] = {"mtime": mtime, "files": {}}
+    self._add_files(logname, files)
+    self._watch(logname, mtime)
+
+  def _remove_dir(self, logname):
+    d = self.dirs.pop(logname, None)
+    if d is not None:
+      for name, (size, uploaded) in d["files"].items():
+        if not uploaded:
+          self._count(name, size, -1)
+    self.unsettled.discard(logname)
+    self.changing.discard(logname)
+    self.dirty = True
+
+  def _scan_dir(self, logname):
+    path = os.path.join(self.root, logname)
+    try:
+      mtime = os.stat(path).st_mtime
+      names = os.listdir(path)
+    except OSError:
+      self._remove_dir(logname)
+      return
+
+    # still being written, check again later
+    if any(name.endswith(".lock") for name in names):
+      self.unsettled.add(logname)
+      return
+
+    if logname not in self.dirs:
+      self._add_dir(logname, {}, mtime)
+    d = self.dirs[logname]
+    d["mtime"] = mtime
+    self._watch(logname, mtime)
+    self.dirty = True
+
+    # files that are already indexed keep their heap entries, only new ones are pushed
+    names = set(names)
+    for name in [name for name in d["files"] if name not in names]:
+      size, uploaded = d["files"].pop(name)
+      if not uploaded:
+        self._count(name, size, -1)
+
+    new = [os.path.join(path, name) for name in names if name not in d["files"] and not name.endswith(".tmp")]
+    files = {}
+    for fn, value in getxattr_many(new, UPLOAD_ATTR_NAME).items():
+      try:
+        files[os.path.basename(fn)] = (os.path.getsize(fn), value is not None)
+      except OSError:
+        # deleter could have deleted
+        pass
+    self._add_files(logname, files)
+
+  def refresh(self):
+    """Picks up new and removed segment directories, and new files in known ones."""
+    try:
+      root_mtime = os.stat(self.root).st_mtime
+    except OSError:
+      return
+
+    if root_mtime != self.root_mtime:
+      self.root_mtime = root_mtime
+      try:
+        lognames = set(os.listdir(self.root))
+      except OSError:
+        cloudlog.exception("upload index listdir failed")
+        return
+
+      for logname in set(self.dirs) - lognames:
+        self._remove_dir(logname)
+      self.unsettled &= lognames
+      self.unsettled |= lognames - set(self.dirs)
+
+    # files added to directories that are already indexed only change their mtime
+    for logname in list(self.changing - self.unsettled):
+      try:
+        mtime = os.stat(os.path.join(self.root, logname)).st_mtime
+      except OSError:
+        self.unsettled.add(logname)
+        continue
+      if mtime != self.dirs[logname]["mtime"]:
+        self.unsettled.add(logname)
+      else:
+        self._watch(logname, mtime)
+
+    for logname in sorted(self.unsettled, key=get_directory_sort):
+      self.unsettled.discard(logname)
+      self._scan_dir(logname)
+
+    if self.dirty and time.monotonic() - self.last_save > SAVE_INTERVAL:
+      self.save()
+
+  def _entry(self, logname, name):
+    d = self.dirs.get(logname)
+    if d is None or name not in d["files"]:
+      return None
+    return d["files"][name]
+
+  def _peek(self, heap, skip):
+    skipped = []
+    ret = None
+    while len(heap):
+      logname, name = heap[0][-1], heap[0][-2][-1]
+      key = os.path.join(logname, name)
+      entry = self._entry(logname, name)
+      fn = os.path.join(self.root, logname, name)
+      if entry is not None and not entry[1]:
+        if key in skip:
+          skipped.append(heapq.heappop(heap))
+          continue
+        if os.path.exists(fn):
+          ret = (name, key, fn)
+          break
+        # removed by someone else
+        self._count(name, entry[0], -1)
+        del self.dirs[logname]["files"][name]
+        self.dirty = True
+      heapq.heappop(heap)
+
+    for item in skipped:
+      heapq.heappush(heap, item)
+    return ret
+
+  def next_file(self, with_raw, skip=()):
+    """Returns (name, key, fn) of the next file to upload that isn't in skip, or None."""
+    ret = self._peek(self.immediate_heap, skip)
+    if ret is None and with_raw:
+      ret = self._peek(self.raw_heap, skip)
+    return ret
+
+  def mark_uploaded(self, key):
+    logname, name = os.path.split(key)
+    entry = self._entry(logname, name)
+    if entry is not None and not entry[1]:
+      entry[1] = True
+      self._count(name, entry[0], -1)
+      self.dirty = True
+
+  def load(self):
+    try:
+      with open(self.path) as f:
+        dat = json.load(f)
+      if dat["version"] != INDEX_VERSION:
+        return
+    except (OSError, ValueError, KeyError):
+      return
+
+    for logname, d in dat["dirs"].items():
+      try:
+        mtime = os.stat(os.path.join(self.root, logname)).st_mtime
+      except OSError:
+        continue
+      if mtime == d["mtime"]:
+        self._add_dir(logname, d["files"], mtime)
+      else:
+        self.unsettled.add(logname)
+
+  def save(self):
+    dat = {"version": INDEX_VERSION, "dirs": self.dirs}
+    try:
+      with atomic_write_in_dir(self.path, overwrite=True) as f:
+        json.dump(dat, f)
+    except OSError:
+      cloudlog.exception("upload index save failed")
+    self.dirty = False
+    self.last_save = time.monotonic()
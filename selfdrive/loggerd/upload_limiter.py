@@ -0,0 +1,156 @@
+import datetime
+import json
+import threading
+import time
+
+from cereal import log
+
+NetworkType = log.DeviceState.NetworkType
+ThermalStatus = log.DeviceState.ThermalStatus
+
+USAGE_PARAM = "moneyPlane.uploader.usage"
+
+# bytes/s, None is unlimited
+LINK_RATES = {
+  "wifi": None,
+  "tether": 256 * 1024,
+  "cell": 128 * 1024,
+}
+# daily caps in MB, from params
+LINK_BUDGET_PARAMS = {
+  "tether": "moneyPlane.settings.uploadTetherDailyMB",
+  "cell": "moneyPlane.settings.uploadCellDailyMB",
+}
+
+HIGH_CPU_PERCENT = 80
+SAVE_INTERVAL = 10.
+
+
+class TokenBucket():
+  def __init__(self, rate, burst=None):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = 0.
+    self.last = time.monotonic()
+    self.lock = threading.Lock()
+
+  def set_rate(self, rate):
+    with self.lock:
+      self.rate = rate
+
+  def consume(self, n):
+    """Takes n tokens and returns how long the caller should wait for them."""
+    with self.lock:
+      if self.rate is None:
+        return 0.
+      if self.rate == 0:
+        return float('inf')
+
+      t = time.monotonic()
+      burst = self.rate if self.burst is None else self.burst
+      self.tokens = min(self.tokens + (t - self.last) * self.rate, burst)
+      self.last = t
+      self.tokens -= n
+      return max(-self.tokens / self.rate, 0.)
+
+
+def get_link(network_type, offroad, tether_enabled):
+  if network_type in (NetworkType.wifi, NetworkType.ethernet):
+    # on the road, wifi is the phone's hotspot
+    return "tether" if (tether_enabled and not offroad and network_type == NetworkType.wifi) else "wifi"
+  return "cell"
+
+
+class UploadLimiter():
+  """Token bucket per link type with a daily byte budget for metered links.
+
+     The rate is cut in half on high cpu usage or a yellow thermal status, and
+     uploads pause on red or worse. Setting exit_event stops throttle from waiting.
+  """
+  def __init__(self, params, exit_event=None):
+    self.params = params
+    self.exit_event = threading.Event() if exit_event is None else exit_event
+    self.bucket = TokenBucket(None)
+    self.lock = threading.Lock()
+    self.link = "wifi"
+    self.paused = False
+
+    self.day = None
+    self.usage = {}
+    self.dirty = False
+    self.last_save = 0.
+    self.load()
+
+  @property
+  def metered(self):
+    return self.link != "wifi"
+
+  def load(self):
+    try:
+      dat = json.loads(self.params.get(USAGE_PARAM) or "{}")
+      self.day = dat.get("day")
+      self.usage = dat.get("bytes", {})
+    except ValueError:
+      self.usage = {}
+
+  def save(self, force=False):
+    if self.dirty and (force or time.monotonic() - self.last_save > SAVE_INTERVAL):
+      self.last_save = time.monotonic()
+      with self.lock:
+        dat = json.dumps({"day": self.day, "bytes": self.usage})
+        self.dirty = False
+      self.params.put(USAGE_PARAM, dat)
+
+  def budget(self, link):
+    if link not in LINK_BUDGET_PARAMS:
+      return None
+    try:
+      return float(self.params.get(LINK_BUDGET_PARAMS[link]) or 0) * 1e6
+    except ValueError:
+      return 0
+
+  def remaining(self):
+    budget = self.budget(self.link)
+    if budget is None:
+      return None
+    with self.lock:
+      return max(budget - self.usage.get(self.link, 0), 0)
+
+  def allowed(self):
+    remaining = self.remaining()
+    return not self.paused and (remaining is None or remaining > 0)
+
+  def update(self, network_type, offroad, tether_enabled, device_state):
+    today = datetime.date.today().isoformat()
+    with self.lock:
+      if self.day != today:
+        self.day = today
+        self.usage = {}
+        self.dirty = True
+
+    self.link = get_link(network_type, offroad, tether_enabled)
+    rate = LINK_RATES[self.link]
+
+    cpu = max(device_state.cpuUsagePercent, default=0)
+    self.paused = device_state.thermalStatus >= ThermalStatus.red
+    if rate is not None and (cpu > HIGH_CPU_PERCENT or device_state.thermalStatus >= ThermalStatus.yellow):
+      rate /= 2
+    elif rate is None and cpu > HIGH_CPU_PERCENT:
+      # don't compete with onroad processes, even on a fast link
+      rate = LINK_RATES["tether"]
+    self.bucket.set_rate(0 if self.paused else rate)
+
+  def throttle(self, n):
+    """Accounts for n bytes about to be sent and sleeps to stay within the current rate."""
+    link = self.link
+    with self.lock:
+      self.usage[link] = self.usage.get(link, 0) + n
+      self.dirty = True
+
+    # paused, don't drop the connection but stop sending until things cool down
+    while (wait := self.bucket.consume(n)) == float('inf'):
+      if self.exit_event.wait(1):
+        return
+
+    if wait > 0:
+      self.exit_event.wait(wait)
@@ -1,4 +1,6 @@
 #!/usr/bin/env python3
+import base64
+import io
 import json
 import os
 import random
@@ -6,7 +8,9 @@ import requests
 import threading
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from urllib.parse import quote
 
 from cereal import log
 import cereal.messaging as messaging
@@ -15,20 +19,23 @@ from common.params import Params
 from selfdrive.hardware import TICI
 from selfdrive.loggerd.xattr_cache import getxattr, setxattr
 from selfdrive.loggerd.config import ROOT
+from selfdrive.loggerd.upload_index import UPLOAD_ATTR_NAME, UploadIndex, get_directory_sort
+from selfdrive.loggerd.upload_limiter import UploadLimiter
 from selfdrive.swaglog import cloudlog
 
 NetworkType = log.DeviceState.NetworkType
-UPLOAD_ATTR_NAME = 'user.upload'
 UPLOAD_ATTR_VALUE = b'1'
+UPLOAD_PROGRESS_ATTR_NAME = 'user.upload_progress'
+
+UPLOAD_WORKERS = int(os.getenv("UPLOADER_WORKERS", "2"))
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+UPLOAD_TIMEOUT = 10
 
 allow_sleep = bool(os.getenv("UPLOADER_SLEEP", "1"))
 force_wifi = os.getenv("FORCEWIFI") is not None
 fake_upload = os.getenv("FAKEUPLOAD") is not None
 
 
-def get_directory_sort(d):
-  return list(map(lambda s: s.rjust(10, '0'), d.rsplit('--', 1)))
-
 def listdir_by_creation(d):
   try:
     paths = os.listdir(d)
@@ -38,6 +45,70 @@ def listdir_by_creation(d):
     cloudlog.exception("listdir_by_creation failed")
     return list()
 
+def get_upload_progress(fn, chunk_size):
+  """Returns how many chunks of fn were already sent."""
+  try:
+    dat = getxattr(fn, UPLOAD_PROGRESS_ATTR_NAME)
+    if dat is None:
+      return 0
+    size, done = map(int, dat.split(b":"))
+    return done if size == chunk_size else 0
+  except (OSError, ValueError):
+    return 0
+
+def set_upload_progress(fn, chunk_size, done):
+  try:
+    setxattr(fn, UPLOAD_PROGRESS_ATTR_NAME, f"{chunk_size}:{done}".encode())
+  except OSError:
+    cloudlog.exception("set_upload_progress failed")
+
+def upload_blocks(session, fn, url, headers, chunk_size=UPLOAD_CHUNK_SIZE, on_sent=None):
+  """Uploads fn as a block blob, one chunk at a time, resuming after the last chunk sent.
+
+     Uncommitted blocks are kept by the blob store for a week, so a new upload url
+     for the same path can pick up where the previous one failed.
+  """
+  sz = os.path.getsize(fn)
+  block_ids = [base64.b64encode(f"{i:08d}".encode()).decode() for i in range((sz + chunk_size - 1) // chunk_size)]
+  done = get_upload_progress(fn, chunk_size)
+  sep = "&" if "?" in url else "?"
+
+  with open(fn, "rb") as f:
+    f.seek(done * chunk_size)
+    for i in range(done, len(block_ids)):
+      dat = f.read(chunk_size)
+      data = dat if on_sent is None else CountingReader(io.BytesIO(dat), len(dat), on_sent)
+      resp = session.put(f"{url}{sep}comp=block&blockid={quote(block_ids[i])}", data=data, timeout=UPLOAD_TIMEOUT)
+      if resp.status_code not in (200, 201):
+        return resp
+      set_upload_progress(fn, chunk_size, i + 1)
+
+  block_list = "".join(f"<Latest>{b}</Latest>" for b in block_ids)
+  data = f'<?xml version="1.0" encoding="utf-8"?><BlockList>{block_list}</BlockList>'
+  list_headers = {k: v for k, v in headers.items() if k.lower() != 'x-ms-blob-type'}
+  resp = session.put(f"{url}{sep}comp=blocklist", data=data, headers=list_headers, timeout=UPLOAD_TIMEOUT)
+  if resp.status_code not in (200, 201):
+    # blocks might have expired, start over next time
+    set_upload_progress(fn, chunk_size, 0)
+  return resp
+
+
+class CountingReader():
+  """File wrapper that reports every read, which is also where uploads get throttled."""
+  def __init__(self, f, size, on_sent):
+    self.f = f
+    self.size = size
+    self.on_sent = on_sent
+
+  def read(self, size=-1):
+    dat = self.f.read(size)
+    self.on_sent(len(dat))
+    return dat
+
+  def __len__(self):
+    return self.size
+
+
 def clear_locks(root):
   for logname in os.listdir(root):
     path = os.path.join(root, logname)
@@ -50,20 +121,23 @@ def clear_locks(root):
 
 
 class Uploader():
-  def __init__(self, dongle_id, root):
+  def __init__(self, dongle_id, root, limiter=None):
     self.dongle_id = dongle_id
     self.api = Api(dongle_id)
     self.root = root
 
-    self.upload_thread = None
-
-    self.last_resp = None
-    self.last_exc = None
+    self.limiter = limiter
+    self.lock = threading.Lock()
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=UPLOAD_WORKERS, pool_maxsize=UPLOAD_WORKERS)
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
 
-    self.raw_size = 0
-    self.raw_count = 0
-    self.immediate_size = 0
-    self.immediate_count = 0
+    # throughput over all uploads in flight
+    self.bytes_sent = 0
+    self.last_bytes_sent = 0
+    self.last_msg_time = time.monotonic()
+    self.active_count = 0
 
     # stats for last successfully uploaded file
     self.last_time = 0
@@ -73,115 +147,57 @@ class Uploader():
     self.immediate_folders = ["crash/", "boot/"]
     self.immediate_priority = {"qlog.bz2": 0, "qcamera.ts": 1}
     self.high_priority = {"rlog.bz2": 0, "fcamera.hevc": 1, "dcamera.hevc": 2, "ecamera.hevc": 3}
+    self.index = UploadIndex(root, self.immediate_priority, self.high_priority, self.immediate_folders)
 
-  def get_upload_sort(self, name):
-    if name in self.immediate_priority:
-      return self.immediate_priority[name]
-    if name in self.high_priority:
-      return self.high_priority[name] + 100
-    return 1000
-
-  def list_upload_files(self):
-    if not os.path.isdir(self.root):
-      return
-
-    self.raw_size = 0
-    self.raw_count = 0
-    self.immediate_size = 0
-    self.immediate_count = 0
-
-    for logname in listdir_by_creation(self.root):
-      path = os.path.join(self.root, logname)
-      try:
-        names = os.listdir(path)
-      except OSError:
-        continue
-
-      if any(name.endswith(".lock") for name in names):
-        continue
-
-      for name in sorted(names, key=self.get_upload_sort):
-        key = os.path.join(logname, name)
-        fn = os.path.join(path, name)
-        # skip files already uploaded
-        try:
-          is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME)
-        except OSError:
-          cloudlog.event("uploader_getxattr_failed", exc=self.last_exc, key=key, fn=fn)
-          is_uploaded = True  # deleter could have deleted
-        if is_uploaded:
-          continue
-
-        try:
-          if name in self.immediate_priority:
-            self.immediate_count += 1
-            self.immediate_size += os.path.getsize(fn)
-          else:
-            self.raw_count += 1
-            self.raw_size += os.path.getsize(fn)
-        except OSError:
-          pass
-
-        yield (name, key, fn)
+  def next_file_to_upload(self, with_raw, skip=()):
+    # qlogs and crash/boot folders first, then the full logs and cameras, then the rest
+    with self.lock:
+      self.index.refresh()
+      d = self.index.next_file(with_raw, skip)
+    if d is None:
+      return None
 
-  def next_file_to_upload(self, with_raw):
-    upload_files = list(self.list_upload_files())
+    name, key, fn = d
+    return (key, fn)
 
-    # try to upload qlog files first
-    for name, key, fn in upload_files:
-      if name in self.immediate_priority or any(f in fn for f in self.immediate_folders):
-        return (key, fn)
+  def on_sent(self, n):
+    with self.lock:
+      self.bytes_sent += n
+    if self.limiter is not None:
+      self.limiter.throttle(n)
 
-    if with_raw:
-      # then upload the full log files, rear and front camera files
-      for name, key, fn in upload_files:
-        if name in self.high_priority:
-          return (key, fn)
+  def do_upload(self, key, fn):
+    url_resp = self.api.get("v1.3/"+self.dongle_id+"/upload_url/", timeout=10, path=key, access_token=self.api.get_token())
+    if url_resp.status_code == 412:
+      return url_resp
 
-      # then upload other files
-      for name, key, fn in upload_files:
-        if not name.endswith('.lock') and not name.endswith(".tmp"):
-          return (key, fn)
+    url_resp_json = json.loads(url_resp.text)
+    url = url_resp_json['url']
+    headers = url_resp_json['headers']
+    cloudlog.debug("upload_url v1.3 %s %s", url, str(headers))
 
-    return None
+    if fake_upload:
+      cloudlog.debug("*** WARNING, THIS IS A FAKE UPLOAD TO %s ***" % url)
 
-  def do_upload(self, key, fn):
-    try:
-      url_resp = self.api.get("v1.3/"+self.dongle_id+"/upload_url/", timeout=10, path=key, access_token=self.api.get_token())
-      if url_resp.status_code == 412:
-        self.last_resp = url_resp
-        return
+      class FakeResponse():
+        def __init__(self):
+          self.status_code = 200
 
-      url_resp_json = json.loads(url_resp.text)
-      url = url_resp_json['url']
-      headers = url_resp_json['headers']
-      cloudlog.debug("upload_url v1.3 %s %s", url, str(headers))
+      return FakeResponse()
 
-      if fake_upload:
-        cloudlog.debug("*** WARNING, THIS IS A FAKE UPLOAD TO %s ***" % url)
+    # large files are sent as blocks, so a dropped connection doesn't start over from zero
+    if 'x-ms-blob-type' in headers and os.path.getsize(fn) > UPLOAD_CHUNK_SIZE:
+      return upload_blocks(self.session, fn, url, headers, on_sent=self.on_sent)
 
-        class FakeResponse():
-          def __init__(self):
-            self.status_code = 200
-
-        self.last_resp = FakeResponse()
-      else:
-        with open(fn, "rb") as f:
-          self.last_resp = requests.put(url, data=f, headers=headers, timeout=10)
-    except Exception as e:
-      self.last_exc = (e, traceback.format_exc())
-      raise
+    with open(fn, "rb") as f:
+      data = CountingReader(f, os.fstat(f.fileno()).st_size, self.on_sent)
+      return self.session.put(url, data=data, headers=headers, timeout=UPLOAD_TIMEOUT)
 
   def normal_upload(self, key, fn):
-    self.last_resp = None
-    self.last_exc = None
-
     try:
-      self.do_upload(key, fn)
-    except Exception:
-      pass
-
-    return self.last_resp
+      return self.do_upload(key, fn), None
+    except Exception as e:
+      return None, (e, traceback.format_exc())
 
   def upload(self, key, fn):
     try:
@@ -199,26 +215,34 @@ class Uploader():
         # tag files of 0 size as uploaded
         setxattr(fn, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
       except OSError:
-        cloudlog.event("uploader_setxattr_failed", exc=self.last_exc, key=key, fn=fn, sz=sz)
+        cloudlog.event("uploader_setxattr_failed", key=key, fn=fn, sz=sz)
+      with self.lock:
+        self.index.mark_uploaded(key)
       success = True
     else:
       start_time = time.monotonic()
       cloudlog.debug("uploading %r", fn)
-      stat = self.normal_upload(key, fn)
+      with self.lock:
+        self.active_count += 1
+      stat, exc = self.normal_upload(key, fn)
+      with self.lock:
+        self.active_count -= 1
       if stat is not None and stat.status_code in (200, 201, 403, 412):
         cloudlog.event("upload_success" if stat.status_code != 412 else "upload_ignored", key=key, fn=fn, sz=sz, debug=True)
         try:
           # tag file as uploaded
           setxattr(fn, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
         except OSError:
-          cloudlog.event("uploader_setxattr_failed", exc=self.last_exc, key=key, fn=fn, sz=sz)
+          cloudlog.event("uploader_setxattr_failed", key=key, fn=fn, sz=sz)
+        with self.lock:
+          self.index.mark_uploaded(key)
 
         self.last_filename = fn
         self.last_time = time.monotonic() - start_time
         self.last_speed = (sz / 1e6) / self.last_time
         success = True
       else:
-        cloudlog.event("upload_failed", stat=stat, exc=self.last_exc, key=key, fn=fn, sz=sz, debug=True)
+        cloudlog.event("upload_failed", stat=stat, exc=exc, key=key, fn=fn, sz=sz, debug=True)
         success = False
 
     return success
@@ -226,13 +250,20 @@ class Uploader():
   def get_msg(self):
     msg = messaging.new_message("uploaderState")
     us = msg.uploaderState
-    us.rawQueueSize = int(self.raw_size / 1e6)
-    us.rawQueueCount = self.raw_count
-    us.immediateQueueSize = int(self.immediate_size / 1e6)
-    us.immediateQueueCount = self.immediate_count
+    us.rawQueueSize = int(self.index.raw_size / 1e6)
+    us.rawQueueCount = self.index.raw_count
+    us.immediateQueueSize = int(self.index.immediate_size / 1e6)
+    us.immediateQueueCount = self.index.immediate_count
     us.lastTime = self.last_time
     us.lastSpeed = self.last_speed
     us.lastFilename = self.last_filename
+
+    t = time.monotonic()
+    with self.lock:
+      us.speed = ((self.bytes_sent - self.last_bytes_sent) / 1e6) / max(t - self.last_msg_time, 1e-3)
+      us.activeCount = self.active_count
+      self.last_bytes_sent = self.bytes_sent
+    self.last_msg_time = t
     return msg
 
 def uploader_fn(exit_event):
@@ -248,42 +279,69 @@ def uploader_fn(exit_event):
 
   sm = messaging.SubMaster(['deviceState'])
   pm = messaging.PubMaster(['uploaderState'])
-  uploader = Uploader(dongle_id, ROOT)
+  limiter = UploadLimiter(params, exit_event)
+  uploader = Uploader(dongle_id, ROOT, limiter)
+
+  # uploads run in the background, so qlogs can go out while a camera file is still uploading
+  workers = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+  uploads = {}
 
   backoff = 0.1
+  next_upload_time = 0.
   while not exit_event.is_set():
     sm.update(0)
+
+    for key, future in list(uploads.items()):
+      if not future.done():
+        continue
+      del uploads[key]
+
+      success = future.result()
+      if success:
+        backoff = 0.1
+      elif allow_sleep:
+        cloudlog.info("upload backoff %r", backoff)
+        next_upload_time = time.monotonic() + backoff + random.uniform(0, backoff)
+        backoff = min(backoff*2, 120)
+
+      pm.send("uploaderState", uploader.get_msg())
+      cloudlog.info("upload done, success=%r", success)
+
     offroad = params.get_bool("IsOffroad")
     network_type = sm['deviceState'].networkType if not force_wifi else NetworkType.wifi
     allow_upload_on_road = params.get_bool("moneyPlane.settings.onRoadUploadEnabled") or offroad
 
-    if network_type == NetworkType.none or not allow_upload_on_road:
+    limiter.update(network_type, offroad, params.get_bool("moneyPlane.settings.tetherEnabled"), sm['deviceState'])
+    limiter.save()
+
+    # the limiter throttles uploads already in flight, new ones wait for budget and a cool device
+    if network_type == NetworkType.none or not allow_upload_on_road or not limiter.allowed():
       if allow_sleep:
-        time.sleep(60 if offroad else 5)
+        time.sleep(1 if len(uploads) else (60 if offroad else 5))
       continue
 
-    good_internet = network_type in [NetworkType.wifi, NetworkType.ethernet]
+    # raw files wait for wifi while offroad, qlogs trickle out over metered links
+    good_internet = network_type in [NetworkType.wifi, NetworkType.ethernet] and not limiter.metered
     allow_raw_upload = params.get_bool("UploadRaw")
 
-    d = uploader.next_file_to_upload(with_raw=allow_raw_upload and good_internet and offroad)
-    if d is None:  # Nothing to upload
+    d = None
+    if len(uploads) < UPLOAD_WORKERS and time.monotonic() >= next_upload_time:
+      d = uploader.next_file_to_upload(with_raw=allow_raw_upload and good_internet and offroad, skip=uploads.keys())
+
+    if d is None:  # Nothing to upload, or waiting on uploads in flight
       if allow_sleep:
-        time.sleep(60 if offroad else 5)
+        waiting = len(uploads) or time.monotonic() < next_upload_time
+        time.sleep(0.1 if waiting else (60 if offroad else 5))
       continue
 
     key, fn = d
 
     cloudlog.debug("upload %r over %s", d, network_type)
-    success = uploader.upload(key, fn)
-    if success:
-      backoff = 0.1
-    elif allow_sleep:
-      cloudlog.info("upload backoff %r", backoff)
-      time.sleep(backoff + random.uniform(0, backoff))
-      backoff = min(backoff*2, 120)
-
-    pm.send("uploaderState", uploader.get_msg())
-    cloudlog.info("upload done, success=%r", success)
+    uploads[key] = workers.submit(uploader.upload, key, fn)
+
+  workers.shutdown(wait=False)
+  uploader.index.save()
+  limiter.save(force=True)
 
 def main():
   uploader_fn(threading.Event())
@@ -1,13 +1,65 @@
+import os
+import threading
+from collections import OrderedDict
+
 from common.xattr import getxattr as getattr1
 from common.xattr import setxattr as setattr1
 
-cached_attributes = {}
+MAX_ENTRIES = 16384
+
+# (path, attr_name) -> (inode, ctime, value), least recently used first.
+# Setting an xattr bumps the ctime, so entries written by other processes are
+# noticed, and files replaced by the deleter get a new inode.
+cached_attributes = OrderedDict()
+lock = threading.Lock()
+
+
+def _version(st):
+  return (st.st_ino, st.st_ctime_ns)
+
+def _lookup(path, attr_name, st):
+  key = (path, attr_name)
+  with lock:
+    entry = cached_attributes.get(key)
+    if entry is not None and entry[0] == _version(st):
+      cached_attributes.move_to_end(key)
+      return True, entry[1]
+  return False, None
+
+def _store(path, attr_name, st, value):
+  with lock:
+    cached_attributes[(path, attr_name)] = (_version(st), value)
+    cached_attributes.move_to_end((path, attr_name))
+    while len(cached_attributes) > MAX_ENTRIES:
+      cached_attributes.popitem(last=False)
+
+def _get(path, attr_name, st):
+  hit, value = _lookup(path, attr_name, st)
+  if not hit:
+    value = getattr1(path, attr_name)
+    _store(path, attr_name, st, value)
+  return value
+
 def getxattr(path, attr_name):
-  if (path, attr_name) not in cached_attributes:
-    response = getattr1(path, attr_name)
-    cached_attributes[(path, attr_name)] = response
-  return cached_attributes[(path, attr_name)]
+  try:
+    st = os.stat(path)
+  except OSError:
+    with lock:
+      cached_attributes.pop((path, attr_name), None)
+    raise
+  return _get(path, attr_name, st)
+
+def getxattr_many(paths, attr_name):
+  """Returns {path: value} for every path that still exists, e.g. all files of a directory."""
+  ret = {}
+  for path in paths:
+    try:
+      ret[path] = getxattr(path, attr_name)
+    except OSError:
+      pass
+  return ret
 
 def setxattr(path, attr_name, attr_value):
-  cached_attributes.pop((path, attr_name), None)
+  with lock:
+    cached_attributes.pop((path, attr_name), None)
   return setattr1(path, attr_name, attr_value)
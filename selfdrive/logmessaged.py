@@ -6,10 +6,18 @@ import cereal.messaging as messaging
 from common.logging_extra import SwagLogFileFormatter
 from selfdrive.swaglog import get_file_handler
 
+BATCH_SIZE = 512  # records handled per write
+
+
+def parse_frames(frames):
+  """Returns (level, record) from a message of UnixDomainSocketHandler."""
+  dat = b''.join(frames)
+  return dat[0], dat[1:].decode("utf-8")
+
 
 def main() -> NoReturn:
   log_handler = get_file_handler()
-  log_handler.setFormatter(SwagLogFileFormatter(None))
+  formatter = SwagLogFileFormatter(None)
   log_level = 20  # logging.INFO
 
   ctx = zmq.Context().instance()
@@ -20,16 +28,29 @@ def main() -> NoReturn:
   pub_sock = messaging.pub_sock('logMessage')
 
   while True:
-    dat = b''.join(sock.recv_multipart())
-    level = dat[0]
-    record = dat[1:].decode("utf-8")
-    if level >= log_level:
-      log_handler.emit(record)
+    # block for one record, then take whatever else is queued
+    batch = [sock.recv_multipart()]
+    while len(batch) < BATCH_SIZE:
+      try:
+        batch.append(sock.recv_multipart(zmq.NOBLOCK))
+      except zmq.error.Again:
+        break
+
+    lines = []
+    records = []
+    for frames in batch:
+      level, record = parse_frames(frames)
+      if level >= log_level:
+        # formatted for the file here, instead of in the sending process
+        lines.append(formatter.format(record))
+      records.append(record)
+    log_handler.emit_lines(lines)
 
     # then we publish them
-    msg = messaging.new_message()
-    msg.logMessage = record
-    pub_sock.send(msg.to_bytes())
+    for record in records:
+      msg = messaging.new_message()
+      msg.logMessage = record
+      pub_sock.send(msg.to_bytes())
 
 
 if __name__ == "__main__":
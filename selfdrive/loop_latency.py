@@ -0,0 +1,117 @@
+"""Fixed bucket latency histograms for the sections of a process's main loop."""
+import math
+from typing import Dict, List, Optional
+
+import cereal.messaging as messaging
+from common.realtime import sec_since_boot
+
+# HDR style buckets, SUB_BUCKETS linear buckets per power of two from 2**MIN_EXP to 2**MAX_EXP ms,
+# so every bucket is within 1 / SUB_BUCKETS of the latencies in it
+SUB_BUCKETS = 8
+MIN_EXP = -6  # 15.6 us
+MAX_EXP = 10  # 1024 ms
+NUM_BUCKETS = (MAX_EXP - MIN_EXP) * SUB_BUCKETS
+
+# upper bound of each bucket, latencies above the last one are counted in an extra overflow bucket
+BUCKET_BOUNDS_MS = [2. ** (MIN_EXP + i // SUB_BUCKETS) * (1 + (i % SUB_BUCKETS + 1) / SUB_BUCKETS) for i in range(NUM_BUCKETS)]
+
+PUBLISH_INTERVAL = 10.  # s
+
+
+def bucket_index(ms: float) -> int:
+  if ms < 2. ** MIN_EXP:
+    return 0
+  m, e = math.frexp(ms)  # ms = m * 2**e, 0.5 <= m < 1
+  idx = (e - 1 - MIN_EXP) * SUB_BUCKETS + int((m - 0.5) * 2 * SUB_BUCKETS)
+  return min(idx, NUM_BUCKETS)
+
+
+def percentile(counts: List[int], q: float, bounds: List[float] = BUCKET_BOUNDS_MS, max_ms: Optional[float] = None) -> float:
+  """Upper bound of the bucket with the q-th percentile (0-100) latency, the max for the overflow bucket."""
+  total = sum(counts)
+  if total == 0:
+    return 0.
+  target = q / 100. * total
+  cum = 0
+  for i, c in enumerate(counts):
+    cum += c
+    if cum >= target and c > 0:
+      bound = bounds[i] if i < len(bounds) else math.inf
+      return bound if max_ms is None else min(bound, max_ms)
+  return max_ms if max_ms is not None else math.inf
+
+
+class LatencyHistogram():
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.counts = [0] * (NUM_BUCKETS + 1)
+    self.count = 0
+    self.sum_ms = 0.
+    self.max_ms = 0.
+
+  def record(self, ms: float):
+    self.counts[bucket_index(ms)] += 1
+    self.count += 1
+    self.sum_ms += ms
+    self.max_ms = max(self.max_ms, ms)
+
+  def percentile(self, q: float) -> float:
+    return percentile(self.counts, q, max_ms=self.max_ms)
+
+
+class LoopLatency():
+  """Histograms of the time spent in each section of a loop, and the whole loop.
+
+     checkpoint(name) records the time since the last checkpoint as section name,
+     and end_loop() records the sum of the sections that aren't ignored, e.g.
+     waiting for messages, as "loop". Every interval the histograms are published
+     on service and reset.
+  """
+  def __init__(self, service: str, interval: float = PUBLISH_INTERVAL):
+    self.service = service
+    self.interval = interval
+    self.sections: Dict[str, LatencyHistogram] = {"loop": LatencyHistogram()}
+    self.sock = None
+
+    self.last_time = sec_since_boot()
+    self.last_publish = self.last_time
+    self.loop_ms = 0.
+
+  def checkpoint(self, name: str, ignore: bool = False):
+    t = sec_since_boot()
+    ms = (t - self.last_time) * 1000.
+    self.last_time = t
+
+    hist = self.sections.get(name)
+    if hist is None:
+      hist = self.sections[name] = LatencyHistogram()
+    hist.record(ms)
+    if not ignore:
+      self.loop_ms += ms
+
+  def end_loop(self):
+    self.sections["loop"].record(self.loop_ms)
+    self.loop_ms = 0.
+
+    if self.last_time - self.last_publish >= self.interval:
+      self.publish()
+      self.last_publish = self.last_time
+
+  def publish(self):
+    if self.sock is None:
+      self.sock = messaging.pub_sock(self.service)
+
+    dat = messaging.new_message(self.service)
+    msg = getattr(dat, self.service)
+    msg.bucketBoundsMs = BUCKET_BOUNDS_MS
+    sections = msg.init('sections', len(self.sections))
+    for i, (name, hist) in enumerate(self.sections.items()):
+      sections[i].name = name
+      sections[i].counts = hist.counts
+      sections[i].count = hist.count
+      sections[i].sumMs = hist.sum_ms
+      sections[i].maxMs = hist.max_ms
+      hist.reset()
+    self.sock.send(dat.to_bytes())
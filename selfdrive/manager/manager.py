@@ -59,6 +59,8 @@ def manager_init():
     ("moneyPlane.settings.pandaModEnabled", "1"),
     ("moneyPlane.settings.tetherEnabled", "1"),
     ("moneyPlane.settings.onRoadUploadEnabled", "0"),
+    ("moneyPlane.settings.uploadCellDailyMB", "100"),
+    ("moneyPlane.settings.uploadTetherDailyMB", "250"),
     ("moneyPlane.settings.opLong", "0"),
 
     ("moneyPlane.settings.mqtt.broker", ""),
@@ -1,34 +1,17 @@
 #!/usr/bin/env python3
-import datetime
-import os
+import json
+import sys
 import time
-from pathlib import Path
-from typing import Dict, Optional, Tuple
-
-import psutil
-from smbus2 import SMBus
 
 import cereal.messaging as messaging
-from cereal import log
-from common.filter_simple import FirstOrderFilter
-from common.numpy_fast import clip, interp
-from common.params import Params, ParamKeyType
-from common.realtime import DT_TRML, sec_since_boot
-from common.dict_helpers import strip_deprecated_keys
-from selfdrive.controls.lib.alertmanager import set_offroad_alert
-from selfdrive.hardware import EON, TICI, HARDWARE
-from selfdrive.loggerd.config import get_available_percent
-from selfdrive.pandad import get_expected_signature
-from selfdrive.swaglog import cloudlog
-from selfdrive.thermald.power_monitoring import PowerMonitoring
-from selfdrive.version import get_git_branch, terms_version, training_version
+from selfdrive.hardware import HARDWARE
+from selfdrive.mqttd.pub_queue import OfflineQueue, PubQueue
 
 from common.cached_params import CachedParams
 from pyextra.paho.mqtt import client as mqtt_client
 from pyextra.paho.mqtt.client import MQTT_ERR_SUCCESS
-from pyextra.paho.mqtt.subscribeoptions import SubscribeOptions
-import json
-import sys
+
+POLL_TIMEOUT = 100  # ms, also how often retries and the offline queue are serviced
 
 def client_id():
   device_type = HARDWARE.get_device_type()
@@ -73,14 +56,13 @@ def connect_mqtt(client, broker, port, username, password, pm):
       print(f"Received `{msg.payload.decode()}` from `{msg.topic}` topic")
 
     def on_publish(client, userdata, mid):
-      print(f"SENT {mid} with SUCCESS")
-      mid_filter = lambda message: message["mid"] != mid
-      client.pub_list = list(filter(mid_filter, client.pub_list))
+      client.pub_queue.on_publish(mid)
 
     def on_disconnect(client, userdata, rc):
       if rc != 0:
         print("Unexpected disconnection.")
       client.connected_flag = False
+      client.pub_queue.on_disconnect()
       for key in client.sub_dict.keys():
         client.sub_dict[key]["server_state"] = False
 
@@ -99,10 +81,10 @@ def connect_mqtt(client, broker, port, username, password, pm):
 def update_subs(client, connect_flag):
   sub_dict = client.sub_dict
   print(f"\n{sub_dict}\n")
-  for key in sub_dict.keys():
+  for key in list(sub_dict.keys()):
     #UNSUB
     if not sub_dict[key]["subscribe"] and sub_dict[key]["server_state"] == True:
-      if coonect_flag:
+      if connect_flag:
         sub_dict.pop(key)
       else:
         res, mid = client.unsubscribe(key)
@@ -110,6 +92,7 @@ def update_subs(client, connect_flag):
           sub_dict.pop(key)
         else:
           print("COULDNT UNSUB")
+      continue
     #SUB
     if sub_dict[key]["subscribe"] and (not sub_dict[key]["server_state"] or connect_flag):
       res, mid = client.subscribe(key)
@@ -133,72 +116,57 @@ def setup_connection(client, pm):
     return False
   return True
 
-def send_pubs(client):
-  updated_pub_list = []
-  for message in client.pub_list:
-    if message["attempts"] > 4:
-      continue
-    if message["attempts"] != 0 and time.time() - message["last_sent"] < 0.2:
-      updated_pub_list.append(message)
-      continue
-
-    result, mid = client.publish(message["topic"], message["content"])
-    message["mid"] = mid
-    message["attempts"] = message["attempts"] + 1
-    message["last_sent"] = time.time()
-    updated_pub_list.append(message)
-
-  return updated_pub_list
-
 def mqtt_thread():
   pm = messaging.PubMaster(['mqttRecvQueue'])
-  sm = messaging.SubMaster(['mqttPubQueue'])
+  poller = messaging.Poller()
+  pub_sock = messaging.sub_sock('mqttPubQueue', poller=poller)
 
   # Set Connecting Client ID
   client = mqtt_client.Client(client_id())
   client.connected_flag = False
   client.sub_dict = {}
-  client.pub_list = []
+  client.pub_queue = PubQueue(client, OfflineQueue())
   client.cached_params = CachedParams()
 
   first_connect = True
 
-  count = 100
+  last_reconnect = 0.
   while True:
     if first_connect:
       first_connect = setup_connection(client, pm)
 
-    sm.update()
-    if not sm.updated["mqttPubQueue"]:
-      continue
-
-    message = sm["mqttPubQueue"]
-    if not message.subscribe and not message.publish and message.topic in client.sub_dict:
-      client.sub_dict[message.topic]["subscribe"] = False
-    if message.subscribe:
-      if message.topic not in client.sub_dict:
-        client.sub_dict[message.topic] = {"server_state": False}
-      client.sub_dict[message.topic]["subscribe"] = True
-    if message.publish:
-      msg = {"topic": message.topic, "content": message.content, "attempts": 0, "last_sent": time.time(), "mid": -1}
-      client.pub_list.append(msg)
-      client.pub_list = client.pub_list[-100:]
-    if client.connected_flag:
-      if count == 100:
-        print("CONNECTED")
-        count = 0
+    # wake up on new messages, or periodically for retries and draining
+    messages = []
+    if len(poller.poll(POLL_TIMEOUT)):
+      messages = messaging.drain_sock(pub_sock)
+
+    subs_changed = False
+    for msg in messages:
+      message = msg.mqttPubQueue
+      if not message.subscribe and not message.publish and message.topic in client.sub_dict:
+        client.sub_dict[message.topic]["subscribe"] = False
+        subs_changed = True
+      if message.subscribe:
+        if message.topic not in client.sub_dict:
+          client.sub_dict[message.topic] = {"server_state": False}
+        client.sub_dict[message.topic]["subscribe"] = True
+        subs_changed = True
+      if message.publish:
+        client.pub_queue.add(message.topic, message.content)
+
+    connected = client.connected_flag
+    if connected and subs_changed:
       client.sub_dict = update_subs(client, False)
-      client.pub_list = send_pubs(client)
-    elif not first_connect:
-      if count == 100:
-        print("I AM RECONNECTING MANUALLY")
-        try:
-          client.reconnect()
-        except:
-          e = sys.exec.info()[0]
-          print(f"error reconnecting {e}")
-        count = 0
-    count = count + 1
+    client.pub_queue.update(connected)
+
+    if not connected and not first_connect and time.monotonic() - last_reconnect > 10.:
+      print("I AM RECONNECTING MANUALLY")
+      last_reconnect = time.monotonic()
+      try:
+        client.reconnect()
+      except Exception:
+        e = sys.exc_info()[0]
+        print(f"error reconnecting {e}")
 
 def main():
   mqtt_thread()
@@ -0,0 +1,209 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+from selfdrive.hardware import PC
+
+if PC:
+  QUEUE_DIR = os.path.join(str(Path.home()), ".comma", "mqttd_queue")
+else:
+  QUEUE_DIR = "/data/mqttd_queue/"
+QUEUE_DIR = os.getenv("MQTTD_QUEUE_DIR", QUEUE_DIR)
+QUEUE_MAX_BYTES = int(os.getenv("MQTTD_QUEUE_MAX_BYTES", 64 * 1024 * 1024))
+
+MAX_ATTEMPTS = 4
+RETRY_INTERVAL = 1.0  # seconds without an ack before a publish is sent again
+
+
+class OfflineQueue:
+  """Undelivered messages, stored as JSON lines in segment files under a byte budget.
+
+     When the budget is exceeded the oldest segments are dropped.
+  """
+  def __init__(self, path=QUEUE_DIR, max_bytes=QUEUE_MAX_BYTES, segment_bytes=256 * 1024):
+    self.path = path
+    self.max_bytes = max_bytes
+    self.segment_bytes = segment_bytes
+    self.dropped = 0
+
+    Path(path).mkdir(parents=True, exist_ok=True)
+    self.segments = deque(sorted(int(fn.split(".")[0]) for fn in os.listdir(path) if fn.endswith(".jsonl")))
+    self.sizes = {seg: os.path.getsize(self._fn(seg)) for seg in self.segments}
+    self.writer = None
+
+  def _fn(self, seg):
+    return os.path.join(self.path, f"{seg:010d}.jsonl")
+
+  def _close_writer(self):
+    if self.writer is not None:
+      self.writer.close()
+      self.writer = None
+
+  def __len__(self):
+    return len(self.segments)
+
+  def total_bytes(self):
+    return sum(self.sizes.values())
+
+  def _write(self, dat):
+    if self.writer is None or self.sizes[self.segments[-1]] >= self.segment_bytes:
+      self._close_writer()
+      seg = self.segments[-1] + 1 if len(self.segments) else 0
+      self.segments.append(seg)
+      self.sizes[seg] = 0
+      self.writer = open(self._fn(seg), "a")
+
+    self.writer.write(dat)
+    self.sizes[self.segments[-1]] += len(dat)
+
+  def push(self, messages):
+    if not len(messages):
+      return
+
+    for m in messages:
+      self._write(json.dumps({"topic": m["topic"], "content": m["content"]}) + "\n")
+    self.writer.flush()
+
+    while self.total_bytes() > self.max_bytes and len(self.segments) > 1:
+      self.dropped += self._delete(self.segments[0])
+
+  def _delete(self, seg):
+    self.segments.remove(seg)
+    del self.sizes[seg]
+    fn = self._fn(seg)
+    with open(fn) as f:
+      count = sum(1 for _ in f)
+    os.remove(fn)
+    return count
+
+  def pop_segment(self):
+    """Removes the oldest segment and returns its messages."""
+    if not len(self.segments):
+      return []
+
+    seg = self.segments[0]
+    if len(self.segments) == 1:
+      self._close_writer()
+
+    fn = self._fn(seg)
+    messages = []
+    with open(fn) as f:
+      for line in f:
+        try:
+          messages.append(json.loads(line))
+        except ValueError:
+          # partially written line after a crash
+          pass
+    self.segments.popleft()
+    del self.sizes[seg]
+    os.remove(fn)
+    return messages
+
+
+class PubQueue:
+  """Publishes to an mqtt client and tracks the in-flight messages by mid.
+
+     Messages that can't be delivered go to the offline queue, which is
+     drained at drain_rate messages per second while connected.
+
+     on_publish and on_disconnect are called from the paho network thread and only
+     touch inflight, early_acks and unacked under lock. Everything else, including the
+     offline queue, is only used from the thread calling add and update.
+  """
+  def __init__(self, client, offline, max_inflight=100, drain_rate=20., qos=0):
+    self.client = client
+    self.offline = offline
+    self.max_inflight = max_inflight
+    self.drain_rate = drain_rate
+    self.qos = qos
+
+    self.lock = threading.Lock()
+    self.inflight = {}
+    self.early_acks = set()
+    self.unacked = []
+    self.pending = deque()
+    self.backlog = deque()
+    self.drain_tokens = 0.
+    self.last_update = None
+    self.sent = 0
+
+  def add(self, topic, content):
+    self.pending.append({"topic": topic, "content": content, "attempts": 0, "last_sent": 0.})
+
+  def on_publish(self, mid):
+    # called from the paho network thread, possibly before publish() returned the mid
+    with self.lock:
+      if self.inflight.pop(mid, None) is None:
+        self.early_acks.add(mid)
+      else:
+        self.sent += 1
+
+  def on_disconnect(self):
+    # called from the paho network thread, the next update spills these to the offline queue
+    with self.lock:
+      self.unacked += self.inflight.values()
+      self.inflight.clear()
+      self.early_acks.clear()
+
+  def spill(self, messages=None):
+    """Moves the given messages, or everything not yet published, to the offline queue."""
+    if messages is None:
+      messages = list(self.backlog) + list(self.pending)
+      self.backlog.clear()
+      self.pending.clear()
+    self.offline.push(messages)
+
+  def _publish(self, messages, t):
+    for message in messages:
+      result, mid = self.client.publish(message["topic"], message["content"], qos=self.qos)
+      message["attempts"] += 1
+      message["last_sent"] = t
+      with self.lock:
+        if mid in self.early_acks:
+          self.early_acks.discard(mid)
+          self.sent += 1
+        else:
+          self.inflight[mid] = message
+
+  def update(self, connected, t=None):
+    t = time.monotonic() if t is None else t
+    dt = 0. if self.last_update is None else t - self.last_update
+    self.last_update = t
+
+    with self.lock:
+      unacked, self.unacked = self.unacked, []
+    self.spill(unacked)
+
+    if not connected:
+      self.drain_tokens = 0.
+      self.spill()
+      return
+
+    with self.lock:
+      expired = [mid for mid, m in self.inflight.items() if t - m["last_sent"] > RETRY_INTERVAL]
+      retries = [self.inflight.pop(mid) for mid in expired]
+    failed = [m for m in retries if m["attempts"] >= MAX_ATTEMPTS]
+    retries = [m for m in retries if m["attempts"] < MAX_ATTEMPTS]
+    self.spill(failed)
+
+    # rate limited drain of the offline queue, without starving live messages
+    self.drain_tokens = min(self.drain_tokens + dt * self.drain_rate, self.drain_rate)
+    if not len(self.backlog) and len(self.offline) and self.drain_tokens >= 1:
+      self.backlog.extend({"topic": m["topic"], "content": m["content"], "attempts": 0, "last_sent": 0.}
+                          for m in self.offline.pop_segment())
+
+    room = self.max_inflight - len(self.inflight)
+    batch = retries + [self.pending.popleft() for _ in range(min(room - len(retries), len(self.pending)))]
+    drain = min(int(self.drain_tokens), room - len(batch), len(self.backlog))
+    if drain > 0:
+      self.drain_tokens -= drain
+      batch += [self.backlog.popleft() for _ in range(drain)]
+
+    self._publish(batch, t)
+
+    # only keep a bounded number of live messages in memory
+    if len(self.pending) > self.max_inflight:
+      self.spill([self.pending.popleft() for _ in range(len(self.pending) - self.max_inflight)])
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+import shutil
+import tempfile
+import threading
+import unittest
+
+from selfdrive.mqttd.pub_queue import MAX_ATTEMPTS, RETRY_INTERVAL, OfflineQueue, PubQueue
+
+
+class FakeBroker:
+  """Stands in for a paho client, acks are delivered by calling ack()."""
+  def __init__(self):
+    self.mid = 0
+    self.published = {}
+
+  def publish(self, topic, content, qos=0):
+    self.mid += 1
+    self.published[self.mid] = (topic, content)
+    return 0, self.mid
+
+  def ack(self, queue, mids=None):
+    for mid in list(self.published.keys()) if mids is None else mids:
+      self.published.pop(mid)
+      queue.on_publish(mid)
+
+
+class TestPubQueue(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.broker = FakeBroker()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_publish_and_ack(self):
+    q = PubQueue(self.broker, OfflineQueue(self.tmpdir), max_inflight=10)
+    for i in range(25):
+      q.add("topic", str(i))
+    q.update(True, t=0.)
+    self.assertEqual(len(q.inflight), 10)
+
+    self.broker.ack(q)
+    self.assertEqual(len(q.inflight), 0)
+    q.update(True, t=0.1)
+    q.update(True, t=0.2)
+    self.broker.ack(q)
+    q.update(True, t=0.3)
+    self.broker.ack(q)
+    self.assertEqual(q.sent, 25)
+
+  def test_early_ack(self):
+    q = PubQueue(self.broker, OfflineQueue(self.tmpdir))
+    q.on_publish(1)
+    q.add("topic", "a")
+    q.update(True, t=0.)
+    self.assertEqual(len(q.inflight), 0)
+    self.assertEqual(q.sent, 1)
+
+  def test_offline_drain(self):
+    offline = OfflineQueue(self.tmpdir, segment_bytes=100)
+    q = PubQueue(self.broker, offline, drain_rate=10.)
+    for i in range(50):
+      q.add("topic", str(i))
+    q.update(False, t=0.)
+    self.assertEqual(len(self.broker.published), 0)
+    self.assertGreater(len(offline), 1)
+
+    # survives a restart
+    offline = OfflineQueue(self.tmpdir, segment_bytes=100)
+    q = PubQueue(self.broker, offline, drain_rate=10.)
+    q.update(True, t=0.)
+    t = 0.
+    while len(offline) or len(q.backlog):
+      t += 0.1
+      q.update(True, t=t)
+      self.broker.ack(q)
+    self.assertEqual(q.sent, 50)
+    # rate limited to 10 messages/s
+    self.assertGreaterEqual(t, 4.)
+
+  def test_retries_spill_to_disk(self):
+    offline = OfflineQueue(self.tmpdir)
+    # no draining, otherwise the message would be picked up again right away
+    q = PubQueue(self.broker, offline, drain_rate=0.)
+    q.add("topic", "a")
+    t = 0.
+    for _ in range(MAX_ATTEMPTS + 1):
+      q.update(True, t=t)
+      t += RETRY_INTERVAL * 2
+    self.assertEqual(len(q.inflight), 0)
+    self.assertEqual(offline.pop_segment(), [{"topic": "topic", "content": "a"}])
+
+  def test_disconnect(self):
+    offline = OfflineQueue(self.tmpdir)
+    q = PubQueue(self.broker, offline, drain_rate=0.)
+    for i in range(5):
+      q.add("topic", str(i))
+    q.update(True, t=0.)
+    self.assertEqual(len(q.inflight), 5)
+
+    # the network thread only hands the in-flight messages over
+    t = threading.Thread(target=q.on_disconnect)
+    t.start()
+    t.join()
+    self.assertEqual(len(q.inflight), 0)
+    self.assertEqual(len(offline), 0)
+
+    q.add("topic", "5")
+    q.update(False, t=0.1)
+    self.assertEqual([m["content"] for m in offline.pop_segment()], [str(i) for i in range(6)])
+
+  def test_byte_budget(self):
+    offline = OfflineQueue(self.tmpdir, max_bytes=1000, segment_bytes=100)
+    for i in range(100):
+      offline.push([{"topic": "topic", "content": str(i)}])
+    self.assertLessEqual(offline.total_bytes(), 1000)
+    self.assertGreater(offline.dropped, 0)
+    # the newest messages are kept
+    msgs = []
+    while len(offline):
+      msgs += offline.pop_segment()
+    self.assertEqual(msgs[-1]["content"], "99")
+    self.assertEqual(len(msgs) + offline.dropped, 100)
+
+
+if __name__ == "__main__":
+  unittest.main()
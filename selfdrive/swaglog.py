@@ -1,11 +1,18 @@
+import gzip
+import json
 import logging
 import os
+import queue
+import shutil
+import threading
 import time
+from collections import OrderedDict
 from pathlib import Path
 from logging.handlers import BaseRotatingHandler
 
 import zmq
 
+from common.file_helpers import atomic_write_in_dir
 from common.logging_extra import SwagLogger, SwagFormatter, SwagLogFileFormatter
 from selfdrive.hardware import PC
 
@@ -14,23 +21,94 @@ if PC:
 else:
   SWAGLOG_DIR = "/data/log/"
 
+MANIFEST_NAME = "swaglog_manifest.json"
+COMPRESSED_EXT = ".gz"
+
 def get_file_handler():
   Path(SWAGLOG_DIR).mkdir(parents=True, exist_ok=True)
   base_filename = os.path.join(SWAGLOG_DIR, "swaglog")
   handler = SwaglogRotatingFileHandler(base_filename)
   return handler
 
+def read_manifest(log_dir):
+  """Returns [(name, size)] of the log files in log_dir, oldest first, or None without a manifest."""
+  try:
+    with open(os.path.join(log_dir, MANIFEST_NAME)) as f:
+      return [(name, size) for name, size in json.load(f)["files"]]
+  except (OSError, ValueError, KeyError, TypeError):
+    return None
+
+def get_log_size(path):
+  """Uncompressed size of a log file."""
+  if not path.endswith(COMPRESSED_EXT):
+    return os.path.getsize(path)
+  # gzip keeps the uncompressed size mod 2**32 in the last four bytes
+  with open(path, "rb") as f:
+    f.seek(-4, os.SEEK_END)
+    return int.from_bytes(f.read(4), "little")
+
+def open_log(path):
+  if path.endswith(COMPRESSED_EXT):
+    return gzip.open(path, "rt")
+  return open(path, "r")
+
+def compress_log(path):
+  """Gzips a closed log file next to it, keeping its xattrs, and removes the original."""
+  dest = path + COMPRESSED_EXT
+  with open(path, "rb") as f_in, gzip.open(dest + ".tmp", "wb") as f_out:
+    shutil.copyfileobj(f_in, f_out)
+  try:
+    for attr in os.listxattr(path):
+      os.setxattr(dest + ".tmp", attr, os.getxattr(path, attr))
+  except OSError:
+    pass
+  os.rename(dest + ".tmp", dest)
+  remove_log(path)
+  return dest
+
+def remove_log(path):
+  try:
+    os.remove(path)
+  except FileNotFoundError:
+    pass
+
 class SwaglogRotatingFileHandler(BaseRotatingHandler):
-  def __init__(self, base_filename, interval=60, max_bytes=1024*256, backup_count=2500, encoding=None):
+  """Rotates every interval seconds or max_bytes, whichever comes first.
+
+     Closed files are gzipped in a background thread, and the oldest ones are
+     deleted to stay within backup_count files and max_total_bytes on disk.
+     The files are kept in a manifest, so neither startup nor athenad have to
+     list the directory.
+  """
+  def __init__(self, base_filename, interval=60, max_bytes=1024*256, backup_count=2500,
+               max_total_bytes=1024*1024*100, compress=True, encoding=None):
     super().__init__(base_filename, mode="a", encoding=encoding, delay=True)
     self.base_filename = base_filename
+    self.log_dir = os.path.dirname(base_filename)
     self.interval = interval # seconds
     self.max_bytes = max_bytes
     self.backup_count = backup_count
+    self.max_total_bytes = max_total_bytes
+
+    # path -> size on disk, newest first
+    self.files_lock = threading.Lock()
+    self.manifest_lock = threading.Lock()
     self.log_files = self.get_existing_logfiles()
-    log_indexes = [f.split(".")[-1] for f in self.log_files]
+    log_indexes = [os.path.basename(f).split(".")[1] for f in self.log_files]
     self.last_file_idx = max([int(i) for i in log_indexes if i.isdigit()] or [-1])
     self.last_rollover = None
+
+    self.compress_queue = None
+    self.compress_pending = set()
+    if compress:
+      self.compress_queue = queue.Queue()
+      # left over from the last run
+      for fn in reversed(self.log_files):
+        if not fn.endswith(COMPRESSED_EXT):
+          self.compress_pending.add(fn)
+          self.compress_queue.put(fn)
+      threading.Thread(target=self._compress_thread, daemon=True).start()
+
     self.doRollover()
 
   def _open(self):
@@ -38,17 +116,66 @@ class SwaglogRotatingFileHandler(BaseRotatingHandler):
     self.last_file_idx += 1
     next_filename = f"{self.base_filename}.{self.last_file_idx:010}"
     stream = open(next_filename, self.mode, encoding=self.encoding)
-    self.log_files.insert(0, next_filename)
+    with self.files_lock:
+      self.log_files[next_filename] = 0
+      self.log_files.move_to_end(next_filename, last=False)
     return stream
 
   def get_existing_logfiles(self):
-    log_files = list()
-    base_dir = os.path.dirname(self.base_filename)
-    for fn in os.listdir(base_dir):
-      fp = os.path.join(base_dir, fn)
-      if fp.startswith(self.base_filename) and os.path.isfile(fp):
-        log_files.append(fp)
-    return sorted(log_files)
+    """Log files from the manifest, the directory is only listed without one.
+
+       The manifest's entries are checked for what the last run may have done
+       between changing a file and writing the manifest.
+    """
+    manifest = read_manifest(self.log_dir)
+    if manifest is None:
+      names = [fn for fn in os.listdir(self.log_dir) if fn.startswith(os.path.basename(self.base_filename) + ".")]
+      for fn in names:
+        if fn.endswith(".tmp"):
+          remove_log(os.path.join(self.log_dir, fn))
+      names = {fn for fn in names if not fn.endswith(".tmp")}
+    else:
+      names = {name for name, _ in manifest}
+      # opened after the manifest was last written
+      idx = max([int(i) for i in (fn.split(".")[1] for fn in names) if i.isdigit()] or [-1]) + 1
+      while True:
+        fn = os.path.basename(f"{self.base_filename}.{idx:010}")
+        if not any(os.path.exists(os.path.join(self.log_dir, fn + ext)) for ext in ("", COMPRESSED_EXT)):
+          break
+        names.add(fn)
+        idx += 1
+
+    files = OrderedDict()
+    for fn in sorted(names, reverse=True):
+      f = self._check_logfile(os.path.join(self.log_dir, fn))
+      if f is not None:
+        files[f[0]] = f[1]
+    return files
+
+  def _check_logfile(self, path):
+    """Returns (path, size) of a log file, which may have been compressed since, or None if it's gone."""
+    if not path.endswith(COMPRESSED_EXT):
+      dest = path + COMPRESSED_EXT
+      # interrupted compression
+      remove_log(dest + ".tmp")
+      if os.path.isfile(dest):
+        # compressed, but the original wasn't removed yet
+        remove_log(path)
+        path = dest
+    try:
+      return path, os.path.getsize(path)
+    except OSError:
+      return None
+
+  def write_manifest(self):
+    with self.manifest_lock:
+      with self.files_lock:
+        files = [(os.path.basename(fn), size) for fn, size in reversed(self.log_files.items())]
+      try:
+        with atomic_write_in_dir(os.path.join(self.log_dir, MANIFEST_NAME), overwrite=True) as f:
+          json.dump({"files": files}, f)
+      except OSError:
+        pass
 
   def shouldRollover(self, record):
     size_exceeded = self.max_bytes > 0 and self.stream.tell() >= self.max_bytes
@@ -57,16 +184,86 @@ class SwaglogRotatingFileHandler(BaseRotatingHandler):
 
   def doRollover(self):
     if self.stream:
+      closed = self.stream.name
+      with self.files_lock:
+        self.log_files[closed] = self.stream.tell()
       self.stream.close()
+      if self.compress_queue is not None:
+        with self.files_lock:
+          self.compress_pending.add(closed)
+        self.compress_queue.put(closed)
     self.stream = self._open()
+    self.delete_old()
+    self.write_manifest()
 
-    if self.backup_count > 0:
-      while len(self.log_files) > self.backup_count:
-        to_delete = self.log_files.pop()
-        if os.path.exists(to_delete): # just being safe, should always exist
+  def delete_old(self):
+    """Deletes the oldest files past backup_count or max_total_bytes, never the open one."""
+    with self.files_lock:
+      # files waiting to be compressed count at their full size until they're replaced,
+      # so the budget holds when compression falls behind
+      total = sum(self.log_files.values())
+      while len(self.log_files) > 1:
+        over_count = self.backup_count > 0 and len(self.log_files) > self.backup_count
+        over_size = self.max_total_bytes > 0 and total > self.max_total_bytes
+        if not (over_count or over_size):
+          break
+        to_delete, size = self.log_files.popitem()
+        total -= size
+        try:
           os.remove(to_delete)
+        except OSError:
+          pass
+
+  def _compress_thread(self):
+    while True:
+      fn = self.compress_queue.get()
+      try:
+        dest = compress_log(fn)
+        size = os.path.getsize(dest)
+      except OSError:
+        with self.files_lock:
+          self.compress_pending.discard(fn)
+        continue  # deleted before its turn
+      with self.files_lock:
+        self.compress_pending.discard(fn)
+        if fn in self.log_files:
+          # keep the order, so the newest files stay first
+          self.log_files = OrderedDict((dest, size) if k == fn else (k, v) for k, v in self.log_files.items())
+          fn = None
+      if fn is not None:
+        # deleted while it was being compressed
+        try:
+          os.remove(dest)
+        except OSError:
+          pass
+        continue
+      self.delete_old()
+      self.write_manifest()
+
+  def emit_lines(self, lines):
+    """Writes records that are already formatted with a single write."""
+    if not len(lines):
+      return
+
+    self.acquire()
+    try:
+      if self.stream is None:
+        self.stream = self._open()
+      if self.shouldRollover(None):
+        self.doRollover()
+      self.stream.write(self.terminator.join(lines) + self.terminator)
+      self.stream.flush()
+    except Exception:
+      self.handleError(None)
+    finally:
+      self.release()
 
 class UnixDomainSocketHandler(logging.Handler):
+  """Sends level + json record frames to logmessaged.
+
+     The sender only does one format_dict and one dumps per record,
+     logmessaged makes the file line from the json it receives.
+  """
   def __init__(self, formatter):
     logging.Handler.__init__(self)
     self.setFormatter(formatter)
@@ -83,14 +280,15 @@ class UnixDomainSocketHandler(logging.Handler):
     if os.getpid() != self.pid:
       self.connect()
 
-    msg = self.format(record).rstrip('\n')
-    # print("SEND".format(repr(msg)))
     try:
+      msg = self.format(record).rstrip('\n')
       s = chr(record.levelno)+msg
       self.sock.send(s.encode('utf8'), zmq.NOBLOCK)
     except zmq.error.Again:
       # drop :/
       pass
+    except Exception:
+      self.handleError(record)
 
 
 def add_file_handler(log):
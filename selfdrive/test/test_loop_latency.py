@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+import math
+import unittest
+from unittest import mock
+
+import cereal.messaging as messaging
+from selfdrive import loop_latency
+from selfdrive.loop_latency import BUCKET_BOUNDS_MS, MAX_EXP, MIN_EXP, NUM_BUCKETS, LatencyHistogram, LoopLatency, bucket_index, percentile
+
+
+class FakePubSocket():
+  def __init__(self):
+    self.sent = []
+
+  def send(self, dat):
+    self.sent.append(dat)
+
+
+class TestLoopLatency(unittest.TestCase):
+  def test_bucket_index(self):
+    self.assertEqual(bucket_index(0.), 0)
+    self.assertEqual(bucket_index(2. ** MIN_EXP / 2), 0)
+    lower = 2. ** MIN_EXP
+    for i, upper in enumerate(BUCKET_BOUNDS_MS):
+      self.assertEqual(bucket_index(lower), i)
+      self.assertEqual(bucket_index((lower + upper) / 2), i)
+      self.assertEqual(bucket_index(math.nextafter(upper, 0)), i)
+      # every bucket is within 1 / SUB_BUCKETS of the latencies in it
+      self.assertLessEqual(upper / lower, 1 + 1 / loop_latency.SUB_BUCKETS + 1e-9)
+      lower = upper
+
+    # the overflow bucket
+    self.assertEqual(bucket_index(2. ** MAX_EXP), NUM_BUCKETS)
+    self.assertEqual(bucket_index(1e9), NUM_BUCKETS)
+
+  def test_percentile(self):
+    hist = LatencyHistogram()
+    self.assertEqual(hist.percentile(50), 0.)
+    for ms in [1.] * 90 + [10.] * 9 + [100.]:
+      hist.record(ms)
+
+    self.assertEqual(hist.percentile(50), BUCKET_BOUNDS_MS[bucket_index(1.)])
+    self.assertEqual(hist.percentile(90), BUCKET_BOUNDS_MS[bucket_index(1.)])
+    self.assertEqual(hist.percentile(99), BUCKET_BOUNDS_MS[bucket_index(10.)])
+    # the max is more precise than the bucket bound
+    self.assertEqual(hist.percentile(100), 100.)
+    self.assertEqual(percentile(hist.counts, 100), BUCKET_BOUNDS_MS[bucket_index(100.)])
+    self.assertEqual((hist.count, hist.sum_ms, hist.max_ms), (100, 280., 100.))
+
+    # the overflow bucket has no upper bound, other than the max
+    hist.record(5000.)
+    self.assertEqual(hist.counts[NUM_BUCKETS], 1)
+    self.assertEqual(hist.percentile(100), 5000.)
+    self.assertEqual(percentile(hist.counts, 100), math.inf)
+
+  def test_loop(self):
+    sock = FakePubSocket()
+    t = [0.]
+    with mock.patch.object(loop_latency, "sec_since_boot", lambda: t[0]), \
+         mock.patch.object(messaging, "pub_sock", lambda service: sock):
+      latency = LoopLatency("controlsdLatency", interval=1.)
+      for _ in range(3):
+        t[0] += 0.010
+        latency.checkpoint("Wait", ignore=True)
+        t[0] += 0.0021
+        latency.checkpoint("Update")
+        t[0] += 0.0012
+        latency.checkpoint("Send")
+        latency.end_loop()
+
+      loop = latency.sections["loop"]
+      self.assertEqual(loop.count, 3)
+      self.assertAlmostEqual(loop.max_ms, 3.3)
+      self.assertAlmostEqual(latency.sections["Wait"].max_ms, 10.)
+      self.assertEqual(sock.sent, [])
+
+      # published and reset every interval
+      t[0] += 1.
+      latency.checkpoint("Wait", ignore=True)
+      latency.end_loop()
+    self.assertEqual(len(sock.sent), 1)
+    self.assertEqual(latency.sections["loop"].count, 0)
+
+    msg = messaging.log_from_bytes(sock.sent[0]).controlsdLatency
+    self.assertEqual(list(msg.bucketBoundsMs), BUCKET_BOUNDS_MS)
+    sections = {s.name: s for s in msg.sections}
+    self.assertEqual(set(sections), {"loop", "Wait", "Update", "Send"})
+    self.assertEqual(sections["loop"].count, 4)
+    self.assertEqual(sections["loop"].counts[bucket_index(3.3)], 3)
+    self.assertEqual(sections["loop"].counts[0], 1)
+    self.assertEqual(len(sections["loop"].counts), NUM_BUCKETS + 1)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+import gzip
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from common.logging_extra import SwagFormatter, SwagLogFileFormatter
+from selfdrive import swaglog
+from selfdrive.logmessaged import parse_frames
+from selfdrive.swaglog import COMPRESSED_EXT, MANIFEST_NAME, SwaglogRotatingFileHandler, UnixDomainSocketHandler, cloudlog, read_manifest
+
+
+class FakePushSocket():
+  def __init__(self):
+    self.sent = []
+
+  def send(self, dat, flags=0):
+    self.sent.append(dat)
+
+
+class TestSwaglogRotatingFileHandler(unittest.TestCase):
+  def setUp(self):
+    self.log_dir = tempfile.mkdtemp()
+    self.base_filename = os.path.join(self.log_dir, "swaglog")
+
+  def tearDown(self):
+    shutil.rmtree(self.log_dir)
+
+  def _handler(self, **kwargs):
+    handler = SwaglogRotatingFileHandler(self.base_filename, interval=0, **kwargs)
+    self.addCleanup(handler.close)
+    return handler
+
+  def _wait_compressed(self, handler, timeout=10):
+    start = time.monotonic()
+    while handler.compress_pending or not handler.compress_queue.empty():
+      self.assertLess(time.monotonic() - start, timeout)
+      time.sleep(0.01)
+    # the manifest is written after the file leaves compress_pending
+    time.sleep(0.1)
+
+  def _dir_files(self):
+    return {fn: os.path.getsize(os.path.join(self.log_dir, fn)) for fn in os.listdir(self.log_dir) if fn != MANIFEST_NAME}
+
+  def _write_log(self, name, dat=b"x\n"):
+    with open(os.path.join(self.log_dir, name), "wb") as f:
+      f.write(dat)
+
+  def test_byte_budget(self):
+    handler = self._handler(max_bytes=1000, max_total_bytes=5000)
+    for i in range(2000):
+      handler.emit_lines([os.urandom(32).hex()])
+    self._wait_compressed(handler)
+
+    files = self._dir_files()
+    manifest = dict(read_manifest(self.log_dir))
+    # the open file is in the manifest, but its size isn't known until it's closed
+    active = os.path.basename(handler.stream.name)
+    self.assertEqual(set(files), set(manifest))
+    self.assertEqual({fn: size for fn, size in files.items() if fn != active},
+                     {fn: size for fn, size in manifest.items() if fn != active})
+    self.assertLessEqual(sum(manifest.values()), 5000)
+    self.assertLessEqual(sum(files.values()), 5000 + 1000 + 65)
+    self.assertTrue(all(fn.endswith(COMPRESSED_EXT) for fn in files if fn != active))
+
+    # the oldest files were deleted
+    self.assertGreater(len(files), 1)
+    self.assertNotIn(f"swaglog.{0:010}{COMPRESSED_EXT}", files)
+
+  def test_backup_count(self):
+    handler = self._handler(max_bytes=10, backup_count=3, compress=False)
+    for i in range(10):
+      handler.emit_lines([f"line {i:05}"])
+    self.assertEqual(len(self._dir_files()), 3)
+    self.assertEqual(len(read_manifest(self.log_dir)), 3)
+
+  def test_reconcile_manifest(self):
+    handler = self._handler(max_bytes=10)
+    for i in range(3):
+      handler.emit_lines([f"line {i:05}"])
+    self._wait_compressed(handler)
+    handler.close()
+    last = handler.last_file_idx
+
+    # died after compressing and before writing the manifest
+    self._write_log(f"swaglog.{last+1:010}", b"orphan\n")
+    os.rename(os.path.join(self.log_dir, f"swaglog.{last+1:010}"), os.path.join(self.log_dir, f"swaglog.{last+1:010}{COMPRESSED_EXT}"))
+    # died before removing the compressed original
+    self._write_log(f"swaglog.{last+2:010}")
+    with gzip.open(os.path.join(self.log_dir, f"swaglog.{last+2:010}{COMPRESSED_EXT}"), "wb") as f:
+      f.write(b"x\n")
+    # died while compressing
+    self._write_log(f"swaglog.{last+3:010}")
+    self._write_log(f"swaglog.{last+3:010}{COMPRESSED_EXT}.tmp", b"partial")
+    # not a log file the manifest knows of, the directory isn't listed to find it
+    stray = f"swaglog.{last+10:010}"
+    self._write_log(stray)
+
+    with mock.patch("os.listdir", side_effect=AssertionError("listed the log dir")):
+      handler = self._handler(max_bytes=10)
+    self._wait_compressed(handler)
+
+    files = self._dir_files()
+    self.assertEqual(set(files) - {stray}, set(dict(read_manifest(self.log_dir))))
+    self.assertFalse(any(fn.endswith(".tmp") for fn in files))
+    self.assertNotIn(f"swaglog.{last+2:010}", files)
+    for idx in (last+1, last+2, last+3):
+      self.assertIn(f"swaglog.{idx:010}{COMPRESSED_EXT}", files)
+    self.assertEqual(os.path.basename(handler.stream.name), f"swaglog.{last+4:010}")
+
+    # the orphan now counts towards the budget
+    self.assertIn(os.path.join(self.log_dir, f"swaglog.{last+1:010}{COMPRESSED_EXT}"), handler.log_files)
+
+  def test_no_manifest(self):
+    self._write_log(f"swaglog.{0:010}")
+    self._write_log(f"swaglog.{1:010}{COMPRESSED_EXT}.tmp", b"partial")
+    self._write_log(f"swaglog.{1:010}")
+
+    handler = self._handler(max_bytes=10, compress=False)
+    self.assertEqual(set(handler.log_files), {f"{self.base_filename}.{i:010}" for i in range(3)})
+    self.assertNotIn(f"swaglog.{1:010}{COMPRESSED_EXT}.tmp", self._dir_files())
+
+  def test_budget_compression_behind(self):
+    release = threading.Event()
+    compress_log = swaglog.compress_log
+    def blocked_compress_log(path):
+      release.wait()
+      return compress_log(path)
+
+    with mock.patch("selfdrive.swaglog.compress_log", side_effect=blocked_compress_log):
+      handler = self._handler(max_bytes=1000, max_total_bytes=5000)
+      for i in range(2000):
+        handler.emit_lines([os.urandom(32).hex()])
+      # nothing compressed yet, the uncompressed files are deleted to stay within budget
+      self.assertLessEqual(sum(self._dir_files().values()), 5000 + 1000 + 65)
+      release.set()
+      self._wait_compressed(handler)
+
+
+class TestUnixDomainSocketHandler(unittest.TestCase):
+  def test_file_line_from_frame(self):
+    handler = UnixDomainSocketHandler(SwagFormatter(cloudlog))
+    handler.sock = FakePushSocket()
+    handler.pid = os.getpid()
+
+    record = cloudlog.makeRecord("swaglog", logging.WARNING, __file__, 1, {"event": "x", "n": {1: 2.5}}, (), None)
+    handler.emit(record)
+    self.assertEqual(len(handler.sock.sent), 1)
+
+    # the sender only sends the json record, logmessaged makes the file line from it
+    level, dat = parse_frames([handler.sock.sent[0]])
+    self.assertEqual(level, logging.WARNING)
+    self.assertEqual(json.loads(dat)["msg"], {"event": "x", "n": {"1": 2.5}})
+    line = json.loads(SwagLogFileFormatter(None).format(dat))
+    self.assertEqual(line["msg"], {"event$s": "x", "n": {"1$f": 2.5}})
+    self.assertIn("id", line)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,6 +1,21 @@
+import os
 from tools.lib.url_file import URLFile
 
 def FileReader(fn, debug=False):
   if fn.startswith("http://") or fn.startswith("https://"):
     return URLFile(fn, debug=debug)
   return open(fn, "rb")
+
+
+def read_all_into(f):
+  """Reads the rest of a file from FileReader into a single preallocated bytearray."""
+  if isinstance(f, URLFile):
+    size = f.get_length() - f.tell()
+  else:
+    size = os.fstat(f.fileno()).st_size - f.tell()
+
+  buf = bytearray(max(0, size))
+  n = f.readinto(buf)
+  if n < len(buf):
+    del buf[n:]
+  return buf
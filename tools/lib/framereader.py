@@ -2,15 +2,18 @@
 import json
 import os
 import pickle
+import queue
 import struct
 import subprocess
 import tempfile
 import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 
 import numpy as np
 from aenum import Enum
-from lru import LRU
 
 import _io
 from tools.lib.cache import cache_path_for_file_path
@@ -26,12 +29,57 @@ HEVC_SLICE_B = 0
 HEVC_SLICE_P = 1
 HEVC_SLICE_I = 2
 
+FRAME_CACHE_BYTES = int(os.getenv("FRAME_CACHE_BYTES", str(128 * 1024 * 1024)))
+
 
 class GOPReader:
   def get_gop(self, num):
     # returns (start_frame_num, num_frames, frames_to_skip, gop_data)
     raise NotImplementedError
 
+  def get_gop_span(self, num_b, num_e):
+    # like get_gop, for all the GOPs holding frames num_b to num_e - 1
+    raise NotImplementedError
+
+  def gop_starts(self):
+    # returns the first frame number of every GOP
+    raise NotImplementedError
+
+
+class ByteLRU:
+  """LRU cache bounded by the total nbytes of its values. Values larger than the
+     bound aren't cached.
+  """
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.nbytes = 0
+    self._d = OrderedDict()
+    self._lock = threading.Lock()
+
+  def __contains__(self, key):
+    with self._lock:
+      return key in self._d
+
+  def __getitem__(self, key):
+    with self._lock:
+      self._d.move_to_end(key)
+      return self._d[key]
+
+  def __setitem__(self, key, value):
+    with self._lock:
+      if key in self._d:
+        self.nbytes -= self._d.pop(key).nbytes
+      if value.nbytes > self.max_bytes:
+        return
+      self._d[key] = value
+      self.nbytes += value.nbytes
+      while self.nbytes > self.max_bytes:
+        self.nbytes -= self._d.popitem(last=False)[1].nbytes
+
+  def __len__(self):
+    with self._lock:
+      return len(self._d)
+
 
 class DoNothingContextManager:
   def __enter__(self):
@@ -209,6 +257,60 @@ def rgb24toyuv420(rgb):
   return yuv420.clip(0, 255).astype('uint8')
 
 
+def ffmpeg_decode_cmd(vid_fmt, pix_fmt, threads=None):
+  threads = threads if threads is not None else os.getenv("FFMPEG_THREADS", "0")
+  cuda = os.getenv("FFMPEG_CUDA", "0") == "1"
+  return ["ffmpeg",
+          "-threads", threads,
+          "-hwaccel", "none" if not cuda else "cuda",
+          "-c:v", "hevc",
+          "-vsync", "0",
+          "-f", vid_fmt,
+          "-flags2", "showall",
+          "-i", "pipe:0",
+          "-threads", threads,
+          "-f", "rawvideo",
+          "-pix_fmt", pix_fmt,
+          "pipe:1"]
+
+
+def frame_shape(w, h, pix_fmt):
+  if pix_fmt == "rgb24":
+    return (h, w, 3)
+  elif pix_fmt == "yuv420p":
+    return (h*w*3//2,)
+  elif pix_fmt == "yuv444p":
+    return (3, h, w)
+  else:
+    raise NotImplementedError
+
+
+def decompress_video_frames(rawdat, vid_fmt, w, h, pix_fmt, threads=None):
+  """Like decompress_video_data, but yields the frames one by one as ffmpeg outputs them."""
+  shape = frame_shape(w, h, pix_fmt)
+  out_size = int(np.prod(shape))
+
+  with tempfile.TemporaryFile() as tmpf:
+    tmpf.write(rawdat)
+    tmpf.seek(0)
+
+    proc = subprocess.Popen(ffmpeg_decode_cmd(vid_fmt, pix_fmt, threads),
+                            stdin=tmpf, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+      while True:
+        dat = proc.stdout.read(out_size)
+        if len(dat) == 0:
+          break
+        assert len(dat) == out_size
+        yield np.frombuffer(dat, dtype=np.uint8).reshape(shape)
+
+      if proc.wait() != 0:
+        raise DataUnreadableError("ffmpeg failed")
+    finally:
+      proc.kill()
+      proc.wait()
+
+
 def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt):
   # using a tempfile is much faster than proc.communicate for some reason
 
@@ -216,22 +318,8 @@ def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt):
     tmpf.write(rawdat)
     tmpf.seek(0)
 
-    threads = os.getenv("FFMPEG_THREADS", "0")
-    cuda = os.getenv("FFMPEG_CUDA", "0") == "1"
-    proc = subprocess.Popen(
-      ["ffmpeg",
-       "-threads", threads,
-       "-hwaccel", "none" if not cuda else "cuda",
-       "-c:v", "hevc",
-       "-vsync", "0",
-       "-f", vid_fmt,
-       "-flags2", "showall",
-       "-i", "pipe:0",
-       "-threads", threads,
-       "-f", "rawvideo",
-       "-pix_fmt", pix_fmt,
-       "pipe:1"],
-      stdin=tmpf, stdout=subprocess.PIPE, stderr=open("/dev/null"))
+    proc = subprocess.Popen(ffmpeg_decode_cmd(vid_fmt, pix_fmt),
+                            stdin=tmpf, stdout=subprocess.PIPE, stderr=open("/dev/null"))
 
     # dat = proc.communicate()[0]
     dat = proc.stdout.read()
@@ -266,18 +354,85 @@ class BaseFrameReader:
     raise NotImplementedError
 
 
-def FrameReader(fn, cache_prefix=None, readahead=False, readbehind=False, index_data=None):
+def FrameReader(fn, cache_prefix=None, readahead=False, readbehind=False, index_data=None, cache_decoded=False):
   frame_type = fingerprint_video(fn)
   if frame_type == FrameType.raw:
     return RawFrameReader(fn)
   elif frame_type in (FrameType.h265_stream,):
     if not index_data:
       index_data = get_video_index(fn, frame_type, cache_prefix)
-    return StreamFrameReader(fn, frame_type, index_data, readahead=readahead, readbehind=readbehind)
+    fr = StreamFrameReader(fn, frame_type, index_data, readahead=readahead, readbehind=readbehind)
+    return DecodedFrameReader(fr) if cache_decoded else fr
   else:
     raise NotImplementedError(frame_type)
 
 
+def decoded_cache_path(fn, pix_fmt):
+  return cache_path_for_file_path(fn) + f".{pix_fmt}.raw"
+
+
+def decoded_cache_key(fr, pix_fmt):
+  """Identifies the source a decoded cache was made from, the video index and, for local
+     files, their size and mtime.
+  """
+  key = [pix_fmt, fr.frame_count, fr.w, fr.h]
+  index = getattr(fr, 'index', None)
+  if index is not None:
+    key.append(zlib.crc32(np.ascontiguousarray(index).tobytes()))
+  if os.path.isfile(fr.fn):
+    st = os.stat(fr.fn)
+    key += [st.st_size, st.st_mtime_ns]
+  return key
+
+
+class DecodedFrameReader(BaseFrameReader):
+  """Decodes the whole video once per pixel format into the cache directory, and returns
+     frames as np.memmap views of that file after. The cache is decoded again when the
+     source changes, see decoded_cache_key.
+  """
+  def __init__(self, fr):
+    self.fr = fr
+    self.fn = fr.fn
+    self.frame_type = fr.frame_type
+    self.frame_count = fr.frame_count
+    self.w, self.h = fr.w, fr.h
+    self._frames = {}
+
+  def close(self):
+    self._frames = {}
+    self.fr.close()
+
+  def frames(self, pix_fmt="yuv420p"):
+    """Returns all frames of the video as a read only memmap."""
+    if pix_fmt not in self._frames:
+      shape = (self.frame_count,) + frame_shape(self.w, self.h, pix_fmt)
+      path = decoded_cache_path(self.fn, pix_fmt)
+      key = decoded_cache_key(self.fr, pix_fmt)
+      try:
+        with open(path + ".key") as f:
+          valid = json.load(f) == key and os.path.getsize(path) == int(np.prod(shape))
+      except (OSError, ValueError):
+        valid = False
+
+      if not valid:
+        with atomic_write_in_dir(path, mode="wb", overwrite=True) as f:
+          for frame in self.fr.iter_frames(pix_fmt=pix_fmt):
+            f.write(frame)
+        with atomic_write_in_dir(path + ".key", overwrite=True) as f:
+          json.dump(key, f)
+      self._frames[pix_fmt] = np.memmap(path, dtype=np.uint8, mode="r", shape=shape)
+    return self._frames[pix_fmt]
+
+  def get(self, num, count=1, pix_fmt="yuv420p"):
+    if num + count > self.frame_count:
+      raise ValueError("{} > {}".format(num + count, self.frame_count))
+    if pix_fmt not in ("yuv420p", "rgb24", "yuv444p"):
+      raise ValueError("Unsupported pixel format %r" % pix_fmt)
+
+    frames = self.frames(pix_fmt)
+    return [frames[i] for i in range(num, num + count)]
+
+
 class RawData:
   def __init__(self, f):
     self.f = _io.FileIO(f, 'rb')
@@ -447,24 +602,34 @@ class StreamGOPReader(GOPReader):
 
     return (frame_b, frame_e, offset_b, offset_e)
 
+  def gop_starts(self):
+    return [int(i) for i in np.flatnonzero(self.index[:-1, 0] == HEVC_SLICE_I)]
+
   def get_gop(self, num):
-    frame_b, frame_e, offset_b, offset_e = self._lookup_gop(num)
-    assert frame_b <= num < frame_e
+    return self.get_gop_span(num, num + 1)
+
+  def get_gop_span(self, num_b, num_e):
+    frame_b, _, offset_b, _ = self._lookup_gop(num_b)
+    _, frame_e, _, offset_e = self._lookup_gop(num_e - 1)
+    assert frame_b <= num_b < num_e <= frame_e
 
     num_frames = frame_e - frame_b
 
+    prefix = self.prefix
+    if num_b < self.first_iframe:
+      assert self.prefix_frame_data
+      prefix = prefix + self.prefix_frame_data
+
+    # read the GOP straight in after its prefix instead of concatenating copies
+    rawdat = bytearray(len(prefix) + offset_e - offset_b)
+    rawdat[:len(prefix)] = prefix
     with FileReader(self.fn) as f:
       f.seek(offset_b)
-      rawdat = f.read(offset_e - offset_b)
-
-      if num < self.first_iframe:
-        assert self.prefix_frame_data
-        rawdat = self.prefix_frame_data + rawdat
-
-      rawdat = self.prefix + rawdat
+      bytes_read = f.readinto(memoryview(rawdat)[len(prefix):])
+      assert bytes_read == offset_e - offset_b, (bytes_read, offset_e - offset_b)
 
     skip_frames = 0
-    if num < self.first_iframe:
+    if num_b < self.first_iframe:
       skip_frames = self.num_prefix_frames
 
     return frame_b, num_frames, skip_frames, rawdat
@@ -473,12 +638,12 @@ class StreamGOPReader(GOPReader):
 class GOPFrameReader(BaseFrameReader):
   #FrameReader with caching and readahead for formats that are group-of-picture based
 
-  def __init__(self, readahead=False, readbehind=False):
+  def __init__(self, readahead=False, readbehind=False, cache_bytes=None):
     self.open_ = True
 
     self.readahead = readahead
     self.readbehind = readbehind
-    self.frame_cache = LRU(64)
+    self.frame_cache = ByteLRU(cache_bytes if cache_bytes is not None else FRAME_CACHE_BYTES)
 
     if self.readahead:
       self.cache_lock = threading.RLock()
@@ -539,10 +704,17 @@ class GOPFrameReader(BaseFrameReader):
       ret = ret[skip_frames:]
       assert ret.shape[0] == num_frames
 
-      for i in range(ret.shape[0]):
-        self.frame_cache[(frame_b+i, pix_fmt)] = ret[i]
+      # a GOP can be larger than the cache, then only cache the frames from num on that fit,
+      # copied so they don't keep the whole GOP alive
+      fit = self.frame_cache.max_bytes // max(ret[0].nbytes, 1)
+      if num_frames <= fit:
+        for i in range(num_frames):
+          self.frame_cache[(frame_b+i, pix_fmt)] = ret[i]
+      else:
+        for i in range(num - frame_b, min(num_frames, num - frame_b + fit)):
+          self.frame_cache[(frame_b+i, pix_fmt)] = ret[i].copy()
 
-      return self.frame_cache[(num, pix_fmt)]
+      return ret[num - frame_b]
 
   def get(self, num, count=1, pix_fmt="yuv420p"):
     assert self.frame_count is not None
@@ -563,11 +735,82 @@ class GOPFrameReader(BaseFrameReader):
 
     return ret
 
+  def iter_frames(self, num=0, count=None, pix_fmt="yuv420p", workers=None, gops_per_span=2, max_queued_frames=64):
+    """Yields frames num to num+count-1 in order, decoding spans of GOPs in parallel.
+
+       Each worker runs one ffmpeg process per span of gops_per_span GOPs, and holds at
+       most max_queued_frames decoded frames that haven't been consumed yet.
+    """
+    count = self.frame_count - num if count is None else count
+    if num + count > self.frame_count:
+      raise ValueError("{} > {}".format(num + count, self.frame_count))
+    if count <= 0:
+      return
+    workers = workers or os.cpu_count()
+
+    starts = self.gop_starts() + [self.frame_count]
+    first = max(i for i, s in enumerate(starts) if s <= num)
+    last = min(i for i, s in enumerate(starts) if s >= num + count)
+    spans = [(starts[i], starts[min(i + gops_per_span, last)]) for i in range(first, last, gops_per_span)]
+
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=max_queued_frames) for _ in spans]
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+      # keep as many spans in flight as there are workers
+      for k in range(min(workers, len(spans))):
+        pool.submit(self._decode_span, spans[k], pix_fmt, queues[k], stop)
+
+      for k, (span_b, _) in enumerate(spans):
+        if k + workers < len(spans):
+          pool.submit(self._decode_span, spans[k + workers], pix_fmt, queues[k + workers], stop)
+
+        frame_num = span_b
+        while True:
+          frame = queues[k].get()
+          if frame is None:
+            break
+          if isinstance(frame, Exception):
+            raise frame
+          if num <= frame_num < num + count:
+            yield frame
+          frame_num += 1
+    finally:
+      stop.set()
+      pool.shutdown(wait=False)
+
+  def _decode_span(self, span, pix_fmt, q, stop):
+    def put(item):
+      while not stop.is_set():
+        try:
+          q.put(item, timeout=0.1)
+          return True
+        except queue.Full:
+          pass
+      return False
+
+    try:
+      frame_b, num_frames, skip_frames, rawdat = self.get_gop_span(*span)
+      # the frames are decoded in parallel across processes already
+      frames = decompress_video_frames(rawdat, self.vid_fmt, self.w, self.h, pix_fmt, threads="1")
+      decoded = 0
+      for i, frame in enumerate(frames):
+        if i < skip_frames:
+          continue
+        if not put(frame):
+          frames.close()
+          return
+        decoded += 1
+      assert decoded == num_frames, (decoded, num_frames)
+      put(None)
+    except Exception as e:
+      put(e)
+
 
 class StreamFrameReader(StreamGOPReader, GOPFrameReader):
-  def __init__(self, fn, frame_type, index_data, readahead=False, readbehind=False):
+  def __init__(self, fn, frame_type, index_data, readahead=False, readbehind=False, cache_bytes=None):
     StreamGOPReader.__init__(self, fn, frame_type, index_data)
-    GOPFrameReader.__init__(self, readahead, readbehind)
+    GOPFrameReader.__init__(self, readahead, readbehind, cache_bytes)
 
 
 def GOPFrameIterator(gop_reader, pix_fmt):
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+import os
+import sys
+from operator import attrgetter
+
+import numpy as np
+
+from cereal import log as capnp_log
+from common.file_helpers import atomic_write_in_dir
+from tools.lib.cache import cache_path_for_file_path
+from tools.lib.logreader import LogReader
+
+try:
+  import pyarrow as pa
+except ImportError:
+  pa = None
+
+COLUMN_TYPES = {
+  'bool': np.bool_,
+  'int8': np.int8,
+  'int16': np.int16,
+  'int32': np.int32,
+  'int64': np.int64,
+  'uint8': np.uint8,
+  'uint16': np.uint16,
+  'uint32': np.uint32,
+  'uint64': np.uint64,
+  'float32': np.float32,
+  'float64': np.float64,
+  # enums are stored as their raw value, see enum_names
+  'enum': np.uint16,
+}
+
+
+def _flatten(schema, prefix=""):
+  columns = []
+  for name, field in schema.fields.items():
+    # reading an inactive union member isn't allowed
+    if name.endswith("DEPRECATED") or field.proto.discriminantValue != 0xffff:
+      continue
+
+    if field.proto.which() == 'group':
+      columns += _flatten(field.schema, prefix + name + ".")
+      continue
+
+    typ = field.proto.slot.type.which()
+    if typ == 'struct':
+      columns += _flatten(field.schema, prefix + name + ".")
+    elif typ in COLUMN_TYPES:
+      columns.append((prefix + name, typ, field.schema.enumerants if typ == 'enum' else None))
+  return columns
+
+
+def _row_getter(names):
+  # attrgetter only returns a tuple for more than one name
+  if len(names) == 1:
+    getter = attrgetter(names[0])
+    return lambda x: (getter(x),)
+  elif len(names) == 0:
+    return lambda x: ()
+  return attrgetter(*names)
+
+
+def _is_list_service(service):
+  return capnp_log.Event.schema.fields[service].proto.slot.type.which() == 'list'
+
+
+def service_columns(service):
+  """Returns (name, type, enumerants) of every scalar field of a service.
+
+     Nested structs are flattened into dotted names, lists, text and data are left out.
+     Services that are lists, like can, get a row per element.
+  """
+  schema = capnp_log.Event.schema.fields[service].schema
+  if _is_list_service(service):
+    schema = schema.elementType
+  if not hasattr(schema, 'fields'):
+    raise ValueError(f"{service} isn't a struct or list of structs")
+  return _flatten(schema)
+
+
+def service_dtype(service):
+  return np.dtype([('logMonoTime', np.uint64)] + [(name, COLUMN_TYPES[typ]) for name, typ, _ in service_columns(service)])
+
+
+def enum_names(service, column):
+  """Returns the names of the raw values stored in an enum column.
+
+     Values from a newer schema than the local one have no name.
+  """
+  enumerants = next(e for name, _, e in service_columns(service) if name == column)
+  return {v: k for k, v in enumerants.items()}
+
+
+def events_to_columns(events, services):
+  """Flattens the events of each service into a structured array ordered like the events."""
+  columns = {s: service_columns(s) for s in services}
+  getters = {s: _row_getter([name for name, _, _ in cols]) for s, cols in columns.items()}
+  list_services = {s for s in services if _is_list_service(s)}
+  rows = {s: [] for s in services}
+
+  for ev in events:
+    which = str(ev.which())
+    if which not in rows:
+      continue
+
+    getter = getters[which]
+    if which in list_services:
+      rows[which] += [(ev.logMonoTime,) + getter(x) for x in getattr(ev, which)]
+    else:
+      rows[which].append((ev.logMonoTime,) + getter(getattr(ev, which)))
+
+  ret = {}
+  for s, cols in columns.items():
+    arr = np.empty(len(rows[s]), dtype=service_dtype(s))
+    if len(rows[s]):
+      values = list(zip(*rows[s]))
+      arr['logMonoTime'] = values[0]
+      for (name, typ, _), col in zip(cols, values[1:]):
+        # raw also works for values the local schema doesn't know, e.g. logs from a newer cereal
+        arr[name] = [v.raw for v in col] if typ == 'enum' else col
+    ret[s] = arr
+  return ret
+
+
+def columns_cache_path(fn, service):
+  return cache_path_for_file_path(fn) + f".{service}.npy"
+
+
+def log_columns(fn, services, cache=True):
+  """Returns a structured array per service for one log, cached next to the download cache."""
+  ret = {}
+  if cache:
+    for s in services:
+      path = columns_cache_path(fn, s)
+      if os.path.exists(path):
+        arr = np.load(path)
+        # the schema changed since it was cached
+        if arr.dtype == service_dtype(s):
+          ret[s] = arr
+
+  missing = [s for s in services if s not in ret]
+  if len(missing):
+    new = events_to_columns(LogReader(fn, services=missing), missing)
+    if cache:
+      for s, arr in new.items():
+        with atomic_write_in_dir(columns_cache_path(fn, s), mode="wb", overwrite=True) as f:
+          np.save(f, arr)
+    ret.update(new)
+  return ret
+
+
+def route_columns(log_paths, services, cache=True):
+  """Concatenates the columns of every log of a route, e.g. Route.log_paths()."""
+  per_log = [log_columns(fn, services, cache) for fn in log_paths if fn is not None]
+  return {s: np.concatenate([c[s] for c in per_log]) if len(per_log) else np.empty(0, dtype=service_dtype(s))
+          for s in services}
+
+
+def to_arrow(arr):
+  if pa is None:
+    raise ImportError("pyarrow is needed for arrow tables")
+  return pa.Table.from_arrays([arr[name] for name in arr.dtype.names], names=list(arr.dtype.names))
+
+
+if __name__ == "__main__":
+  if len(sys.argv) < 4:
+    print("Usage: ./logcolumns.py <log path> <out.npz> <service> [<service> ...]")
+    sys.exit(1)
+
+  cols = log_columns(sys.argv[1], sys.argv[3:])
+  np.savez(sys.argv[2], **cols)
+  for s, arr in cols.items():
+    print(f"{s}: {len(arr)} events, {len(arr.dtype.names)} columns")
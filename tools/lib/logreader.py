@@ -2,35 +2,333 @@
 import os
 import sys
 import bz2
+import struct
 import urllib.parse
 import capnp
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
 try:
   from xx.chffr.lib.filereader import FileReader
 except ImportError:
   from tools.lib.filereader import FileReader
+from tools.lib.filereader import read_all_into
 from cereal import log as capnp_log
+from common.file_helpers import atomic_write_in_dir
+from tools.lib.cache import cache_path_for_file_path
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+LOG_INDEX_DTYPE = np.dtype([('offset', np.uint64), ('size', np.uint32), ('logMonoTime', np.uint64), ('which', np.uint16)])
+
+EVENT_STRUCT = capnp_log.Event.schema.node.struct
+EVENT_WHICH = {f.name: f.discriminantValue for f in EVENT_STRUCT.fields if f.discriminantValue != 0xffff}
+UNKNOWN_WHICH = 0xffff
+# byte offsets in the data section of the Event struct
+MONO_TIME_OFFSET = 8 * next(f.slot.offset for f in EVENT_STRUCT.fields if f.name == 'logMonoTime')
+WHICH_OFFSET = 2 * EVENT_STRUCT.discriminantOffset
+
+
+def service_ids(services):
+  return np.array([EVENT_WHICH[s] for s in services], dtype=np.uint16)
+
+
+def _log_ext(fn):
+  _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
+  if ext not in ("", ".bz2"):
+    raise Exception(f"unknown extension {ext}")
+  return ext
+
+
+def _root_fields(dat, segment_start, segment_size):
+  """Reads logMonoTime and the union discriminant straight from the root struct of a message.
+
+     Returns None if the root isn't a plain struct pointer into the first segment.
+  """
+  if segment_size < 8:
+    return None
+  ptr = struct.unpack_from("<Q", dat, segment_start)[0]
+  if ptr & 3 != 0:
+    return None
+
+  offset = (ptr & 0xffffffff) >> 2
+  if offset & (1 << 29):
+    offset -= 1 << 30
+  data_start = 8 * (1 + offset)
+  data_size = 8 * ((ptr >> 32) & 0xffff)
+  if data_start < 0 or data_start + data_size > segment_size:
+    return None
+
+  # fields past the end of the data section have their default value of 0
+  data_start += segment_start
+  mono_time = struct.unpack_from("<Q", dat, data_start + MONO_TIME_OFFSET)[0] if data_size >= MONO_TIME_OFFSET + 8 else 0
+  which = struct.unpack_from("<H", dat, data_start + WHICH_OFFSET)[0] if data_size >= WHICH_OFFSET + 2 else 0
+  return mono_time, which
+
+
+def _decoded_fields(frame):
+  ent = next(capnp_log.Event.read_multiple_bytes(bytes(frame)))
+  try:
+    which = EVENT_WHICH.get(str(ent.which()), UNKNOWN_WHICH)
+  except capnp.lib.capnp.KjException:
+    which = UNKNOWN_WHICH
+  return ent.logMonoTime, which
+
+
+def _index_frames(dat, base_offset=0):
+  """Indexes the complete capnp messages at the start of dat without decoding them.
+
+     Returns the index, with offsets relative to base_offset, and the number of bytes indexed.
+  """
+  rows = []
+  pos, end = 0, len(dat)
+  while end - pos >= 4:
+    num_segments = struct.unpack_from("<I", dat, pos)[0] + 1
+    # segment table is a count followed by one size per segment, padded to a word
+    header_size = (4 * (num_segments + 1) + 7) & ~7
+    if end - pos < header_size:
+      break
+    segment_sizes = struct.unpack_from(f"<{num_segments}I", dat, pos + 4)
+    size = header_size + 8 * sum(segment_sizes)
+    if end - pos < size:
+      break
+
+    fields = _root_fields(dat, pos + header_size, 8 * segment_sizes[0])
+    if fields is None:
+      fields = _decoded_fields(dat[pos:pos + size])
+    rows.append((base_offset + pos, size) + fields)
+    pos += size
+  return np.array(rows, dtype=LOG_INDEX_DTYPE), pos
+
+
+def _select_frames(dat, index, ids, base_offset=0):
+  """Returns the entries of index for the services in ids, and their messages from dat."""
+  index = index[np.isin(index['which'], ids)]
+  offsets = (index['offset'] - base_offset).tolist()
+  return index, b"".join(dat[o:o + sz] for o, sz in zip(offsets, index['size'].tolist()))
+
+
+def _log_chunks(fn, chunk_size=STREAM_CHUNK_SIZE):
+  """Yields the decompressed contents of a log file, chunk by chunk."""
+  ext = _log_ext(fn)
+  with FileReader(fn) as f:
+    decompressor = bz2.BZ2Decompressor() if ext == ".bz2" else None
+    while True:
+      dat = f.read(chunk_size)
+      if len(dat) == 0:
+        break
+
+      if decompressor is None:
+        yield dat
+        continue
+
+      while len(dat):
+        yield decompressor.decompress(dat)
+        dat = b""
+        # multiple concatenated bz2 streams
+        if decompressor.eof:
+          dat = decompressor.unused_data
+          decompressor = bz2.BZ2Decompressor()
+
+
+def read_log_data(fn):
+  """Returns the decompressed contents of a log file."""
+  ext = _log_ext(fn)
+  with FileReader(fn) as f:
+    dat = read_all_into(f)
+
+  # old rlogs weren't bz2 compressed
+  if ext == ".bz2":
+    dat = bz2.decompress(dat)
+  return dat
+
+
+def _log_blocks(fn, start_offset=0):
+  """Yields runs of complete capnp messages as (index, block, block offset), with offsets being
+     positions in the decompressed log. Everything before start_offset is skipped unparsed.
+  """
+  buf = bytearray()
+  buf_offset = 0
+  for chunk in _log_chunks(fn):
+    if buf_offset + len(chunk) <= start_offset:
+      buf_offset += len(chunk)
+      continue
+
+    buf += chunk
+    if buf_offset < start_offset:
+      del buf[:start_offset - buf_offset]
+      buf_offset = start_offset
+
+    index, end = _index_frames(buf, buf_offset)
+    if end > 0:
+      yield index, bytes(buf[:end]), buf_offset
+      del buf[:end]
+      buf_offset += end
+
+  # a trailing partial message means the log was truncated while being written, drop it like loggerd would
+
+
+def _concat_indexes(indexes):
+  return np.concatenate(indexes) if len(indexes) else np.empty(0, dtype=LOG_INDEX_DTYPE)
+
+
+def log_index_path(fn):
+  return cache_path_for_file_path(fn) + ".index.npy"
+
+
+def save_log_index(fn, index):
+  with atomic_write_in_dir(log_index_path(fn), mode="wb", overwrite=True) as f:
+    np.save(f, index)
+  return index
+
+
+def get_log_index(fn, build=True):
+  """Returns the (offset, size, logMonoTime, which) index of a log, building and caching it if needed.
+
+     Offsets are positions in the decompressed log, so seeking with them skips decoding
+     every event before the offset, and which is the union discriminant of each event,
+     see service_ids.
+  """
+  path = log_index_path(fn)
+  if os.path.exists(path):
+    index = np.load(path)
+    if index.dtype == LOG_INDEX_DTYPE:
+      return index
+  if not build:
+    return None
+
+  return save_log_index(fn, _concat_indexes([index for index, _, _ in _log_blocks(fn)]))
+
+
+class LogPrefetcher(object):
+  """Downloads and decompresses the logs following the one being read in a process pool.
+
+     At most prefetch logs are held in memory ahead of the one requested.
+  """
+  def __init__(self, log_paths, prefetch=2, max_workers=None):
+    self._log_paths = log_paths
+    self._prefetch = prefetch
+    self._pool = ProcessPoolExecutor(max_workers=max_workers or prefetch)
+    self._futures = {}
+
+  def get(self, i):
+    """Returns the decompressed data of log i and starts loading the ones after it."""
+    upcoming = [j for j in range(i + 1, len(self._log_paths)) if self._log_paths[j] is not None][:self._prefetch]
+    for j in list(self._futures):
+      if j != i and j not in upcoming:
+        self._futures.pop(j).cancel()
+
+    fut = self._futures.pop(i, None)
+    if fut is None:
+      fut = self._pool.submit(read_log_data, self._log_paths[i])
+    for j in upcoming:
+      if j not in self._futures:
+        self._futures[j] = self._pool.submit(read_log_data, self._log_paths[j])
+    return fut.result()
+
+  def close(self):
+    for fut in self._futures.values():
+      fut.cancel()
+    self._futures.clear()
+    self._pool.shutdown(wait=False)
+
 
 # this is an iterator itself, and uses private variables from LogReader
 class MultiLogIterator(object):
-  def __init__(self, log_paths, wraparound=True):
+  def __init__(self, log_paths, wraparound=True, prefetch=0, max_workers=None, max_segments=None, services=None):
+    """Iterates over the events of consecutive logs.
+
+       prefetch > 0 loads that many of the upcoming logs in a process pool of max_workers
+       while the current one is read. max_segments bounds memory use by dropping the
+       oldest loaded logs, they are loaded again if seeked back to. services only reads
+       the events of those services, times are then relative to the first of them.
+    """
     self._log_paths = log_paths
     self._wraparound = wraparound
+    self._services = services
+    self._max_segments = max_segments
+    self._prefetcher = LogPrefetcher(log_paths, prefetch, max_workers) if prefetch > 0 else None
 
     self._first_log_idx = next(i for i in range(len(log_paths)) if log_paths[i] is not None)
     self._current_log = self._first_log_idx
     self._idx = 0
     self._log_readers = [None]*len(log_paths)
-    self.start_time = self._log_reader(self._first_log_idx)._ts[0]
+    self._loaded = []
+    self._log_times = [None]*len(log_paths)
+    self._wall_time_offset = None
+    # with services, the first segments may have none of their events
+    self._first_event_log = next((i for i in self._segments() if len(self._segment_times(i)[0])), None)
+    if self._first_event_log is None:
+      self.close()
+      raise ValueError(f"no events{'' if services is None else ' of ' + ', '.join(services)} in any log")
+    self._current_log = self._first_event_log
+    self.start_time = int(self._segment_times(self._current_log)[0][0])
 
   def _log_reader(self, i):
     if self._log_readers[i] is None and self._log_paths[i] is not None:
       log_path = self._log_paths[i]
       print("LogReader:%s" % log_path)
-      self._log_readers[i] = LogReader(log_path)
+      dat = self._prefetcher.get(i) if self._prefetcher is not None else None
+      self._log_readers[i] = LogReader(log_path, dat=dat, services=self._services)
+
+      self._loaded.append(i)
+      if self._max_segments is not None and len(self._loaded) > self._max_segments:
+        self._log_readers[self._loaded.pop(0)] = None
 
     return self._log_readers[i]
 
+  def close(self):
+    if self._prefetcher is not None:
+      self._prefetcher.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def _segment_times(self, i):
+    """Returns (logMonoTime, running max of logMonoTime) for the events of segment i.
+
+       Events are only roughly ordered by logMonoTime, the running max is sorted so it
+       can be bisected, and its first entry >= t is the first event at or after t.
+    """
+    if self._log_times[i] is None:
+      if self._log_readers[i] is not None:
+        ts = self._log_readers[i]._ts
+      else:
+        # use a cached index if there is one, so segments can be skipped without decoding them
+        index = get_log_index(self._log_paths[i], build=False)
+        if index is None:
+          ts = self._log_reader(i)._ts
+        else:
+          if self._services is not None:
+            index = index[np.isin(index['which'], service_ids(self._services))]
+          ts = index['logMonoTime'].astype(np.int64)
+      self._log_times[i] = (ts, np.maximum.accumulate(ts))
+    return self._log_times[i]
+
+  def _segments(self, start=None):
+    start = self._first_log_idx if start is None else start
+    return [i for i in range(start, len(self._log_paths)) if self._log_paths[i] is not None]
+
+  def _time_bounds(self, i):
+    ts_max = self._segment_times(i)[1]
+    if len(ts_max) == 0:
+      # no events after filtering by service, never a match
+      return float('inf'), float('-inf')
+    return ts_max[0], ts_max[-1]
+
+  def _find_segment(self, mono_time):
+    """Returns the index of the first segment with events at or after mono_time, or None."""
+    segments = self._segments()
+    # segments are about a minute long, start from the best guess and walk from there
+    guess = min(max(int((mono_time - self.start_time) / 60e9), 0), len(segments) - 1)
+    while guess > 0 and self._time_bounds(segments[guess])[0] > mono_time:
+      guess -= 1
+    while guess < len(segments) and self._time_bounds(segments[guess])[1] < mono_time:
+      guess += 1
+    return segments[guess] if guess < len(segments) else None
+
   def __iter__(self):
     return self
 
@@ -41,11 +339,12 @@ class MultiLogIterator(object):
     else:
       self._idx = 0
       self._current_log = next(i for i in range(self._current_log + 1, len(self._log_readers) + 1)
-                               if i == len(self._log_readers) or self._log_paths[i] is not None)
+                               if i == len(self._log_readers) or
+                               (self._log_paths[i] is not None and len(self._segment_times(i)[0])))
       # wraparound
       if self._current_log == len(self._log_readers):
         if self._wraparound:
-          self._current_log = self._first_log_idx
+          self._current_log = self._first_event_log
         else:
           raise StopIteration
 
@@ -61,43 +360,129 @@ class MultiLogIterator(object):
     return (self._log_reader(self._current_log)._ts[self._idx] - self.start_time) * 1e-9
 
   def seek(self, ts):
-    # seek to nearest minute
-    minute = int(ts/60)
-    if minute >= len(self._log_paths) or self._log_paths[minute] is None:
-      return False
+    # seek to seconds from start of log
+    return self.seek_mono_time(self.start_time + int(ts * 1e9))
 
-    self._current_log = minute
+  def seek_mono_time(self, mono_time):
+    """Seeks to the first event with logMonoTime >= mono_time."""
+    seg = self._find_segment(mono_time)
+    if seg is None:
+      return False
 
-    # HACK: O(n) seek afterward
-    self._idx = 0
-    while self.tell() < ts:
-      self._inc()
+    self._current_log = seg
+    self._idx = int(np.searchsorted(self._segment_times(seg)[1], mono_time))
     return True
 
+  def seek_wall_time(self, wall_time_nanos):
+    """Seeks to the first event at or after a wall time, mapped to logMonoTime with the
+       first clocks event of the route.
+    """
+    if self._wall_time_offset is None:
+      if self._services is None or 'clocks' in self._services:
+        ents = self._log_reader(self._first_log_idx)._ents
+      else:
+        # filtered out of the loaded logs, only decode the clocks events
+        ents = LogReader(self._log_paths[self._first_log_idx], services=['clocks'])._ents
+      clocks = next((m for m in ents if m.which() == 'clocks'), None)
+      if clocks is None:
+        raise Exception("no clocks event to map wall time to logMonoTime")
+      self._wall_time_offset = clocks.clocks.wallTimeNanos - clocks.logMonoTime
+    return self.seek_mono_time(wall_time_nanos - self._wall_time_offset)
+
+  def seek_index(self, idx):
+    """Seeks to the idx-th event of the route."""
+    for seg in self._segments():
+      count = len(self._segment_times(seg)[0])
+      if idx < count:
+        self._current_log = seg
+        self._idx = idx
+        return True
+      idx -= count
+    return False
+
+  def iter_range(self, t0, t1):
+    """Iterates over the events between t0 and t1 seconds from the start of the log
+       without changing the position of the iterator.
+    """
+    t0, t1 = self.start_time + int(t0 * 1e9), self.start_time + int(t1 * 1e9)
+    seg = self._find_segment(t0)
+    if seg is None:
+      return
+
+    for seg in self._segments(seg):
+      ts = self._segment_times(seg)[0]
+      if len(ts) == 0:
+        continue
+      if ts.min() >= t1:
+        break
+
+      # events are only roughly ordered, so events in the range can come after one past t1
+      idxs = np.flatnonzero((ts >= t0) & (ts < t1))
+      if len(idxs):
+        ents = self._log_reader(seg)._ents
+        for i in idxs.tolist():
+          yield ents[i]
+
 
 class LogReader(object):
-  def __init__(self, fn, canonicalize=True, only_union_types=False):
-    data_version = None
-    _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
-    with FileReader(fn) as f:
-      dat = f.read()
-
-    if ext == "":
-      # old rlogs weren't bz2 compressed
-      ents = capnp_log.Event.read_multiple_bytes(dat)
-    elif ext == ".bz2":
-      dat = bz2.decompress(dat)
-      ents = capnp_log.Event.read_multiple_bytes(dat)
-    else:
-      raise Exception(f"unknown extension {ext}")
+  def __init__(self, fn, canonicalize=True, only_union_types=False, streaming=False, write_index=False, dat=None,
+               services=None):
+    """Reads all events of a log.
 
-    self._ents = list(ents)
-    self._ts = [x.logMonoTime for x in self._ents]
+       With streaming=True nothing is read up front, events are decompressed and decoded
+       as they are iterated over. write_index saves an index of the log next to the download
+       cache, see get_log_index. dat is the already decompressed log data, e.g. from a
+       LogPrefetcher. services only decodes the events of those services, picked out with
+       the log index.
+    """
+    data_version = None
+    self._fn = fn
+    self._streaming = streaming
+    self._write_index = write_index
+    self._service_ids = service_ids(services) if services is not None else None
     self.data_version = data_version
     self._only_union_types = only_union_types
 
-  def __iter__(self):
-    for ent in self._ents:
+    _log_ext(fn)
+    if streaming:
+      return
+
+    if dat is None:
+      dat = read_log_data(fn)
+
+    index = None
+    if self._service_ids is not None or write_index:
+      index = get_log_index(fn, build=False)
+      if index is None:
+        index, _ = _index_frames(dat)
+        if write_index:
+          save_log_index(fn, index)
+    if self._service_ids is not None:
+      index, dat = _select_frames(dat, index, self._service_ids)
+
+    ents = capnp_log.Event.read_multiple_bytes(dat)
+
+    self._ents = list(ents)
+    if index is not None:
+      self._ts = index['logMonoTime'].astype(np.int64)
+    else:
+      self._ts = np.array([x.logMonoTime for x in self._ents], dtype=np.int64)
+
+  def _stream(self, start_offset=0):
+    write_index = self._write_index and start_offset == 0 and get_log_index(self._fn, build=False) is None
+    indexes = []
+    for index, block, block_offset in _log_blocks(self._fn, start_offset):
+      if write_index:
+        indexes.append(index)
+      if self._service_ids is not None:
+        index, block = _select_frames(block, index, self._service_ids, block_offset)
+      yield from capnp_log.Event.read_multiple_bytes(block)
+
+    if write_index:
+      save_log_index(self._fn, _concat_indexes(indexes))
+
+  def _filter(self, ents):
+    for ent in ents:
       if self._only_union_types:
         try:
           ent.which()
@@ -107,6 +492,23 @@ class LogReader(object):
       else:
         yield ent
 
+  def __iter__(self):
+    return self._filter(self._stream() if self._streaming else self._ents)
+
+  def iter_from(self, i):
+    """Iterates over the events starting at the i-th one, using the log index to skip
+       decoding everything before it.
+    """
+    if not self._streaming:
+      return self._filter(self._ents[i:])
+
+    index = get_log_index(self._fn)
+    if self._service_ids is not None:
+      index = index[np.isin(index['which'], self._service_ids)]
+    if i >= len(index):
+      return iter(())
+    return self._filter(self._stream(int(index['offset'][i])))
+
 if __name__ == "__main__":
   import codecs
   # capnproto <= 0.8.0 throws errors converting byte data to string
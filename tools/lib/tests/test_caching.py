@@ -1,10 +1,99 @@
 #!/usr/bin/env python3
 import os
+import re
 import shutil
+import threading
 import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 os.environ["COMMA_CACHE"] = "/tmp/__test_cache__"
-from tools.lib.url_file import URLFile, CACHE_DIR
+from tools.lib import url_file
+from tools.lib.url_file import URLFile, CACHE_DIR, CHUNK_SIZE, DownloadCache
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+  data = b""
+  ranges = []
+
+  def log_message(self, *args):
+    pass
+
+  def do_HEAD(self):
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(self.data)))
+    self.end_headers()
+
+  def do_GET(self):
+    m = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+    if m is None:
+      self.send_response(200)
+      body = self.data
+    else:
+      start, end = int(m.group(1)), int(m.group(2))
+      self.ranges.append((start, end))
+      self.send_response(206)
+      body = self.data[start:end + 1]
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+
+class TestLocalFileDownload(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    RangeHandler.data = os.urandom(5 * CHUNK_SIZE + 1234)
+    cls.server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}/fcamera.hevc"
+    threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.server.shutdown()
+
+  def setUp(self):
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+    RangeHandler.ranges = []
+    url_file._download_cache = None
+
+  def test_parallel_read(self):
+    f = URLFile(self.url, cache=True, parallelism=2)
+    self.assertEqual(f.read(), RangeHandler.data)
+    # six chunks coalesced into one request per connection
+    self.assertEqual(len(RangeHandler.ranges), 2)
+
+    f = URLFile(self.url, cache=True)
+    f.seek(CHUNK_SIZE - 10)
+    self.assertEqual(f.read(ll=2 * CHUNK_SIZE), RangeHandler.data[CHUNK_SIZE - 10:3 * CHUNK_SIZE - 10])
+    self.assertEqual(len(RangeHandler.ranges), 2)
+
+    f.seek(len(RangeHandler.data) - 1)
+    self.assertEqual(f.read(ll=100), RangeHandler.data[-1:])
+
+  def test_readinto(self):
+    for cache in (False, True):
+      f = URLFile(self.url, cache=cache, parallelism=3)
+      f.seek(100)
+      buf = bytearray(4 * CHUNK_SIZE)
+      self.assertEqual(f.readinto(buf), len(buf))
+      self.assertEqual(buf, RangeHandler.data[100:100 + len(buf)])
+      self.assertEqual(f.tell(), 100 + len(buf))
+
+      # short read at the end of the file
+      remaining = len(RangeHandler.data) - f.tell()
+      self.assertEqual(f.readinto(buf), remaining)
+      self.assertEqual(buf[:remaining], RangeHandler.data[-remaining:])
+
+  def test_eviction(self):
+    url_file._download_cache = DownloadCache(CACHE_DIR, 2 * CHUNK_SIZE)
+    f = URLFile(self.url, cache=True, parallelism=3)
+    self.assertEqual(f.read(), RangeHandler.data)
+    self.assertLessEqual(url_file.get_download_cache().total_bytes, 2 * CHUNK_SIZE)
+
+    # evicted chunks are downloaded again
+    RangeHandler.ranges = []
+    f.seek(0)
+    self.assertEqual(f.read(ll=10), RangeHandler.data[:10])
+    self.assertEqual(RangeHandler.ranges, [(0, CHUNK_SIZE - 1)])
 
 
 class TestFileDownload(unittest.TestCase):
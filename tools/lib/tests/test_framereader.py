@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from tools.lib import framereader
+from tools.lib.framereader import ByteLRU, DecodedFrameReader, GOPFrameReader, GOPReader, decoded_cache_path, frame_shape
+
+W, H = 8, 4
+
+
+class FakeFrameReader(GOPReader, GOPFrameReader):
+  """GOPs of gop_size frames, each frame filled with its number, plus the first byte of
+     fn if it exists. The "video" has one byte per frame, decoded without ffmpeg, see
+     decompress_video_data.
+  """
+  def __init__(self, frame_count=23, gop_size=5, cache_bytes=None, fn="fake.hevc"):
+    self.fn = fn
+    self.frame_type = framereader.FrameType.h265_stream
+    self.vid_fmt = "hevc"
+    self.w, self.h = W, H
+    self.frame_count = frame_count
+    self.gop_size = gop_size
+    self.gop_spans = []
+    GOPFrameReader.__init__(self, cache_bytes=cache_bytes)
+
+  def gop_starts(self):
+    return list(range(0, self.frame_count, self.gop_size))
+
+  def get_gop(self, num):
+    return self.get_gop_span(num, num + 1)
+
+  def get_gop_span(self, num_b, num_e):
+    frame_b = num_b - num_b % self.gop_size
+    frame_e = min(self.frame_count, (num_e - 1) - (num_e - 1) % self.gop_size + self.gop_size)
+    self.gop_spans.append((frame_b, frame_e))
+    base = 0
+    if os.path.isfile(self.fn):
+      with open(self.fn, "rb") as f:
+        base = f.read(1)[0]
+    return frame_b, frame_e - frame_b, 0, bytes((base + i) % 256 for i in range(frame_b, frame_e))
+
+
+def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt):
+  shape = frame_shape(w, h, pix_fmt)
+  return np.repeat(np.frombuffer(rawdat, dtype=np.uint8), int(np.prod(shape))).reshape((-1,) + shape)
+
+
+def decompress_video_frames(rawdat, vid_fmt, w, h, pix_fmt, threads=None):
+  yield from decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt)
+
+
+@mock.patch.object(framereader, "decompress_video_data", decompress_video_data)
+@mock.patch.object(framereader, "decompress_video_frames", decompress_video_frames)
+class TestGOPFrameReader(unittest.TestCase):
+  def test_get(self):
+    fr = FakeFrameReader()
+    frames = fr.get(3, 4)
+    self.assertEqual([int(f[0]) for f in frames], [3, 4, 5, 6])
+    self.assertEqual(frames[0].shape, frame_shape(W, H, "yuv420p"))
+
+    # the whole GOPs are cached
+    self.assertEqual(fr.gop_spans, [(0, 5), (5, 10)])
+    fr.get(9)
+    self.assertEqual(len(fr.gop_spans), 2)
+    self.assertEqual(len(fr.frame_cache), 10)
+
+  def test_gop_larger_than_cache(self):
+    frame_bytes = int(np.prod(frame_shape(W, H, "rgb24")))
+    fr = FakeFrameReader(cache_bytes=2 * frame_bytes)
+    self.assertEqual(int(fr.get(1, pix_fmt="rgb24")[0][0, 0, 0]), 1)
+    self.assertEqual(len(fr.frame_cache), 2)
+    self.assertEqual(int(fr.get(2, pix_fmt="rgb24")[0][0, 0, 0]), 2)
+    self.assertEqual(len(fr.gop_spans), 1)
+
+    fr = FakeFrameReader(cache_bytes=frame_bytes // 2)
+    self.assertEqual(int(fr.get(4, pix_fmt="rgb24")[0][0, 0, 0]), 4)
+    self.assertEqual(len(fr.frame_cache), 0)
+
+  def test_iter_frames(self):
+    fr = FakeFrameReader()
+    for num, count in [(0, None), (7, 9), (20, 3), (12, 1)]:
+      count = fr.frame_count - num if count is None else count
+      expected = fr.get(num, count, pix_fmt="rgb24")
+      frames = list(fr.iter_frames(num, count, pix_fmt="rgb24", workers=3, gops_per_span=2, max_queued_frames=2))
+      self.assertEqual(len(frames), count)
+      for a, b in zip(frames, expected):
+        np.testing.assert_array_equal(a, b)
+
+    with self.assertRaises(ValueError):
+      list(fr.iter_frames(20, 4))
+
+  def test_get_gop_span(self):
+    fr = FakeFrameReader()
+    fr.gop_spans = []
+    list(fr.iter_frames(7, 9, gops_per_span=2))
+    # frames 7 to 15 are in GOPs 1 to 3, decoded as spans of two GOPs
+    self.assertEqual(sorted(fr.gop_spans), [(5, 15), (15, 20)])
+
+
+@mock.patch.object(framereader, "decompress_video_data", decompress_video_data)
+@mock.patch.object(framereader, "decompress_video_frames", decompress_video_frames)
+class TestDecodedFrameReader(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.fn = os.path.join(self.tmp, "fcamera.hevc")
+    with open(self.fn, "wb") as f:
+      f.write(b"\x00")
+
+  def tearDown(self):
+    for pix_fmt in ("yuv420p", "rgb24"):
+      for path in (decoded_cache_path(self.fn, pix_fmt), decoded_cache_path(self.fn, pix_fmt) + ".key"):
+        if os.path.exists(path):
+          os.remove(path)
+    shutil.rmtree(self.tmp)
+
+  def test_cached_matches_decoded(self):
+    fresh = FakeFrameReader(fn=self.fn)
+    expected = fresh.get(0, fresh.frame_count, pix_fmt="rgb24")
+
+    fr = DecodedFrameReader(FakeFrameReader(fn=self.fn))
+    for i, frame in enumerate(fr.get(0, fr.frame_count, pix_fmt="rgb24")):
+      np.testing.assert_array_equal(frame, expected[i])
+    self.assertTrue(os.path.exists(decoded_cache_path(self.fn, "rgb24")))
+
+    # a new reader maps the cache without decoding
+    inner = FakeFrameReader(fn=self.fn)
+    fr = DecodedFrameReader(inner)
+    np.testing.assert_array_equal(fr.get(17, pix_fmt="rgb24")[0], expected[17])
+    self.assertEqual(inner.gop_spans, [])
+
+  def test_invalidated_when_source_changes(self):
+    fr = DecodedFrameReader(FakeFrameReader(fn=self.fn))
+    self.assertEqual(int(fr.get(3)[0][0]), 3)
+
+    with open(self.fn, "wb") as f:
+      f.write(b"\x64")
+    st = os.stat(self.fn)
+    os.utime(self.fn, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+
+    inner = FakeFrameReader(fn=self.fn)
+    fr = DecodedFrameReader(inner)
+    self.assertEqual(int(fr.get(3)[0][0]), 103)
+    self.assertNotEqual(inner.gop_spans, [])
+
+
+class TestByteLRU(unittest.TestCase):
+  def test_eviction(self):
+    lru = ByteLRU(max_bytes=30)
+    for i in range(3):
+      lru[i] = np.zeros(10, dtype=np.uint8)
+    self.assertEqual((len(lru), lru.nbytes), (3, 30))
+
+    # touching 0 makes 1 the least recently used
+    lru[0]
+    lru[3] = np.zeros(10, dtype=np.uint8)
+    self.assertNotIn(1, lru)
+    self.assertIn(0, lru)
+
+    lru[4] = np.zeros(20, dtype=np.uint8)
+    self.assertEqual(sorted(lru._d), [3, 4])
+    self.assertEqual(lru.nbytes, 30)
+
+    # replacing a key doesn't count it twice
+    lru[4] = np.zeros(5, dtype=np.uint8)
+    self.assertEqual(lru.nbytes, 15)
+
+  def test_too_large(self):
+    lru = ByteLRU(max_bytes=10)
+    lru[0] = np.zeros(5, dtype=np.uint8)
+    lru[1] = np.zeros(11, dtype=np.uint8)
+    self.assertNotIn(1, lru)
+    self.assertEqual((len(lru), lru.nbytes), (1, 5))
+
+    # a too large value still replaces the old one
+    lru[0] = np.zeros(11, dtype=np.uint8)
+    self.assertEqual((len(lru), lru.nbytes), (0, 0))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import unittest
+
+from cereal import log as capnp_log
+from tools.lib.logcolumns import columns_cache_path, enum_names, events_to_columns, log_columns
+from tools.lib.logreader import LogReader
+from tools.lib.tests.test_logreader import make_log
+
+
+class TestLogColumns(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.fn = os.path.join(self.tmp, "rlog.bz2")
+    make_log(self.fn, 200)
+
+  def tearDown(self):
+    for s in ("carState", "can"):
+      if os.path.exists(columns_cache_path(self.fn, s)):
+        os.remove(columns_cache_path(self.fn, s))
+    shutil.rmtree(self.tmp)
+
+  def test_columns(self):
+    cols = log_columns(self.fn, ["carState"])
+    self.assertTrue(os.path.exists(columns_cache_path(self.fn, "carState")))
+
+    cs = cols["carState"]
+    msgs = [m for m in LogReader(self.fn) if m.which() == "carState"]
+    self.assertEqual(len(cs), len(msgs))
+    self.assertEqual(list(cs["logMonoTime"]), [m.logMonoTime for m in msgs])
+    self.assertEqual(list(cs["vEgo"]), [m.carState.vEgo for m in msgs])
+    self.assertIn("cruiseState.speed", cs.dtype.names)
+    self.assertEqual(enum_names("carState", "gearShifter")[cs["gearShifter"][0]], "unknown")
+
+    # second load comes from the cache
+    cached = log_columns(self.fn, ["carState", "can"])
+    self.assertTrue((cached["carState"] == cs).all())
+    self.assertEqual(len(cached["can"]), 100)
+
+  def test_unknown_enum_value(self):
+    # a value only a newer schema would know
+    msg = capnp_log.Event.new_message()
+    msg.init('carState').gearShifter = 200
+    with capnp_log.Event.from_bytes(msg.to_bytes()) as ev:
+      cs = events_to_columns([ev], ["carState"])["carState"]
+    self.assertEqual(cs["gearShifter"][0], 200)
+    self.assertNotIn(200, enum_names("carState", "gearShifter"))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+import bz2
+import os
+import shutil
+import tempfile
+import unittest
+
+from cereal import log as capnp_log
+from tools.lib.logreader import LogReader, MultiLogIterator, get_log_index, log_index_path, service_ids
+
+
+def make_log(fn, n=2000, start_time=1000, dt=10, can_only=False, times=None, wall_time_offset=None):
+  dat = b""
+  for i in range(n):
+    msg = capnp_log.Event.new_message()
+    msg.logMonoTime = start_time + i * dt if times is None else times[i]
+    if i == 0 and wall_time_offset is not None:
+      msg.init('clocks').wallTimeNanos = msg.logMonoTime + wall_time_offset
+    elif i % 2 and not can_only:
+      msg.init('carState').vEgo = i
+    else:
+      msg.init('can', 1)[0].address = i
+    dat += msg.to_bytes()
+
+  if fn.endswith(".bz2"):
+    dat = bz2.compress(dat)
+  with open(fn, "wb") as f:
+    f.write(dat)
+
+
+class TestLogReader(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.fn = os.path.join(self.tmp, "rlog.bz2")
+    make_log(self.fn)
+
+  def tearDown(self):
+    if os.path.exists(log_index_path(self.fn)):
+      os.remove(log_index_path(self.fn))
+    shutil.rmtree(self.tmp)
+
+  def test_streaming_matches_eager(self):
+    eager = [m.as_builder().to_bytes() for m in LogReader(self.fn)]
+    streamed = [m.as_builder().to_bytes() for m in LogReader(self.fn, streaming=True)]
+    self.assertEqual(len(eager), 2000)
+    self.assertEqual(eager, streamed)
+
+  def test_uncompressed(self):
+    fn = os.path.join(self.tmp, "rlog")
+    make_log(fn, 100)
+    self.assertEqual([m.logMonoTime for m in LogReader(fn, streaming=True)], [m.logMonoTime for m in LogReader(fn)])
+
+  def test_index(self):
+    self.assertFalse(os.path.exists(log_index_path(self.fn)))
+    list(LogReader(self.fn, streaming=True, write_index=True))
+    self.assertTrue(os.path.exists(log_index_path(self.fn)))
+
+    index = get_log_index(self.fn, build=False)
+    self.assertEqual(len(index), 2000)
+    self.assertEqual(list(index['logMonoTime'][:3]), [1000, 1010, 1020])
+
+    lr = LogReader(self.fn, streaming=True)
+    self.assertEqual([m.logMonoTime for m in lr.iter_from(1500)], list(index['logMonoTime'][1500:]))
+
+  def test_services(self):
+    all_msgs = list(LogReader(self.fn))
+    expected = [m.logMonoTime for m in all_msgs if m.which() == 'carState']
+    self.assertEqual(len(expected), 1000)
+
+    for write_index in (False, True):
+      for streaming in (False, True):
+        lr = LogReader(self.fn, streaming=streaming, services=['carState'], write_index=write_index)
+        msgs = list(lr)
+        self.assertTrue(all(m.which() == 'carState' for m in msgs))
+        self.assertEqual([m.logMonoTime for m in msgs], expected)
+
+    index = get_log_index(self.fn, build=False)
+    self.assertEqual(list(index['which'][:2]), [service_ids(['can'])[0], service_ids(['carState'])[0]])
+
+
+class TestMultiLogIterator(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    # three one minute segments with an event every 100ms
+    self.log_paths = []
+    for seg in range(3):
+      fn = os.path.join(self.tmp, f"{seg}_rlog.bz2")
+      make_log(fn, 600, start_time=int(seg * 60e9), dt=int(1e8))
+      self.log_paths.append(fn)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def test_seek(self):
+    lr = MultiLogIterator(self.log_paths, wraparound=False)
+    self.assertTrue(lr.seek(90.05))
+    self.assertAlmostEqual(lr.tell(), 90.1)
+    self.assertEqual(next(lr).logMonoTime, int(90.1e9))
+
+    self.assertTrue(lr.seek_mono_time(int(10e9)))
+    self.assertEqual(next(lr).logMonoTime, int(10e9))
+
+    self.assertTrue(lr.seek_index(1250))
+    self.assertEqual(next(lr).logMonoTime, int(125e9))
+
+    self.assertFalse(lr.seek(200))
+    self.assertFalse(lr.seek_index(1800))
+
+  def test_iter_range(self):
+    lr = MultiLogIterator(self.log_paths, wraparound=False)
+    ts = [m.logMonoTime for m in lr.iter_range(59.5, 61)]
+    self.assertEqual(ts, [int(t * 1e8) for t in range(595, 610)])
+    self.assertEqual(lr.tell(), 0)
+
+  def test_iter_range_out_of_order(self):
+    # an event in the range logged after one past the end of it
+    times = [int(t * 1e8) for t in range(600)]
+    times[598], times[599] = times[599], times[598]
+    make_log(self.log_paths[0], 600, times=times)
+    lr = MultiLogIterator(self.log_paths, wraparound=False)
+    ts = [m.logMonoTime for m in lr.iter_range(59.5, 59.85)]
+    self.assertEqual(ts, [int(t * 1e8) for t in range(595, 599)])
+
+  def test_seek_wall_time(self):
+    offset = int(1.6e18)
+    make_log(self.log_paths[0], 600, start_time=0, dt=int(1e8), wall_time_offset=offset)
+    for services in (None, ['carState']):
+      lr = MultiLogIterator(self.log_paths, wraparound=False, services=services)
+      self.assertTrue(lr.seek_wall_time(offset + int(90.05e9)))
+      self.assertEqual(next(lr).logMonoTime, int(90.1e9))
+
+    make_log(self.log_paths[0], 600, start_time=0, dt=int(1e8))
+    with self.assertRaises(Exception):
+      MultiLogIterator(self.log_paths, services=['carState']).seek_wall_time(offset)
+
+  def test_services(self):
+    lr = MultiLogIterator(self.log_paths, wraparound=False, services=['carState'])
+    self.assertEqual(lr.start_time, int(1e8))
+    self.assertTrue(lr.seek(60))
+    self.assertEqual(next(lr).logMonoTime, int(60.1e9))
+
+    expected = [m.logMonoTime for m in MultiLogIterator(self.log_paths, wraparound=False)
+                if m.which() == 'carState' and m.logMonoTime > int(60.1e9)]
+    self.assertEqual([m.logMonoTime for m in lr], expected)
+
+  def test_services_missing_from_segments(self):
+    make_log(self.log_paths[0], 600, start_time=0, dt=int(1e8), can_only=True)
+    lr = MultiLogIterator(self.log_paths, wraparound=True, services=['carState'])
+    self.assertEqual(lr.start_time, int(60.1e9))
+    self.assertTrue(lr.seek_mono_time(int(179.9e9)))
+    self.assertEqual(next(lr).logMonoTime, int(179.9e9))
+    # wraps around to the first segment with carState
+    self.assertEqual(next(lr).logMonoTime, int(60.1e9))
+
+    with self.assertRaises(ValueError):
+      MultiLogIterator(self.log_paths[:1], services=['carState'])
+
+  def test_prefetch(self):
+    expected = [m.logMonoTime for m in MultiLogIterator(self.log_paths, wraparound=False)]
+
+    with MultiLogIterator(self.log_paths, wraparound=False, prefetch=2, max_segments=1) as lr:
+      self.assertEqual([m.logMonoTime for m in lr], expected)
+      self.assertEqual(sum(r is not None for r in lr._log_readers), 1)
+    # the pool is shut down on exit
+    with self.assertRaises(RuntimeError):
+      lr._prefetcher._pool.submit(int)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,11 +1,13 @@
 # pylint: skip-file
 
+import mmap
 import os
 import time
 import tempfile
 import threading
 import urllib.parse
 import pycurl
+from collections import OrderedDict
 from hashlib import sha256
 from io import BytesIO
 from tenacity import retry, wait_random_exponential, stop_after_attempt
@@ -15,6 +17,9 @@ K = 1000
 CHUNK_SIZE = 1000 * K
 
 CACHE_DIR = os.environ.get("COMMA_CACHE", "/tmp/comma_download_cache/")
+CACHE_MAX_BYTES = int(os.environ.get("COMMA_CACHE_MAX_BYTES", 10 * K * K * K))
+#  Number of range requests in flight at once
+DOWNLOAD_PARALLELISM = int(os.environ.get("URLFILE_PARALLELISM", "4"))
 
 
 def hash_256(link):
@@ -22,15 +27,96 @@ def hash_256(link):
   return hsh
 
 
+class DownloadCache(object):
+  """Keeps the download cache under a byte budget, evicting the least recently used chunks.
+
+     Other processes may share the directory, so files can disappear underneath us.
+  """
+  def __init__(self, cache_dir, max_bytes):
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    self._lock = threading.Lock()
+    self._entries = None
+    self._total = 0
+
+  def _load(self):
+    if self._entries is not None:
+      return
+    entries = []
+    for fn in os.listdir(self.cache_dir):
+      try:
+        st = os.stat(os.path.join(self.cache_dir, fn))
+      except FileNotFoundError:
+        continue
+      entries.append((st.st_mtime, fn, st.st_size))
+    self._entries = OrderedDict((fn, size) for _, fn, size in sorted(entries))
+    self._total = sum(self._entries.values())
+
+  def touch(self, fn):
+    with self._lock:
+      self._load()
+      if fn in self._entries:
+        self._entries.move_to_end(fn)
+    try:
+      os.utime(os.path.join(self.cache_dir, fn))
+    except FileNotFoundError:
+      pass
+
+  def add(self, fn, size):
+    with self._lock:
+      self._load()
+      self._total += size - self._entries.pop(fn, 0)
+      self._entries[fn] = size
+      while self._total > self.max_bytes and len(self._entries) > 1:
+        old_fn, old_size = self._entries.popitem(last=False)
+        self._total -= old_size
+        try:
+          os.remove(os.path.join(self.cache_dir, old_fn))
+        except FileNotFoundError:
+          pass
+
+  @property
+  def total_bytes(self):
+    with self._lock:
+      self._load()
+      return self._total
+
+
+_download_cache = None
+
+
+def get_download_cache():
+  global _download_cache
+  if _download_cache is None:
+    mkdirs_exists_ok(CACHE_DIR)
+    _download_cache = DownloadCache(CACHE_DIR, CACHE_MAX_BYTES)
+  return _download_cache
+
+
+class BufferWriter(object):
+  """Write target for pycurl that fills a preallocated buffer."""
+  def __init__(self, buf):
+    self.buf = memoryview(buf).cast('B')
+    self.written = 0
+
+  def write(self, data):
+    if self.written + len(data) > len(self.buf):
+      # more data than was asked for, returning a short count aborts the transfer
+      return 0
+    self.buf[self.written:self.written + len(data)] = data
+    self.written += len(data)
+
+
 class URLFile(object):
   _tlocal = threading.local()
 
-  def __init__(self, url, debug=False, cache=None):
+  def __init__(self, url, debug=False, cache=None, parallelism=None):
     self._url = url
     self._pos = 0
     self._length = None
     self._local_file = None
     self._debug = debug
+    self._parallelism = parallelism if parallelism is not None else DOWNLOAD_PARALLELISM
     #  True by default, false if FILEREADER_CACHE is defined, but can be overwritten by the cache input
     self._force_download = not int(os.environ.get("FILEREADER_CACHE", "0"))
     if cache is not None:
@@ -40,6 +126,10 @@ class URLFile(object):
       self._curl = self._tlocal.curl
     except AttributeError:
       self._curl = self._tlocal.curl = pycurl.Curl()
+    try:
+      self._multi_curls = self._tlocal.multi_curls
+    except AttributeError:
+      self._multi_curls = self._tlocal.multi_curls = []
     mkdirs_exists_ok(CACHE_DIR)
 
   def __enter__(self):
@@ -81,36 +171,158 @@ class URLFile(object):
         file_length.write(str(self._length))
     return self._length
 
+  def _chunk_file_name(self, chunk_number):
+    return hash_256(self._url) + "_" + str(float(chunk_number))
+
+  def _copy_cached_chunk(self, chunk_number, start, end, out):
+    """Copies bytes [start, end) of a cached chunk into out, returns False if it isn't cached."""
+    file_name = self._chunk_file_name(chunk_number)
+    try:
+      with open(os.path.join(CACHE_DIR, file_name), "rb") as cached_file, \
+           mmap.mmap(cached_file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if len(mm) < end:
+          return False
+        with memoryview(mm) as view:
+          out[:] = view[start:end]
+    except (FileNotFoundError, ValueError):
+      # ValueError is raised for empty files, which can't be mapped
+      return False
+    get_download_cache().touch(file_name)
+    return True
+
+  def _download_chunks(self, chunk_numbers):
+    """Downloads and caches chunks, coalescing contiguous ones into a single range request."""
+    length = self.get_length()
+    runs = []
+    for i in chunk_numbers:
+      if len(runs) and runs[-1][1] == i - 1:
+        runs[-1][1] = i
+      else:
+        runs.append([i, i])
+
+    # split long runs so that the requests can be spread over the parallel connections
+    per_request = max(1, -(-len(chunk_numbers) // self._parallelism))
+    requests = []
+    for first, last in runs:
+      for b in range(first, last + 1, per_request):
+        requests.append((b, min(b + per_request - 1, last)))
+
+    cache = get_download_cache()
+    ret = {}
+    for k in range(0, len(requests), self._parallelism):
+      batch = requests[k:k + self._parallelism]
+      datas = self.read_ranges([(b * CHUNK_SIZE, min((e + 1) * CHUNK_SIZE, length)) for b, e in batch])
+      for (b, e), data in zip(batch, datas):
+        data = memoryview(data)
+        for i in range(b, e + 1):
+          chunk = data[(i - b) * CHUNK_SIZE:(i - b + 1) * CHUNK_SIZE]
+          file_name = self._chunk_file_name(i)
+          with atomic_write_in_dir(os.path.join(CACHE_DIR, file_name), mode="wb", overwrite=True) as new_cached_file:
+            new_cached_file.write(chunk)
+          cache.add(file_name, len(chunk))
+          ret[i] = chunk
+    return ret
+
+  def readinto(self, b):
+    """Reads up to len(b) bytes into b, returns the number of bytes read.
+
+       Data is written straight into b, cached chunks are memory mapped and only the
+       needed part of them is copied.
+    """
+    out = memoryview(b).cast('B')
+    file_begin = self._pos
+    file_end = min(self._pos + len(out), self.get_length())
+    if file_begin >= file_end:
+      return 0
+
+    if self._force_download:
+      # split large reads over the parallel connections
+      part_size = max(CHUNK_SIZE, -(-(file_end - file_begin) // self._parallelism))
+      starts = range(file_begin, file_end, part_size)
+      ranges = [(start, min(start + part_size, file_end)) for start in starts]
+      self.read_ranges(ranges, [out[start - file_begin:end - file_begin] for start, end in ranges])
+      self._pos = file_end
+      return file_end - file_begin
+
+    #  We have to align with chunks we store
+    missing = []
+    for i in range(file_begin // CHUNK_SIZE, (file_end - 1) // CHUNK_SIZE + 1):
+      start, end = max(file_begin, i * CHUNK_SIZE), min(file_end, (i + 1) * CHUNK_SIZE)
+      if not self._copy_cached_chunk(i, start - i * CHUNK_SIZE, end - i * CHUNK_SIZE, out[start - file_begin:end - file_begin]):
+        missing.append(i)
+
+    for i, data in self._download_chunks(missing).items():
+      start, end = max(file_begin, i * CHUNK_SIZE), min(file_end, (i + 1) * CHUNK_SIZE)
+      out[start - file_begin:end - file_begin] = data[start - i * CHUNK_SIZE:end - i * CHUNK_SIZE]
+
+    self._pos = file_end
+    return file_end - file_begin
+
   def read(self, ll=None):
     if self._force_download:
       return self.read_aux(ll=ll)
 
-    file_begin = self._pos
-    file_end = self._pos + ll if ll is not None else self.get_length()
-    #  We have to align with chunks we store. Position is the begginiing of the latest chunk that starts before or at our file
-    position = (file_begin // CHUNK_SIZE) * CHUNK_SIZE
-    response = b""
-    while True:
-      self._pos = position
-      chunk_number = self._pos / CHUNK_SIZE
-      file_name = hash_256(self._url) + "_" + str(chunk_number)
-      full_path = os.path.join(CACHE_DIR, str(file_name))
-      data = None
-      #  If we don't have a file, download it
-      if not os.path.exists(full_path):
-        data = self.read_aux(ll=CHUNK_SIZE)
-        with atomic_write_in_dir(full_path, mode="wb") as new_cached_file:
-          new_cached_file.write(data)
-      else:
-        with open(full_path, "rb") as cached_file:
-          data = cached_file.read()
+    file_end = min(self._pos + ll, self.get_length()) if ll is not None else self.get_length()
+    response = bytearray(max(0, file_end - self._pos))
+    self.readinto(response)
+    return bytes(response)
+
+  def _setup_curl(self, c, headers, dats):
+    c.setopt(pycurl.URL, self._url)
+    c.setopt(pycurl.WRITEDATA, dats)
+    c.setopt(pycurl.NOSIGNAL, 1)
+    c.setopt(pycurl.TIMEOUT_MS, 500000)
+    c.setopt(pycurl.HTTPHEADER, headers)
+    c.setopt(pycurl.FOLLOWLOCATION, True)
+
+  @retry(wait=wait_random_exponential(multiplier=1, max=5), stop=stop_after_attempt(3), reraise=True)
+  def read_ranges(self, ranges, bufs=None):
+    """Downloads the byte ranges [start, end) at the same time into bufs, which are allocated if not given."""
+    if bufs is None:
+      bufs = [bytearray(end - start) for start, end in ranges]
+    while len(self._multi_curls) < len(ranges):
+      self._multi_curls.append(pycurl.Curl())
+
+    m = pycurl.CurlMulti()
+    transfers = []
+    for c, (start, end), buf in zip(self._multi_curls, ranges, bufs):
+      headers = ["Connection: keep-alive", f"Range: bytes={start}-{end - 1}"]
+      writer = BufferWriter(buf)
+      c.reset()
+      self._setup_curl(c, headers, writer)
+      m.add_handle(c)
+      transfers.append((c, headers, writer))
 
-      response += data[max(0, file_begin - position): min(CHUNK_SIZE, file_end - position)]
+    if self._debug:
+      print("downloading", self._url, ranges)
 
-      position += CHUNK_SIZE
-      if position >= file_end:
-        self._pos = file_end
-        return response
+    try:
+      num_handles = len(transfers)
+      while num_handles:
+        ret, num_handles = m.perform()
+        if ret == pycurl.E_CALL_MULTI_PERFORM:
+          continue
+        if num_handles:
+          m.select(1.0)
+
+      for c, headers, writer in transfers:
+        response_code = c.getinfo(pycurl.RESPONSE_CODE)
+        if response_code != 206:  # Partial Content
+          raise Exception(f"Error, requested range but got unexpected response {response_code} {headers} ({self._url}): {repr(bytes(writer.buf[:writer.written]))[:500]}")
+
+      _, _, failed = m.info_read()
+      if len(failed):
+        raise pycurl.error(*failed[0][1:])
+
+      for c, headers, writer in transfers:
+        if writer.written != len(writer.buf):
+          raise Exception(f"Error, got {writer.written} bytes for {headers} ({self._url})")
+    finally:
+      for c, _, _ in transfers:
+        m.remove_handle(c)
+      m.close()
+
+    return bufs
 
   @retry(wait=wait_random_exponential(multiplier=1, max=5), stop=stop_after_attempt(3), reraise=True)
   def read_aux(self, ll=None):
@@ -121,19 +333,14 @@ class URLFile(object):
         end = self.get_length() - 1
       else:
         end = min(self._pos + ll, self.get_length()) - 1
-      if self._pos >= end:
+      if self._pos > end:
         return b""
       headers.append(f"Range: bytes={self._pos}-{end}")
       download_range = True
 
     dats = BytesIO()
     c = self._curl
-    c.setopt(pycurl.URL, self._url)
-    c.setopt(pycurl.WRITEDATA, dats)
-    c.setopt(pycurl.NOSIGNAL, 1)
-    c.setopt(pycurl.TIMEOUT_MS, 500000)
-    c.setopt(pycurl.HTTPHEADER, headers)
-    c.setopt(pycurl.FOLLOWLOCATION, True)
+    self._setup_curl(c, headers, dats)
 
     if self._debug:
       print("downloading", self._url)
@@ -173,6 +380,9 @@ class URLFile(object):
   def seek(self, pos):
     self._pos = pos
 
+  def tell(self):
+    return self._pos
+
   @property
   def name(self):
     """Returns a local path to file with the URLFile's contents.
@@ -193,6 +403,8 @@ class URLFile(object):
 
       self._local_file = local_file
       self.read = self._local_file.read
+      self.readinto = self._local_file.readinto
       self.seek = self._local_file.seek
+      self.tell = self._local_file.tell
 
     return self._local_file.name